@@ -0,0 +1,417 @@
+"""
+Offline benchmarks for the Medical Search Report pipeline.
+
+parsers: replays the recorded pages in fixtures/ through every source extractor
+with each installed HTML parsing backend and reports throughput.
+
+pipeline: runs MedicalSearchSystem end to end against a local stand-in server that
+replays the recorded pages and stubs the embedding and completion APIs, and reports
+per-stage wall time, request counts, bytes parsed and end-to-end p50/p95.
+
+relevance: ranks the recorded pages for each judged query with the hybrid BM25 + dense
+ranking and with dense similarity alone, and reports nDCG@k for both.
+
+Usage:
+    python benchmark.py parsers --iterations 200
+    python benchmark.py pipeline --runs 10 --source-latency-ms 150 --api-latency-ms 300
+    python benchmark.py relevance --k 5
+"""
+import os
+import io
+import re
+import glob
+import json
+import math
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+import importlib.util
+import numpy as np
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(HERE, "fixtures")
+
+def load_medical_search():
+    """
+    Import code.py under a non-conflicting name (``code`` shadows the standard library module)
+    """
+    spec = importlib.util.spec_from_file_location("medical_search", os.path.join(HERE, "code.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# (extractor name, fixture glob, call on a MedicalSearchSystem)
+EXTRACTORS = [
+    ("pubmed_search", "pubmed_search.html",
+     lambda system, html: system._parse_pubmed_search(html, "https://pubmed.ncbi.nlm.nih.gov/")),
+    ("pubmed_abstract", "pubmed_article_*.html",
+     lambda system, html: system._parse_pubmed_abstract(html)),
+    ("clinical_trials_search", "clinicaltrials_search.html",
+     lambda system, html: system._parse_clinical_trials_search(html, "https://clinicaltrials.gov/")),
+    ("clinical_trial", "clinicaltrials_study_*.html",
+     lambda system, html: system._parse_clinical_trial(html)),
+    ("cdc_search", "cdc_search.html",
+     lambda system, html: system._parse_cdc_search(html, "https://www.cdc.gov/")),
+    ("cdc_page", "cdc_page_*.html",
+     lambda system, html: system._parse_cdc_page(html)),
+]
+
+def load_fixtures(pattern: str) -> list:
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, pattern))):
+        with open(path, 'r', encoding='utf-8') as f:
+            pages.append(f.read())
+    return pages
+
+def bench_parsers(iterations: int, backends: list):
+    medical_search = load_medical_search()
+    # Slowest backend first so the speedup column is relative to html.parser
+    backends = backends or list(reversed(medical_search.HTML_BACKENDS))
+    with tempfile.TemporaryDirectory(prefix="medical_search_bench_") as cache_dir:
+        print(f"{'extractor':<24}{'backend':<14}{'pages/s':>12}{'MB/s':>10}{'speedup':>10}")
+        for name, pattern, extract in EXTRACTORS:
+            pages = load_fixtures(pattern)
+            if not pages:
+                print(f"{name:<24}no fixtures matching {pattern}")
+                continue
+            total_bytes = sum(len(page.encode('utf-8')) for page in pages)
+
+            baseline = None
+            reference = None
+            for backend in backends:
+                system = medical_search.MedicalSearchSystem("benchmark", cache_dir=cache_dir, html_backend=backend)
+                # Parsers disagree on insignificant whitespace, so compare normalized text
+                outputs = " ".join(str([extract(system, page) for page in pages]).replace('\\n', ' ').split())
+                if reference is None:
+                    reference = outputs
+                elif outputs != reference:
+                    print(f"  warning: {backend} output differs from {backends[0]} for {name}")
+
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    for page in pages:
+                        extract(system, page)
+                elapsed = time.perf_counter() - start
+
+                pages_per_s = iterations * len(pages) / elapsed
+                mb_per_s = iterations * total_bytes / elapsed / 1e6
+                baseline = baseline or pages_per_s
+                print(f"{name:<24}{backend:<14}{pages_per_s:>12.1f}{mb_per_s:>10.2f}{pages_per_s / baseline:>9.2f}x")
+
+# Canned LLM output for the stand-in completions endpoint
+STUB_TERMS = "chest pain, shortness of breath, pulmonary embolism"
+STUB_ANALYSIS = """### Potential Causes
+- Acute coronary syndrome
+- Pulmonary embolism
+- Gastroesophageal reflux disease
+
+### Diagnostic Approaches
+- 12-lead ECG and high-sensitivity troponin
+- D-dimer with Wells criteria, CT pulmonary angiography
+
+### Treatment Options
+- Medications: aspirin, anticoagulants, proton pump inhibitors
+- Therapies: cardiac rehabilitation
+
+### Similar Cases
+- Adults presenting with pleuritic chest pain and dyspnea
+
+### Clinical Recommendations
+- Seek immediate care for chest pain lasting more than a few minutes
+- Cardiology referral for abnormal ECG or troponin"""
+
+DEFAULT_QUERIES = [
+    "35-year-old with chest pain and shortness of breath",
+    "sudden pleuritic chest pain after a long flight",
+    "chest pain and heartburn after meals",
+]
+
+def stub_embedding(text: str, dim: int = 256) -> list:
+    """
+    Deterministic hashed bag-of-words embedding so similar texts get similar vectors
+    """
+    vector = [0.0] * dim
+    for token in re.findall(r'[a-z0-9]+', text.lower()):
+        vector[int(hashlib.md5(token.encode('utf-8')).hexdigest(), 16) % dim] += 1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+class StandInServer:
+    """
+    Local stand-in for PubMed, ClinicalTrials.gov, CDC and the Nebius API. Source pages are
+    replayed from fixtures/, embeddings and completions are stubbed, and every response is
+    delayed by a configurable latency. Request counts and bytes served are recorded per route.
+    """
+    ROUTES = [
+        ('pubmed_search', re.compile(r'^/$'), lambda m: "pubmed_search.html"),
+        ('pubmed_article', re.compile(r'^/(\d+)/$'), lambda m: f"pubmed_article_{m.group(1)}.html"),
+        ('clinical_trials_search', re.compile(r'^/ct2/results$'), lambda m: "clinicaltrials_search.html"),
+        ('clinical_trial', re.compile(r'^/ct2/show/(NCT\d+)$'), lambda m: f"clinicaltrials_study_{m.group(1)}.html"),
+        ('cdc_search', re.compile(r'^/search/index\.html$'), lambda m: "cdc_search.html"),
+        ('cdc_page', re.compile(r'^/([a-z0-9-]+)/index\.html$'), lambda m: f"cdc_page_{m.group(1)}.html"),
+    ]
+
+    def __init__(self, source_latency_ms: float = 0, api_latency_ms: float = 0):
+        self.source_latency = source_latency_ms / 1000
+        self.api_latency = api_latency_ms / 1000
+        self.lock = threading.Lock()
+        self.stats = {}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately; without this, delayed ACKs add ~40 ms per request
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server._handle_get(self)
+
+            def do_POST(self):
+                server._handle_post(self)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _record(self, route: str, nbytes: int):
+        with self.lock:
+            entry = self.stats.setdefault(route, {'requests': 0, 'bytes': 0})
+            entry['requests'] += 1
+            entry['bytes'] += nbytes
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {}
+
+    def _send(self, handler, status: int, body: bytes, content_type: str):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _handle_get(self, handler):
+        time.sleep(self.source_latency)
+        path = urlparse(handler.path).path
+        for route, pattern, fixture in self.ROUTES:
+            match = pattern.match(path)
+            if match:
+                fixture_path = os.path.join(FIXTURES_DIR, fixture(match))
+                if os.path.exists(fixture_path):
+                    with open(fixture_path, 'rb') as f:
+                        body = f.read()
+                    self._record(route, len(body))
+                    self._send(handler, 200, body, "text/html; charset=utf-8")
+                    return
+        self._record('not_found', 0)
+        self._send(handler, 404, b"Not found", "text/plain")
+
+    def _handle_post(self, handler):
+        time.sleep(self.api_latency)
+        payload = json.loads(handler.rfile.read(int(handler.headers.get('Content-Length', 0))) or b"{}")
+        path = urlparse(handler.path).path
+
+        if path.endswith('/embeddings'):
+            inputs = payload.get('input')
+            inputs = inputs if isinstance(inputs, list) else [inputs]
+            body = json.dumps({'data': [{'index': i, 'embedding': stub_embedding(text)}
+                                        for i, text in enumerate(inputs)]}).encode('utf-8')
+            self._record('embeddings', len(body))
+            self._send(handler, 200, body, "application/json")
+            return
+
+        if path.endswith('/completions'):
+            prompt = payload.get('prompt', '')
+            if "each numbered query" in prompt:
+                numbers = re.findall(r'^\s*(\d+): ', prompt, re.MULTILINE)
+                text = "\n".join(f"{n}: {STUB_TERMS}" for n in numbers)
+            elif "Extract the key medical terms" in prompt:
+                text = STUB_TERMS
+            else:
+                text = STUB_ANALYSIS
+            if payload.get('stream'):
+                chunks = [text[i:i + 16] for i in range(0, len(text), 16)]
+                body = "".join(f"data: {json.dumps({'choices': [{'text': c}]})}\n\n" for c in chunks)
+                body = (body + "data: [DONE]\n\n").encode('utf-8')
+                content_type = "text/event-stream"
+            else:
+                body = json.dumps({'choices': [{'text': text}]}).encode('utf-8')
+                content_type = "application/json"
+            self._record('completions', len(body))
+            self._send(handler, 200, body, content_type)
+            return
+
+        self._send(handler, 404, b"Not found", "text/plain")
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * pct / 100
+    low, high = math.floor(k), math.ceil(k)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+def bench_pipeline(runs: int, queries: list, source_latency_ms: float, api_latency_ms: float, warm: bool):
+    medical_search = load_medical_search()
+    stage_names = ['terms', 'search.pubmed', 'search.clinical_trials', 'search.cdc', 'embed', 'rank',
+                   'analysis', 'render']
+    stage_samples = {name: [] for name in stage_names}
+    end_to_end = []
+
+    # Every cache directory is removed once the runs are done
+    with contextlib.ExitStack() as temp_dirs, StandInServer(source_latency_ms, api_latency_ms) as server:
+        shared_cache_dir = temp_dirs.enter_context(tempfile.TemporaryDirectory(prefix="medical_search_bench_"))
+        source_urls = {name: server.url for name in medical_search.SOURCE_URLS}
+        for run in range(runs):
+            for query in queries:
+                cache_dir = shared_cache_dir if warm else temp_dirs.enter_context(
+                    tempfile.TemporaryDirectory(prefix="medical_search_bench_"))
+                tracer = medical_search.Tracer()
+                system = medical_search.MedicalSearchSystem("benchmark", cache_dir=cache_dir,
+                                                            base_url=f"{server.url}v1/", source_urls=source_urls,
+                                                            tracer=tracer)
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    results = system.search_medical_info(query)
+                    ranked = system.rank_results(query, results)[:5]
+                    analysis = system.generate_medical_analysis(query, ranked)
+                    system._render_report_html(query, ranked, analysis['analysis'])
+                    end_to_end.append(time.perf_counter() - start)
+
+                # Stage time per run is the sum of that stage's spans (e.g. embedding calls inside ranking)
+                stages = tracer.summary()
+                for name in stage_names:
+                    stage_samples[name].append(stages.get(name, {}).get('total_ms', 0.0) / 1000)
+        request_stats = server.stats
+
+    total_runs = runs * len(queries)
+    print(f"{total_runs} pipeline runs ({'warm' if warm else 'cold'} caches, "
+          f"source latency {source_latency_ms:.0f} ms, API latency {api_latency_ms:.0f} ms)\n")
+    print(f"{'stage':<26}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for name in stage_names:
+        samples = [s * 1000 for s in stage_samples[name]]
+        print(f"{name:<26}{sum(samples) / len(samples):>10.1f}{percentile(samples, 50):>10.1f}"
+              f"{percentile(samples, 95):>10.1f}")
+    samples = [s * 1000 for s in end_to_end]
+    print(f"{'end-to-end':<26}{sum(samples) / len(samples):>10.1f}{percentile(samples, 50):>10.1f}"
+          f"{percentile(samples, 95):>10.1f}")
+
+    print(f"\n{'route':<26}{'requests':>10}{'per run':>10}{'KB':>10}")
+    html_bytes = 0
+    for route, entry in sorted(request_stats.items()):
+        if route not in ('embeddings', 'completions'):
+            html_bytes += entry['bytes']
+        print(f"{route:<26}{entry['requests']:>10}{entry['requests'] / total_runs:>10.1f}{entry['bytes'] / 1024:>10.1f}")
+    print(f"\nHTML bytes parsed: {html_bytes / 1024:.1f} KB ({html_bytes / 1024 / total_runs:.1f} KB per run)")
+
+# Graded judgments of the recorded pages for DEFAULT_QUERIES, keyed by URL path on the stand-in server:
+# 2 = answers the query, 1 = partly relevant; unlisted pages are not relevant
+RELEVANCE_JUDGMENTS = {
+    "35-year-old with chest pain and shortness of breath": {
+        "/38000001/": 2, "/heart-disease-symptoms/index.html": 2, "/38000002/": 1, "/38000004/": 1,
+        "/ct2/show/NCT05000001": 1,
+    },
+    "sudden pleuritic chest pain after a long flight": {
+        "/38000002/": 2, "/blood-clots-facts/index.html": 2, "/ct2/show/NCT05000002": 2, "/38000001/": 1,
+        "/ct2/show/NCT05000001": 1,
+    },
+    "chest pain and heartburn after meals": {
+        "/38000005/": 2, "/38000001/": 1, "/38000004/": 1,
+    },
+}
+
+def ndcg(gains: list, k: int) -> float:
+    """
+    nDCG@k of ranked gains against the ideal ordering of the same gains
+    """
+    def dcg(values):
+        return sum(g / math.log2(i + 2) for i, g in enumerate(values[:k]))
+    ideal = dcg(sorted(gains, reverse=True))
+    return dcg(gains) / ideal if ideal else 0.0
+
+def eval_relevance(k: int = 5, judgments: dict = RELEVANCE_JUDGMENTS) -> dict:
+    """
+    {query: {'hybrid': nDCG@k, 'dense': nDCG@k}} over the recorded pages, with the stand-in's
+    hashed bag-of-words embeddings as the dense model
+    """
+    medical_search = load_medical_search()
+    scores = {}
+
+    with contextlib.ExitStack() as temp_dirs, StandInServer() as server:
+        source_urls = {name: server.url for name in medical_search.SOURCE_URLS}
+        for query, judged in judgments.items():
+            cache_dir = temp_dirs.enter_context(tempfile.TemporaryDirectory(prefix="medical_search_bench_"))
+            system = medical_search.MedicalSearchSystem("benchmark", cache_dir=cache_dir, base_url=f"{server.url}v1/",
+                                                        source_urls=source_urls, tracer=medical_search.Tracer())
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = system.search_medical_info(query)
+                hybrid = system.rank_results(query, results)
+
+                # Dense-only baseline: cosine similarity of every document, not just the BM25 candidates
+                query_vector = np.asarray(system._embed_query(query))
+                embeddings = system._cached_embeddings(results, [system._ranking_text(r) for r in results])
+                similarity = [float(np.dot(e, query_vector) / (np.linalg.norm(e) * np.linalg.norm(query_vector) or 1.0))
+                              for e in embeddings]
+                dense = [results[i] for i in sorted(range(len(results)), key=lambda i: -similarity[i])]
+
+            def gains(ranked):
+                return [judged.get(urlparse(r.url).path, 0) for r in ranked]
+            scores[query] = {'hybrid': ndcg(gains(hybrid), k), 'dense': ndcg(gains(dense), k)}
+    return scores
+
+def bench_relevance(k: int):
+    scores = eval_relevance(k)
+    print(f"{'query':<56}{'hybrid':>10}{'dense':>10}")
+    for query, score in scores.items():
+        print(f"{query[:54]:<56}{score['hybrid']:>10.3f}{score['dense']:>10.3f}")
+    mean = {name: sum(s[name] for s in scores.values()) / len(scores) for name in ('hybrid', 'dense')}
+    print(f"{f'mean nDCG@{k}':<56}{mean['hybrid']:>10.3f}{mean['dense']:>10.3f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Medical Search Report benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parsers_cmd = subparsers.add_parser("parsers", help="HTML extractor throughput per parsing backend")
+    parsers_cmd.add_argument("--iterations", type=int, default=100)
+    parsers_cmd.add_argument("--backends", nargs="*", default=None,
+                             help="Backends to compare (default: all installed)")
+
+    pipeline_cmd = subparsers.add_parser("pipeline", help="End-to-end pipeline against a local stand-in server")
+    pipeline_cmd.add_argument("--runs", type=int, default=5, help="Passes over the query list")
+    pipeline_cmd.add_argument("--queries", nargs="*", default=DEFAULT_QUERIES)
+    pipeline_cmd.add_argument("--source-latency-ms", type=float, default=0)
+    pipeline_cmd.add_argument("--api-latency-ms", type=float, default=0)
+    pipeline_cmd.add_argument("--warm", action="store_true",
+                              help="Share caches and the local corpus across runs instead of starting cold")
+
+    relevance_cmd = subparsers.add_parser("relevance", help="nDCG@k of hybrid vs dense-only ranking on judged queries")
+    relevance_cmd.add_argument("--k", type=int, default=5)
+
+    args = parser.parse_args()
+    if args.command == "parsers":
+        bench_parsers(args.iterations, args.backends)
+    elif args.command == "pipeline":
+        bench_pipeline(args.runs, args.queries, args.source_latency_ms, args.api_latency_ms, args.warm)
+    elif args.command == "relevance":
+        bench_relevance(args.k)
+
+if __name__ == "__main__":
+    main()
@@ -6,45 +6,1063 @@ import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 from datetime import datetime
 import webbrowser
-from typing import List, Dict, Any
-from urllib.parse import urljoin
+from typing import List, Dict, Any, Optional, Callable, Iterator
+from urllib.parse import urljoin, urlsplit
+from collections import OrderedDict, deque
+from string import Template
 import json
+from html import escape as html_escape
 import random
+import argparse
+import hashlib
+import sqlite3
+import math
+import time
+import threading
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    SelectolaxParser = None
+
+try:
+    from flask import Flask, Response, request, jsonify, abort, stream_with_context
+except ImportError:
+    Flask = None
+
+try:
+    import lxml  # noqa: F401
+    BS4_FAST_PARSER = 'lxml'
+except ImportError:
+    BS4_FAST_PARSER = 'html.parser'
+
+SOURCE_URLS = {
+    'pubmed': "https://pubmed.ncbi.nlm.nih.gov/",
+    'clinical_trials': "https://clinicaltrials.gov/",
+    'cdc': "https://www.cdc.gov/"
+}
+
+DEFAULT_CACHE_DIR = os.getenv("MEDICAL_SEARCH_CACHE_DIR", ".medical_search_cache")
+DEFAULT_HTML_BACKEND = os.getenv("MEDICAL_SEARCH_HTML_BACKEND") or ('selectolax' if SelectolaxParser else BS4_FAST_PARSER)
+DEFAULT_TRACE_FILE = os.getenv("MEDICAL_SEARCH_TRACE_FILE")
+DEFAULT_TRACE_FORMAT = os.getenv("MEDICAL_SEARCH_TRACE_FORMAT", "json")
+HTML_BACKENDS = [name for name, available in [('selectolax', SelectolaxParser is not None),
+                                              ('lxml', BS4_FAST_PARSER == 'lxml'),
+                                              ('html.parser', True)] if available]
+
+class HTMLPage:
+    """
+    Parsed HTML page exposing CSS-selector extraction over the fastest installed backend:
+    selectolax, then BeautifulSoup with lxml, then BeautifulSoup with html.parser
+    """
+    def __init__(self, html: str, backend: str = DEFAULT_HTML_BACKEND):
+        self.backend = backend
+        if backend == 'selectolax':
+            self.root = SelectolaxParser(html)
+        else:
+            self.root = BeautifulSoup(html, backend)
+
+    def select(self, selector: str, node=None, limit: Optional[int] = None) -> list:
+        node = self.root if node is None else node
+        if self.backend == 'selectolax':
+            nodes = node.css(selector)
+            return nodes[:limit] if limit else nodes
+        return node.select(selector, limit=limit or 0)
+
+    def select_one(self, selector: str, node=None):
+        node = self.root if node is None else node
+        if self.backend == 'selectolax':
+            return node.css_first(selector)
+        return node.select_one(selector)
+
+    def text(self, node) -> str:
+        if node is None:
+            return ""
+        if self.backend == 'selectolax':
+            return node.text(deep=True).strip()
+        return node.get_text().strip()
+
+    def attr(self, node, name: str) -> Optional[str]:
+        if node is None:
+            return None
+        if self.backend == 'selectolax':
+            return node.attributes.get(name)
+        return node.get(name)
+
+    def _same(self, a, b) -> bool:
+        # selectolax creates a new wrapper per access, so identity only works for BeautifulSoup
+        return a == b if self.backend == 'selectolax' else a is b
+
+    def block_texts(self, selector: str, node=None, exclude: tuple = ()) -> List[str]:
+        """
+        Non-empty text of matching blocks in document order, skipping blocks nested in excluded tags
+        """
+        node = self.root if node is None else node
+        texts = []
+        for block in self.select(selector, node):
+            parent = block.parent
+            excluded = False
+            while parent is not None and not excluded and not self._same(parent, node):
+                excluded = (parent.tag if self.backend == 'selectolax' else parent.name) in exclude
+                parent = parent.parent
+            if not excluded:
+                text = self.text(block)
+                if text:
+                    texts.append(text)
+        return texts
+
+class SearchResult:
+    """
+    One retrieved document and its ranking scores. Slotted to keep large candidate sets compact,
+    and still readable like the dicts it replaced: result['title'], result.get('similarity_score', 0)
+    """
+    __slots__ = ('source', 'title', 'content', 'url', 'term_index', 'bm25_score', 'similarity_score', 'fusion_score')
+
+    def __init__(self, source: str, title: str, content: str, url: str, term_index: Optional[int] = None):
+        self.source = source
+        self.title = title
+        self.content = content
+        self.url = url
+        self.term_index = term_index
+        self.bm25_score = None
+        self.similarity_score = None
+        self.fusion_score = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'SearchResult':
+        return cls(data['source'], data['title'], data['content'], data['url'], data.get('term_index'))
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        A field or score, or default when it is unset
+        """
+        value = getattr(self, key) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def copy(self) -> 'SearchResult':
+        result = SearchResult(self.source, self.title, self.content, self.url, self.term_index)
+        result.bm25_score, result.similarity_score, result.fusion_score = \
+            self.bm25_score, self.similarity_score, self.fusion_score
+        return result
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in self.__slots__ if getattr(self, key) is not None}
+
+class EmbeddingCache:
+    """
+    Persistent document embedding cache stored as a memory-mapped float32 matrix.
+    Rows are addressed through an id map keyed by model, document URL and content hash.
+    """
+    def __init__(self, cache_dir: str, model: str):
+        self.model = model
+        self.matrix_path = os.path.join(cache_dir, "embeddings.f32")
+        self.index_path = os.path.join(cache_dir, "embeddings_index.json")
+        self.ids = {}
+        self.dim = None
+        self._matrix = None
+        self.lock = threading.RLock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        if os.path.exists(self.index_path) and os.path.exists(self.matrix_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    index = json.load(f)
+                # Rows written for another model may have a different width, so start over
+                if index.get('model') == model:
+                    self.ids = index.get('ids', {})
+                    self.dim = index.get('dim')
+            except Exception as e:
+                print(f"Ignoring unreadable embedding cache index: {str(e)}")
+                self.ids, self.dim = {}, None
+
+    def make_key(self, url: str, text: str) -> str:
+        """
+        Build the cache key for a document from its URL, content hash and model
+        """
+        content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return hashlib.sha256(f"{self.model}\n{url}\n{content_hash}".encode('utf-8')).hexdigest()
+
+    def _rows(self):
+        if self._matrix is None and self.ids and self.dim:
+            self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode='r',
+                                     shape=(len(self.ids), self.dim))
+        return self._matrix
+
+    def get_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Look up embeddings for the given keys, returning None for misses
+        """
+        with self.lock:
+            matrix = self._rows()
+            return [np.array(matrix[self.ids[key]]) if key in self.ids else None for key in keys]
+
+    def put_many(self, keys: List[str], embeddings: List[Optional[List[float]]]):
+        """
+        Append new embeddings to the matrix and persist the id map
+        """
+        with self.lock:
+            first_row = len(self.ids)
+            new_rows = []
+            for key, embedding in zip(keys, embeddings):
+                if embedding is None or key in self.ids:
+                    continue
+                vector = np.asarray(embedding, dtype=np.float32)
+                if self.dim is None:
+                    self.dim = int(vector.shape[0])
+                if vector.shape[0] != self.dim:
+                    continue
+                self.ids[key] = len(self.ids)
+                new_rows.append(vector)
+
+            if not new_rows:
+                return
+
+            # Write at the row offset recorded in the id map so a torn previous write is overwritten
+            self._matrix = None
+            with open(self.matrix_path, 'r+b' if os.path.exists(self.matrix_path) else 'wb') as f:
+                f.seek(first_row * self.dim * 4)
+                f.write(np.stack(new_rows).tobytes())
+                f.truncate()
+
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'model': self.model, 'dim': self.dim, 'ids': self.ids}, f)
+            os.replace(tmp_path, self.index_path)
+
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'have', 'in', 'is', 'it',
+    'its', 'of', 'on', 'or', 'that', 'the', 'to', 'was', 'were', 'with', 'what', 'which', 'who'
+}
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase word tokens without stopwords, shared by the BM25 indexes
+    """
+    return [t for t in re.findall(r'[a-z0-9]+', text.lower()) if t not in STOPWORDS]
+
+MEDICAL_LEXICON = [
+    # Symptoms and presentations
+    'chest pain', 'shortness of breath', 'dyspnea', 'palpitations', 'syncope', 'dizziness', 'vertigo',
+    'headache', 'migraine', 'fever', 'fatigue', 'cough', 'wheezing', 'hemoptysis', 'nausea', 'vomiting',
+    'diarrhea', 'constipation', 'abdominal pain', 'back pain', 'joint pain', 'rash', 'itching', 'swelling',
+    'edema', 'weight loss', 'weight gain', 'night sweats', 'insomnia', 'confusion', 'seizure', 'numbness',
+    'tingling', 'weakness', 'blurred vision', 'sore throat', 'jaundice', 'bleeding', 'bruising',
+    'heartburn', 'difficulty swallowing', 'frequent urination', 'blood in urine', 'memory loss', 'anxiety',
+    'depression', 'tremor',
+    # Conditions
+    'heart attack', 'myocardial infarction', 'acute coronary syndrome', 'angina', 'heart failure',
+    'atrial fibrillation', 'arrhythmia', 'hypertension', 'high blood pressure', 'hypotension', 'stroke',
+    'pulmonary embolism', 'deep vein thrombosis', 'blood clot', 'asthma', 'copd', 'pneumonia',
+    'bronchitis', 'tuberculosis', 'covid 19', 'influenza', 'diabetes', 'type 1 diabetes', 'type 2 diabetes',
+    'hypothyroidism', 'hyperthyroidism', 'obesity', 'high cholesterol', 'kidney disease', 'kidney stones',
+    'urinary tract infection', 'liver disease', 'cirrhosis', 'gerd', 'acid reflux', 'peptic ulcer',
+    'irritable bowel syndrome', 'crohn disease', 'ulcerative colitis', 'cancer', 'breast cancer',
+    'lung cancer', 'prostate cancer', 'colon cancer', 'leukemia', 'lymphoma', 'melanoma', 'osteoporosis',
+    'rheumatoid arthritis', 'osteoarthritis', 'gout', 'lupus', 'multiple sclerosis', 'parkinson disease',
+    'alzheimer disease', 'dementia', 'epilepsy', 'sepsis', 'anemia', 'allergy', 'anaphylaxis',
+    'panic disorder', 'schizophrenia', 'bipolar disorder',
+    # Treatments and drug classes
+    'anticoagulant', 'antibiotic', 'antiviral', 'statin', 'beta blocker', 'ace inhibitor', 'insulin',
+    'metformin', 'aspirin', 'warfarin', 'apixaban', 'rivaroxaban', 'heparin', 'nitroglycerin', 'ibuprofen',
+    'acetaminophen', 'opioid', 'corticosteroid', 'prednisone', 'chemotherapy', 'immunotherapy',
+    'radiation therapy', 'dialysis', 'vaccine', 'proton pump inhibitor', 'omeprazole', 'antidepressant',
+    'ssri', 'physical therapy', 'surgery',
+]
+
+MEDICAL_SUFFIX_PATTERN = re.compile(
+    r'\b[a-z]{3,}(?:itis|osis|emia|aemia|oma|pathy|algia|ectomy|plasty|scopy|penia|uria|plegia|'
+    r'trophy|megaly|rrhea|sclerosis|cardia|pnea)\b'
+)
+
+# Words that describe the patient rather than the medical problem
+QUERY_FILLER_WORDS = {
+    'year', 'years', 'old', 'yo', 'month', 'months', 'week', 'weeks', 'day', 'days', 'male', 'female',
+    'man', 'woman', 'boy', 'girl', 'patient', 'adult', 'child', 'infant', 'elderly', 'presenting',
+    'presents', 'history', 'since', 'after', 'severe', 'mild', 'acute', 'chronic', 'new', 'recent',
+    'sudden', 'onset', 'persistent', 'ongoing', 'recurrent', 'worsening', 'experiencing', 'complains',
+    'has', 'having', 'had', 'my', 'his', 'her', 'their',
+    'i', 'me', 'am', 'this', 'these', 'about', 'how', 'treat', 'treatment', 'cause', 'causes', 'symptoms'
+}
+
+def normalize_query(query: str) -> str:
+    """
+    Case-, punctuation- and whitespace-insensitive form of a query used as a cache key
+    """
+    return ' '.join(re.findall(r'[a-z0-9]+', query.lower()))
+
+class MedicalLexicon:
+    """
+    Regex lexicon extractor that answers term extraction locally when it covers the query well
+    """
+    def __init__(self, terms: List[str] = MEDICAL_LEXICON):
+        alternation = '|'.join(re.escape(t) for t in sorted(terms, key=len, reverse=True))
+        self.pattern = re.compile(rf'\b(?:{alternation})\b')
+
+    def extract(self, query: str) -> tuple:
+        """
+        Return (terms, confidence) where confidence is the share of content words covered by a term
+        """
+        text = normalize_query(query)
+        terms = []
+        for match in list(self.pattern.finditer(text)) + list(MEDICAL_SUFFIX_PATTERN.finditer(text)):
+            if match.group(0) not in terms and not any(match.group(0) in t for t in terms):
+                terms.append(match.group(0))
+
+        content_words = [w for w in tokenize(text) if not w.isdigit() and w not in QUERY_FILLER_WORDS]
+        if not terms or not content_words:
+            return terms, 0.0
+        covered = set(tokenize(' '.join(terms)))
+        return terms, sum(1 for w in content_words if w in covered) / len(content_words)
+
+class TermExtractionCache:
+    """
+    LRU of normalized query -> extracted terms in front of a SQLite table on disk. The table keeps
+    the max_disk_entries most recently used queries; a miss writes one row instead of the whole store.
+    """
+    def __init__(self, cache_dir: str, max_entries: int = 1024, max_disk_entries: int = 100000):
+        self.path = os.path.join(cache_dir, "terms.db")
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory = OrderedDict()
+        self.lock = threading.RLock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS terms (key TEXT PRIMARY KEY, terms TEXT NOT NULL, "
+                          "last_access REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS terms_last_access ON terms (last_access)")
+        self.conn.commit()
+        self._import_json(os.path.join(cache_dir, "terms.json"))
+        self.disk_entries = self.conn.execute("SELECT COUNT(*) FROM terms").fetchone()[0]
+
+    def _import_json(self, path: str):
+        # Earlier versions kept the whole store in one JSON file
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            now = time.time()
+            self.conn.executemany("INSERT OR IGNORE INTO terms VALUES (?, ?, ?)",
+                                  [(key, json.dumps(terms), now) for key, terms in saved.items()])
+            self.conn.commit()
+            os.remove(path)
+        except (ValueError, OSError) as e:
+            print(f"Ignoring unreadable term cache {path}: {str(e)}")
+
+    def get(self, key: str) -> tuple:
+        """
+        Return (terms, tier) with tier 'memory' or 'disk', or (None, None) on a miss
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key], 'memory'
+            row = self.conn.execute("SELECT terms FROM terms WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, None
+            self.conn.execute("UPDATE terms SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            terms = json.loads(row[0])
+            self._remember(key, terms)
+            return terms, 'disk'
+
+    def set(self, key: str, terms: List[str]):
+        with self.lock:
+            self._remember(key, terms)
+            row = (json.dumps(terms), time.time(), key)
+            if self.conn.execute("UPDATE terms SET terms = ?, last_access = ? WHERE key = ?", row).rowcount == 0:
+                self.conn.execute("INSERT OR REPLACE INTO terms (terms, last_access, key) VALUES (?, ?, ?)", row)
+                self.disk_entries += 1
+            if self.disk_entries > self.max_disk_entries:
+                self.disk_entries -= self.conn.execute(
+                    "DELETE FROM terms WHERE key IN (SELECT key FROM terms ORDER BY last_access LIMIT ?)",
+                    (self.disk_entries - self.max_disk_entries,)
+                ).rowcount
+            self.conn.commit()
+
+    def _remember(self, key: str, terms: List[str]):
+        self.memory[key] = terms
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+class BM25Index:
+    """
+    Incrementally built Okapi BM25 index over short documents
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_ids = []
+        self.term_freqs = []
+        self.doc_lengths = []
+        self.doc_freqs = {}
+        self.total_length = 0
+
+    def add(self, doc_id: Any, text: str):
+        tokens = tokenize(text)
+        freqs = {}
+        for token in tokens:
+            freqs[token] = freqs.get(token, 0) + 1
+        for token in freqs:
+            self.doc_freqs[token] = self.doc_freqs.get(token, 0) + 1
+        self.doc_ids.append(doc_id)
+        self.term_freqs.append(freqs)
+        self.doc_lengths.append(len(tokens))
+        self.total_length += len(tokens)
+
+    def search(self, query: str, top_k: Optional[int] = None) -> List[tuple]:
+        """
+        Return (doc_id, score) pairs with a positive score, best first
+        """
+        n_docs = len(self.doc_ids)
+        if not n_docs:
+            return []
+        avg_length = self.total_length / n_docs or 1
+        query_terms = [t for t in set(tokenize(query)) if t in self.doc_freqs]
+
+        scored = []
+        for i, freqs in enumerate(self.term_freqs):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[i] / avg_length)
+            for term in query_terms:
+                tf = freqs.get(term)
+                if tf:
+                    df = self.doc_freqs[term]
+                    idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                    score += idf * tf * (self.k1 + 1) / (tf + norm)
+            if score > 0:
+                scored.append((self.doc_ids[i], score))
+
+        scored.sort(key=lambda x: x[1], reverse=True)
+        return scored[:top_k] if top_k else scored
+
+class LocalCorpus:
+    """
+    Every document fetched so far, persisted as JSON lines and searchable with BM25
+    """
+    def __init__(self, cache_dir: str):
+        self.path = os.path.join(cache_dir, "corpus.jsonl")
+        self.documents = {}
+        self.index = BM25Index()
+        self.lock = threading.RLock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._index(SearchResult.from_dict(json.loads(line)))
+                    except (ValueError, KeyError):
+                        continue
+
+    def _index(self, document: SearchResult) -> bool:
+        url = document.url
+        if url in self.documents:
+            return False
+        self.documents[url] = document
+        self.index.add(url, f"{document.title} {document.content}")
+        return True
+
+    def add_documents(self, results: List[SearchResult]) -> int:
+        """
+        Add unseen documents to the corpus and return how many were new
+        """
+        with self.lock:
+            new_documents = []
+            for result in results:
+                document = SearchResult(result['source'], result['title'], result['content'], result['url'])
+                if document.url and self._index(document):
+                    new_documents.append(document)
+
+            if new_documents:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    for document in new_documents:
+                        f.write(json.dumps(document.to_dict()) + "\n")
+            return len(new_documents)
+
+    def search(self, query: str, top_k: int = 20) -> List[SearchResult]:
+        """
+        Copies of the best BM25 matches, so callers can score them without touching the corpus
+        """
+        with self.lock:
+            return [self.documents[url].copy() for url, _ in self.index.search(query, top_k)]
+
+BOILERPLATE_PATTERN = re.compile(
+    r'^(page last reviewed|last reviewed|content source|source:|on this page|related pages|share this|'
+    r'print this page|skip directly to|sign up for|get email updates|to receive email updates|'
+    r'links with this icon|exit notification|cookie|accessibility|privacy policy)',
+    re.IGNORECASE
+)
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    First max_tokens whitespace tokens of text, with whitespace collapsed
+    """
+    return ' '.join(text.split(None, max_tokens)[:max_tokens])
+
+def budget_blocks(blocks: List[str], max_tokens: int) -> List[str]:
+    """
+    Page blocks in order until max_tokens is spent, skipping boilerplate lines and repeated blocks
+    """
+    kept, seen, remaining = [], set(), max_tokens
+    for block in blocks:
+        key = normalize_query(block)
+        if not key or key in seen or BOILERPLATE_PATTERN.match(block):
+            continue
+        seen.add(key)
+        tokens = block.split()
+        kept.append(' '.join(tokens[:remaining]))
+        remaining -= len(tokens)
+        if remaining <= 0:
+            break
+    return kept
+
+def simhash(text: str, shingle_size: int = 3) -> int:
+    """
+    64-bit SimHash over word shingles; near-identical texts differ in only a few bits
+    """
+    words = re.findall(r'[a-z0-9]+', text.lower())
+    shingles = {' '.join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+    hashes = np.array([int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'big')
+                       for s in shingles], dtype=np.uint64)
+    bits = (hashes[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    weights = bits.astype(np.int64).sum(axis=0) * 2 - len(hashes)
+    return sum(1 << bit for bit in np.flatnonzero(weights > 0).tolist())
+
+class DocumentNormalizer:
+    """
+    Cleans fetched results before they are stored and embedded: collapses whitespace, caps content
+    at a token budget and drops exact and near-duplicate documents (SimHash Hamming distance)
+    """
+    def __init__(self, max_tokens: int = 512, max_distance: int = 8):
+        self.max_tokens = max_tokens
+        self.max_distance = max_distance
+
+    def normalize(self, results: List[SearchResult]) -> tuple:
+        """
+        (kept results in their original order, number of duplicates dropped)
+        """
+        kept, urls, fingerprints = [], set(), []
+        for result in results:
+            if result.url in urls:
+                continue
+            content = truncate_tokens(result['content'], self.max_tokens)
+            fingerprint = simhash(f"{result.title} {content}")
+            if any((fingerprint ^ other).bit_count() <= self.max_distance for other in fingerprints):
+                continue
+            urls.add(result.url)
+            fingerprints.append(fingerprint)
+            result.content = content
+            kept.append(result)
+        return kept, len(results) - len(kept)
+
+DEFAULT_FANOUT = {'pubmed': (3, 5), 'clinical_trials': (2, 3), 'cdc': (1, 2)}
+SOURCE_KEYS = {'PubMed': 'pubmed', 'ClinicalTrials.gov': 'clinical_trials', 'CDC': 'cdc'}
+
+class FanOutPlanner:
+    """
+    Learns which sources and search-term positions put documents into the top-ranked results and
+    splits a per-query fetch latency budget toward the high-yield ones. The fixed default fan-out
+    is used until every source has been observed for warmup queries. Statistics persist as JSON.
+    """
+    FETCH_STAGES = {
+        'fetch.pubmed_search': ('pubmed', 'search_seconds'),
+        'fetch.pubmed_article': ('pubmed', 'detail_seconds'),
+        'fetch.clinical_trials_search': ('clinical_trials', 'search_seconds'),
+        'fetch.clinical_trial': ('clinical_trials', 'detail_seconds'),
+        'fetch.cdc_search': ('cdc', 'search_seconds'),
+        'fetch.cdc_page': ('cdc', 'detail_seconds'),
+    }
+
+    def __init__(self, cache_dir: str, latency_budget: float = 10.0, warmup: int = 5, max_terms: int = 3,
+                 prior_yield: float = 0.25, prior_weight: float = 5.0, smoothing: float = 0.2):
+        self.path = os.path.join(cache_dir, "fanout.json")
+        self.latency_budget = latency_budget
+        self.warmup = warmup
+        self.max_terms = max_terms
+        self.prior_yield = prior_yield
+        self.prior_weight = prior_weight
+        self.smoothing = smoothing
+        # Never fetch more documents per query than the default fan-out does, only redistribute them
+        self.max_documents = sum(terms * per_term for terms, per_term in DEFAULT_FANOUT.values())
+        self.lock = threading.Lock()
+        self.sources = {name: {'queries': 0, 'searches': [0] * max_terms, 'fetched': [0] * max_terms,
+                               'top_hits': [0] * max_terms, 'search_seconds': 1.0, 'detail_seconds': 0.5}
+                        for name in DEFAULT_FANOUT}
+        os.makedirs(cache_dir, exist_ok=True)
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+                for name, stats in saved.items():
+                    if name in self.sources:
+                        self.sources[name].update({k: v for k, v in stats.items() if k in self.sources[name]})
+            except (ValueError, OSError):
+                pass
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.sources, f)
+        os.replace(tmp_path, self.path)
+
+    def _yield(self, hits: int, fetched: int) -> float:
+        return (hits + self.prior_weight * self.prior_yield) / (fetched + self.prior_weight)
+
+    def observe_fetch(self, stage: str, seconds: float):
+        """
+        Fold one page fetch time into the source's moving average
+        """
+        if stage not in self.FETCH_STAGES:
+            return
+        name, key = self.FETCH_STAGES[stage]
+        with self.lock:
+            stats = self.sources[name]
+            stats[key] += self.smoothing * (seconds - stats[key])
+
+    def record_query(self, searched: Dict[str, int], results: List[Dict[str, Any]]):
+        """
+        Count the term searches each source ran for a query and the documents they fetched,
+        by search-term position
+        """
+        with self.lock:
+            for name, stats in self.sources.items():
+                stats['queries'] += 1
+                for term_index in range(min(searched.get(name, 0), self.max_terms)):
+                    stats['searches'][term_index] += 1
+            for result in results:
+                name, term_index = SOURCE_KEYS.get(result['source']), result.get('term_index')
+                if name is not None and term_index is not None and term_index < self.max_terms:
+                    self.sources[name]['fetched'][term_index] += 1
+            self._save()
+
+    def record_ranking(self, top_results: List[Dict[str, Any]]):
+        """
+        Credit the sources and term positions whose documents made it into the top results
+        """
+        with self.lock:
+            credited = False
+            for result in top_results:
+                name, term_index = SOURCE_KEYS.get(result['source']), result.get('term_index')
+                if name is not None and term_index is not None and term_index < self.max_terms:
+                    self.sources[name]['top_hits'][term_index] += 1
+                    credited = True
+            if credited:
+                self._save()
+
+    def _terms(self, name: str, stats: Dict[str, Any]) -> int:
+        """
+        Leading term positions, up to the default, whose top hits per search are at least half of
+        the first position's. A term that only finds documents an earlier term already fetched scores nothing.
+        """
+        rates = [self._yield(h, n) for h, n in zip(stats['top_hits'], stats['searches'])]
+        terms = 1
+        while terms < min(DEFAULT_FANOUT[name][0], self.max_terms) and rates[terms] >= 0.5 * rates[0]:
+            terms += 1
+        return terms
+
+    def plan(self) -> Dict[str, tuple]:
+        """
+        (terms, documents per term) for each source
+        """
+        with self.lock:
+            if min(stats['queries'] for stats in self.sources.values()) < self.warmup:
+                return dict(DEFAULT_FANOUT)
+            
+            # Every source keeps at least one document per term so its yield keeps being measured
+            terms = {name: self._terms(name, stats) for name, stats in self.sources.items()}
+            per_term = {name: 1 for name in self.sources}
+            budget = self.latency_budget - sum(terms[name] * (stats['search_seconds'] + stats['detail_seconds'])
+                                               for name, stats in self.sources.items())
+            documents = sum(terms.values())
+            
+            # Greedily add a document per term to the source with the best yield per second of fetching
+            value = {
+                name: self._yield(sum(stats['top_hits']), sum(stats['fetched'])) / max(stats['detail_seconds'], 1e-3)
+                for name, stats in self.sources.items()
+            }
+            while True:
+                candidates = [name for name, stats in self.sources.items()
+                              if per_term[name] < 2 * DEFAULT_FANOUT[name][1]
+                              and terms[name] * stats['detail_seconds'] <= budget
+                              and documents + terms[name] <= self.max_documents]
+                if not candidates:
+                    break
+                name = max(candidates, key=value.get)
+                per_term[name] += 1
+                budget -= terms[name] * self.sources[name]['detail_seconds']
+                documents += terms[name]
+            return {name: (terms[name], per_term[name]) for name in self.sources}
+
+    def stats(self) -> Dict[str, Any]:
+        plan = self.plan()
+        with self.lock:
+            return {
+                'latency_budget': self.latency_budget,
+                'adaptive': min(stats['queries'] for stats in self.sources.values()) >= self.warmup,
+                'sources': {
+                    name: {
+                        'queries': stats['queries'],
+                        'searches': sum(stats['searches']),
+                        'fetched': sum(stats['fetched']),
+                        'top_hits': sum(stats['top_hits']),
+                        'yield': round(self._yield(sum(stats['top_hits']), sum(stats['fetched'])), 4),
+                        'term_yield': [round(self._yield(h, n), 4) for h, n in zip(stats['top_hits'], stats['searches'])],
+                        'search_seconds': round(stats['search_seconds'], 4),
+                        'detail_seconds': round(stats['detail_seconds'], 4),
+                        'plan': {'terms': plan[name][0], 'per_term': plan[name][1]}
+                    }
+                    for name, stats in self.sources.items()
+                }
+            }
+
+class Span:
+    """
+    One timed stage of a query, with attributes such as bytes, HTTP status and cache hit/miss
+    """
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self.duration = None
+        self.error = None
+        self._start = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, name: str, value: float = 1):
+        """
+        Accumulate a counter attribute, e.g. bytes over several API calls
+        """
+        self.attributes[name] = self.attributes.get(name, 0) + value
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start_time,
+            'duration_ms': round((self.duration or 0) * 1000, 3),
+            'status': 'error' if self.error else 'ok',
+            'error': self.error,
+            'attributes': self.attributes
+        }
+
+    def to_otel(self) -> Dict[str, Any]:
+        """
+        The span as an OpenTelemetry (OTLP/JSON) span record
+        """
+        start_ns = int(self.start_time * 1e9)
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or "",
+            'name': self.name,
+            'kind': 'SPAN_KIND_INTERNAL',
+            'startTimeUnixNano': str(start_ns),
+            'endTimeUnixNano': str(start_ns + int((self.duration or 0) * 1e9)),
+            'attributes': [{'key': key, 'value': self._otel_value(value)} for key, value in self.attributes.items()],
+            'status': {'code': 'STATUS_CODE_ERROR', 'message': self.error} if self.error else {'code': 'STATUS_CODE_OK'}
+        }
+
+    @staticmethod
+    def _otel_value(value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, (int, np.integer)):
+            return {'intValue': str(int(value))}
+        if isinstance(value, (float, np.floating)):
+            return {'doubleValue': float(value)}
+        return {'stringValue': str(value)}
+
+_current_span = contextvars.ContextVar('medical_search_span', default=None)
+
+def current_span() -> Optional[Span]:
+    """
+    The innermost open span in this context, if any
+    """
+    return _current_span.get()
+
+class Tracer:
+    """
+    Records nested spans for each query stage. Recent spans are kept in memory for summaries;
+    with export_path every finished span is also appended as a JSON line, either in the plain
+    span format or as OpenTelemetry span records (export_format='otel').
+    """
+    def __init__(self, export_path: Optional[str] = None, export_format: str = 'json', max_spans: int = 4096):
+        if export_format not in ('json', 'otel'):
+            raise ValueError(f"Unknown trace export format: {export_format}")
+        self.export_path = export_path
+        self.export_format = export_format
+        self.spans = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        parent = _current_span.get()
+        span = Span(name, parent.trace_id if parent else os.urandom(16).hex(),
+                    parent.span_id if parent else None, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = str(e) or type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            span.finish()
+            self._record(span)
+
+    def _record(self, span: Span):
+        with self.lock:
+            self.spans.append(span)
+            if self.export_path:
+                with open(self.export_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(self._export_record(span), default=str) + "\n")
+
+    def _export_record(self, span: Span) -> Dict[str, Any]:
+        return span.to_otel() if self.export_format == 'otel' else span.to_dict()
+
+    def export(self, path: str):
+        """
+        Write every retained span to path as JSON lines
+        """
+        with self.lock:
+            spans = list(self.spans)
+        with open(path, 'w', encoding='utf-8') as f:
+            for span in spans:
+                f.write(json.dumps(self._export_record(span), default=str) + "\n")
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Per-stage count, error count and total/mean/max duration over the retained spans
+        """
+        with self.lock:
+            spans = list(self.spans)
+        stages = {}
+        for span in spans:
+            stage = stages.setdefault(span.name, {'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            duration_ms = (span.duration or 0) * 1000
+            stage['count'] += 1
+            stage['errors'] += 1 if span.error else 0
+            stage['total_ms'] += duration_ms
+            stage['max_ms'] = max(stage['max_ms'], duration_ms)
+        for stage in stages.values():
+            stage['mean_ms'] = round(stage['total_ms'] / stage['count'], 3)
+            stage['total_ms'] = round(stage['total_ms'], 3)
+            stage['max_ms'] = round(stage['max_ms'], 3)
+        return stages
+
+class AnalysisSectionParser:
+    """
+    Incrementally splits streamed analysis text into '### ' sections
+    """
+    def __init__(self):
+        self.text = ""
+        self.completed_text = ""
+        self.sections = []
+        self._current = None
+        self._line_start = 0
+
+    def feed(self, delta: str) -> List[str]:
+        """
+        Add streamed text and return the titles of sections it completed
+        """
+        self.text += delta
+        finished = []
+        while True:
+            line_end = self.text.find('\n', self._line_start)
+            if line_end < 0:
+                break
+            line = self.text[self._line_start:line_end]
+            if line.startswith('### '):
+                if self._current is not None:
+                    self.completed_text = self.text[:self._line_start]
+                    self.sections.append(self._current)
+                    finished.append(self._current)
+                self._current = line[4:].strip()
+            self._line_start = line_end + 1
+        return finished
+
+    def close(self) -> List[str]:
+        """
+        Mark the stream as finished and return the last section, if any
+        """
+        if self._current is None:
+            return []
+        self.completed_text = self.text
+        self.sections.append(self._current)
+        self._current = None
+        return [self.sections[-1]]
 
 class MedicalSearchSystem:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, cache_dir: str = DEFAULT_CACHE_DIR,
+                 html_backend: str = DEFAULT_HTML_BACKEND,
+                 local_min_results: int = 5, local_similarity_threshold: float = 0.35,
+                 local_similarity_ratio: float = 0.4,
+                 rerank_top_k: int = 12, rrf_k: int = 60, lexicon_confidence: float = 0.8,
+                 base_url: str = "https://api.studio.nebius.com/v1/",
+                 source_urls: Optional[Dict[str, str]] = None, tracer: Optional[Tracer] = None,
+                 content_max_tokens: int = 512, embed_max_tokens: int = 96,
+                 fanout_latency_budget: float = 10.0, yield_top_k: int = 5, query_cache_size: int = 256):
         """
         Initialize the medical search system with Nebius AI Studio API
         """
+        self.tracer = tracer or Tracer(DEFAULT_TRACE_FILE, DEFAULT_TRACE_FORMAT)
         self.api_key = api_key
-        self.base_url = "https://api.studio.nebius.com/v1/"
+        self.base_url = base_url
+        self.source_urls = {**SOURCE_URLS, **(source_urls or {})}
         self.embedding_model = "BAAI/bge-en-icl"
         self.llm_model = "meta-llama/Meta-Llama-3.1-70B-Instruct"
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
+        self.html_backend = html_backend
+        self.cache_dir = cache_dir
+        self.embedding_cache = EmbeddingCache(cache_dir, self.embedding_model)
+        self.corpus = LocalCorpus(cache_dir)
+        self.local_min_results = local_min_results
+        self.local_similarity_threshold = local_similarity_threshold
+        self.local_similarity_ratio = local_similarity_ratio
+        # Query -> embedding LRU shared by the service and batch worker threads
+        self._query_embeddings = OrderedDict()
+        self._query_lock = threading.Lock()
+        self.query_cache_size = query_cache_size
+        self.rerank_top_k = rerank_top_k
+        self.rrf_k = rrf_k
+        self.term_cache = TermExtractionCache(cache_dir)
+        self.lexicon = MedicalLexicon()
+        self.lexicon_confidence = lexicon_confidence
+        self.normalizer = DocumentNormalizer(max_tokens=content_max_tokens)
+        self.embed_max_tokens = embed_max_tokens
+        self.planner = FanOutPlanner(cache_dir, latency_budget=fanout_latency_budget)
+        self.yield_top_k = yield_top_k
+        self.term_stats = {'queries': 0, 'memory_hits': 0, 'disk_hits': 0, 'lexicon_answers': 0,
+                           'llm_calls': 0, 'llm_failures': 0}
+        self._stats_lock = threading.Lock()
+        
+        # One pooled keep-alive session shared by every source fetch and API call
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=32)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
-    def search_medical_info(self, query: str) -> List[Dict[str, Any]]:
+    def search_medical_info(self, query: str) -> List[SearchResult]:
         """
         Search for medical information based on user query
         """
+        # Answer from the local corpus when it already holds enough relevant documents
+        with self.tracer.span('search.local') as span:
+            local_results = self._search_local(query)
+            span.set(results=len(local_results), cache_hit=len(local_results) >= self.local_min_results)
+        if len(local_results) >= self.local_min_results:
+            print(f"Found {len(local_results)} relevant medical documents in the local corpus")
+            return local_results
+        
         # Extract key medical terms from query
         medical_terms = self._extract_medical_terms(query)
         
-        # Fetch data from medical sources
+        # Fetch data from medical sources, with fan-out shifted toward the sources that have been paying off
+        plan = self.planner.plan()
         results = []
-        results.extend(self._search_pubmed(medical_terms))
-        results.extend(self._search_clinical_trials(medical_terms))
-        results.extend(self._search_cdc(medical_terms))
+        results.extend(self._search_pubmed(medical_terms, *plan['pubmed']))
+        results.extend(self._search_clinical_trials(medical_terms, *plan['clinical_trials']))
+        results.extend(self._search_cdc(medical_terms, *plan['cdc']))
+        self.planner.record_query({name: min(len(medical_terms), terms) for name, (terms, _) in plan.items()}, results)
+        
+        # Sources overlap heavily; drop near-duplicates and cap content before anything is stored or embedded
+        with self.tracer.span('normalize', documents=len(results)) as span:
+            results, duplicates = self.normalizer.normalize(results)
+            span.set(duplicates=duplicates)
         
-        print(f"Found {len(results)} relevant medical documents")
+        added = self.corpus.add_documents(results)
+        print(f"Found {len(results)} relevant medical documents ({added} new to the local corpus)")
         return results
 
+    def _search_local(self, query: str, candidates: int = 20) -> List[SearchResult]:
+        """
+        BM25 over the local corpus, keeping candidates whose cached embedding is close to the query.
+        The best candidate must reach local_similarity_threshold; the rest are kept when they score at
+        least local_similarity_ratio of the best, since absolute cosine scales differ between embedding models.
+        """
+        documents = self.corpus.search(query, top_k=candidates)
+        if len(documents) < self.local_min_results:
+            return []
+        
+        query_embedding = self._embed_query(query)
+        if not query_embedding:
+            return []
+        
+        keys = [self.embedding_cache.make_key(d['url'], self._ranking_text(d)) for d in documents]
+        embeddings = self.embedding_cache.get_many(keys)
+        
+        scored = []
+        for document, embedding in zip(documents, embeddings):
+            if embedding is None:
+                continue
+            similarity = cosine_similarity(
+                np.array(query_embedding).reshape(1, -1),
+                embedding.reshape(1, -1)
+            )[0][0]
+            scored.append((similarity, document))
+        
+        best = max((similarity for similarity, _ in scored), default=0.0)
+        if best < self.local_similarity_threshold:
+            return []
+        return [document for similarity, document in scored if similarity >= self.local_similarity_ratio * best]
+
     def _extract_medical_terms(self, query: str) -> List[str]:
         """
-        Use LLM to extract key medical terms from query
+        Extract key medical terms from query: cached answer, then the local lexicon, then the LLM
         """
+        with self.tracer.span('terms') as span:
+            terms, tier = self._lookup_medical_terms(query, span)
+            span.set(source=tier, cache_hit=tier in ('memory', 'disk'), terms=len(terms))
+            return terms
+
+    def _lookup_medical_terms(self, query: str, span: Span) -> tuple:
+        """
+        (terms, where they came from) for _extract_medical_terms
+        """
+        self._count_term_stat('queries')
+        key = normalize_query(query)
+        
+        terms, tier = self.term_cache.get(key)
+        if terms is not None:
+            self._count_term_stat(f'{tier}_hits')
+            return terms, tier
+        
+        terms, confidence = self.lexicon.extract(query)
+        if terms and confidence >= self.lexicon_confidence:
+            self._count_term_stat('lexicon_answers')
+            self.term_cache.set(key, terms)
+            return terms, 'lexicon'
+        
         prompt = f"""
         Extract the key medical terms from this query that would be useful for searching medical literature.
         Return only a comma-separated list of terms, no additional text.
@@ -52,8 +1070,9 @@ class MedicalSearchSystem:
         Query: {query}
         """
         
+        self._count_term_stat('llm_calls')
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}completions",
                 headers=self.headers,
                 json={
@@ -64,242 +1083,467 @@ class MedicalSearchSystem:
                 },
                 timeout=30
             )
+            span.set(http_status=response.status_code, bytes=len(response.content))
             
             if response.status_code == 200:
                 terms = response.json()['choices'][0]['text'].strip()
-                return [term.strip() for term in terms.split(',') if term.strip()]
+                terms = [term.strip() for term in terms.split(',') if term.strip()]
+                if terms:
+                    self.term_cache.set(key, terms)
+                    return terms, 'llm'
         except Exception as e:
             print(f"Error extracting medical terms: {str(e)}")
+            span.set(llm_error=str(e))
         
-        # Fallback to simple keyword extraction if LLM fails
-        return list(set(re.findall(r'\b[a-z]+\b', query.lower())))
+        # Fallback to simple keyword extraction if LLM fails (not cached, so the LLM is retried next time)
+        self._count_term_stat('llm_failures')
+        return list(set(re.findall(r'\b[a-z]+\b', query.lower()))), 'fallback'
 
-    def _search_pubmed(self, terms: List[str]) -> List[Dict[str, Any]]:
+    def prefetch_medical_terms(self, queries: List[str], batch_size: int = 20) -> int:
         """
-        Search PubMed for relevant articles
+        Warm the term cache for many queries with one LLM call per batch_size queries. Queries the
+        cache or lexicon already answer are skipped; any the batched answer misses go through the
+        single-query path later. Returns how many queries were answered.
         """
-        base_url = "https://pubmed.ncbi.nlm.nih.gov/"
-        results = []
-        
-        for term in terms[:3]:  # Limit to top 3 terms
-            try:
-                search_url = f"{base_url}?term={term.replace(' ', '+')}"
-                response = requests.get(search_url, timeout=10)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                articles = soup.find_all('article', class_='full-docsum')[:5]  # Limit to 5 results
-                
-                for article in articles:
-                    try:
-                        title = article.find('a', class_='docsum-title').text.strip()
-                        abstract_url = urljoin(base_url, article.find('a', class_='docsum-title')['href'])
-                        
-                        # Fetch abstract
-                        abstract_response = requests.get(abstract_url, timeout=10)
-                        abstract_soup = BeautifulSoup(abstract_response.text, 'html.parser')
-                        abstract = abstract_soup.find('div', class_='abstract-content').text.strip() if abstract_soup.find('div', class_='abstract-content') else ""
-                        
-                        results.append({
-                            'source': 'PubMed',
-                            'title': title,
-                            'content': abstract,
-                            'url': abstract_url
-                        })
-                    except Exception as e:
-                        print(f"Error processing PubMed article: {str(e)}")
-                        continue
-            except Exception as e:
-                print(f"Error searching PubMed for {term}: {str(e)}")
+        pending = {}
+        for query in queries:
+            key = normalize_query(query)
+            if key in pending or self.term_cache.get(key)[0] is not None:
                 continue
+            terms, confidence = self.lexicon.extract(query)
+            if not terms or confidence < self.lexicon_confidence:
+                pending[key] = query
+        
+        answered = 0
+        pending = list(pending.items())
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            numbered = "\n".join(f"{i + 1}: {query}" for i, (_, query) in enumerate(chunk))
+            prompt = f"""
+        Extract the key medical terms from each numbered query that would be useful for searching medical literature.
+        Answer with one line per query in the form "<number>: term, term, term", no additional text.
+        
+        Queries:
+        {numbered}
+        """
+            
+            self._count_term_stat('llm_calls')
+            with self.tracer.span('terms.batch', queries=len(chunk)) as span:
+                try:
+                    response = self.session.post(
+                        f"{self.base_url}completions",
+                        headers=self.headers,
+                        json={
+                            "model": self.llm_model,
+                            "prompt": prompt,
+                            "max_tokens": 50 * len(chunk),
+                            "temperature": 0.3
+                        },
+                        timeout=60
+                    )
+                    span.set(http_status=response.status_code, bytes=len(response.content))
+                    response.raise_for_status()
+                    text = response.json()['choices'][0]['text']
+                except Exception as e:
+                    print(f"Error extracting medical terms for a batch: {str(e)}")
+                    self._count_term_stat('llm_failures')
+                    continue
                 
-        return results
+                for match in re.finditer(r'^\s*(\d+)\s*[:.)]\s*(.+)$', text, re.MULTILINE):
+                    i = int(match.group(1)) - 1
+                    terms = [term.strip() for term in match.group(2).split(',') if term.strip()]
+                    if 0 <= i < len(chunk) and terms:
+                        self.term_cache.set(chunk[i][0], terms)
+                        answered += 1
+                span.set(answered=answered)
+        return answered
+
+    def _count_term_stat(self, name: str):
+        with self._stats_lock:
+            self.term_stats[name] += 1
+
+    def term_extraction_stats(self) -> Dict[str, Any]:
+        """
+        Term extraction counters and the share of queries answered without an LLM call
+        """
+        # Copy under the lock so the rate is computed from one consistent snapshot
+        with self._stats_lock:
+            stats = dict(self.term_stats)
+        queries = stats['queries']
+        return {
+            **stats,
+            'llm_avoided_rate': (queries - stats['llm_calls']) / queries if queries else 0.0
+        }
+
+    def _fetch(self, url: str, timeout: int, stage: str) -> requests.Response:
+        """
+        GET a source page inside a span recording the URL, HTTP status and bytes received
+        """
+        with self.tracer.span(stage, url=url) as span:
+            memo = _page_memo.get()
+            if memo is not None:
+                response, shared = memo.fetch(url, self._get, url, timeout, stage)
+                span.set(cache_hit=shared)
+            else:
+                response = self._get(url, timeout, stage)
+            span.set(http_status=response.status_code, bytes=len(response.content))
+            return response
+
+    def _get(self, url: str, timeout: int, stage: str) -> requests.Response:
+        start = time.perf_counter()
+        response = self.session.get(url, timeout=timeout)
+        self.planner.observe_fetch(stage, time.perf_counter() - start)
+        return response
+
+    def _search_pubmed(self, terms: List[str], max_terms: int = 3, per_term: int = 5) -> List[SearchResult]:
+        """
+        Search PubMed for relevant articles
+        """
+        with self.tracer.span('search.pubmed', terms=len(terms), max_terms=max_terms, per_term=per_term) as span:
+            base_url = self.source_urls['pubmed']
+            results = []
+            seen_urls = set()
+            
+            for term_index, term in enumerate(terms[:max_terms]):
+                try:
+                    search_url = f"{base_url}?term={term.replace(' ', '+')}"
+                    response = self._fetch(search_url, 10, 'fetch.pubmed_search')
+                    response.raise_for_status()
+                    
+                    for title, abstract_url in self._parse_pubmed_search(response.text, base_url, limit=per_term):
+                        if abstract_url in seen_urls:  # Already fetched for an earlier term
+                            continue
+                        seen_urls.add(abstract_url)
+                        try:
+                            # Fetch abstract
+                            abstract_response = self._fetch(abstract_url, 10, 'fetch.pubmed_article')
+                            abstract = self._parse_pubmed_abstract(abstract_response.text)
+                            
+                            results.append(SearchResult('PubMed', title, abstract, abstract_url, term_index))
+                        except Exception as e:
+                            print(f"Error processing PubMed article: {str(e)}")
+                            continue
+                except Exception as e:
+                    print(f"Error searching PubMed for {term}: {str(e)}")
+                    continue
+                    
+            span.set(results=len(results))
+            return results
 
-    def _search_clinical_trials(self, terms: List[str]) -> List[Dict[str, Any]]:
+    def _parse_pubmed_search(self, html: str, base_url: str, limit: int = 5) -> List[tuple]:
+        """
+        Extract (title, abstract URL) pairs from a PubMed search results page
+        """
+        page = HTMLPage(html, self.html_backend)
+        links = []
+        for article in page.select('article.full-docsum', limit=limit):
+            link = page.select_one('a.docsum-title', article)
+            if link is not None:
+                links.append((page.text(link), urljoin(base_url, page.attr(link, 'href') or '')))
+        return links
+
+    def _parse_pubmed_abstract(self, html: str) -> str:
+        """
+        Extract the abstract text from a PubMed article page
+        """
+        page = HTMLPage(html, self.html_backend)
+        return page.text(page.select_one('div.abstract-content'))
+
+    def _search_clinical_trials(self, terms: List[str], max_terms: int = 2, per_term: int = 3) -> List[SearchResult]:
         """
         Search ClinicalTrials.gov for relevant studies
         """
-        base_url = "https://clinicaltrials.gov/"
-        results = []
-        
-        for term in terms[:2]:  # Limit to top 2 terms
-            try:
-                search_url = f"{base_url}ct2/results?cond={term.replace(' ', '+')}"
-                response = requests.get(search_url, timeout=15)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                studies = soup.find_all('div', class_='study-info')[:3]  # Limit to 3 results
-                
-                for study in studies:
-                    try:
-                        title = study.find('a', class_='study-link').text.strip()
-                        study_url = urljoin(base_url, study.find('a', class_='study-link')['href'])
-                        
-                        # Fetch study details
-                        study_response = requests.get(study_url, timeout=15)
-                        study_soup = BeautifulSoup(study_response.text, 'html.parser')
-                        
-                        conditions = study_soup.find('div', id='conditions').text.strip() if study_soup.find('div', id='conditions') else ""
-                        criteria = study_soup.find('div', id='eligibility').text.strip() if study_soup.find('div', id='eligibility') else ""
-                        interventions = study_soup.find('div', id='interventions').text.strip() if study_soup.find('div', id='interventions') else ""
-                        
-                        content = f"Conditions: {conditions}\nEligibility: {criteria}\nInterventions: {interventions}"
-                        
-                        results.append({
-                            'source': 'ClinicalTrials.gov',
-                            'title': title,
-                            'content': content,
-                            'url': study_url
-                        })
-                    except Exception as e:
-                        print(f"Error processing clinical trial: {str(e)}")
-                        continue
-            except Exception as e:
-                print(f"Error searching ClinicalTrials.gov for {term}: {str(e)}")
-                continue
-                
-        return results
+        with self.tracer.span('search.clinical_trials', terms=len(terms), max_terms=max_terms, per_term=per_term) as span:
+            base_url = self.source_urls['clinical_trials']
+            results = []
+            seen_urls = set()
+            
+            for term_index, term in enumerate(terms[:max_terms]):
+                try:
+                    search_url = f"{base_url}ct2/results?cond={term.replace(' ', '+')}"
+                    response = self._fetch(search_url, 15, 'fetch.clinical_trials_search')
+                    response.raise_for_status()
+                    
+                    for title, study_url in self._parse_clinical_trials_search(response.text, base_url, limit=per_term):
+                        if study_url in seen_urls:  # Already fetched for an earlier term
+                            continue
+                        seen_urls.add(study_url)
+                        try:
+                            # Fetch study details
+                            study_response = self._fetch(study_url, 15, 'fetch.clinical_trial')
+                            content = self._parse_clinical_trial(study_response.text)
+                            
+                            results.append(SearchResult('ClinicalTrials.gov', title, content, study_url, term_index))
+                        except Exception as e:
+                            print(f"Error processing clinical trial: {str(e)}")
+                            continue
+                except Exception as e:
+                    print(f"Error searching ClinicalTrials.gov for {term}: {str(e)}")
+                    continue
+                    
+            span.set(results=len(results))
+            return results
+
+    def _parse_clinical_trials_search(self, html: str, base_url: str, limit: int = 3) -> List[tuple]:
+        """
+        Extract (title, study URL) pairs from a ClinicalTrials.gov results page
+        """
+        page = HTMLPage(html, self.html_backend)
+        links = []
+        for study in page.select('div.study-info', limit=limit):
+            link = page.select_one('a.study-link', study)
+            if link is not None:
+                links.append((page.text(link), urljoin(base_url, page.attr(link, 'href') or '')))
+        return links
+
+    def _parse_clinical_trial(self, html: str) -> str:
+        """
+        Extract conditions, eligibility and interventions from a study page
+        """
+        page = HTMLPage(html, self.html_backend)
+        conditions = page.text(page.select_one('div#conditions'))
+        criteria = page.text(page.select_one('div#eligibility'))
+        interventions = page.text(page.select_one('div#interventions'))
+        return f"Conditions: {conditions}\nEligibility: {criteria}\nInterventions: {interventions}"
 
-    def _search_cdc(self, terms: List[str]) -> List[Dict[str, Any]]:
+    def _search_cdc(self, terms: List[str], max_terms: int = 1, per_term: int = 2) -> List[SearchResult]:
         """
         Search CDC health topics
         """
-        base_url = "https://www.cdc.gov/"
-        results = []
-        
-        for term in terms[:1]:  # Limit to top term
-            try:
-                search_url = f"{base_url}search/index.html?query={term.replace(' ', '+')}"
-                response = requests.get(search_url, timeout=10)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                # Find top 2 results
-                items = soup.select('.search-results .item')[:2]
-                
-                for item in items:
-                    try:
-                        title = item.find('h3').text.strip()
-                        page_url = urljoin(base_url, item.find('a')['href'])
-                        
-                        # Fetch page content
-                        page_response = requests.get(page_url, timeout=10)
-                        page_soup = BeautifulSoup(page_response.text, 'html.parser')
-                        
-                        # Extract main content
-                        main_content = (page_soup.find('main') or 
-                                       page_soup.find('div', id='content') or 
-                                       page_soup.find('article'))
-                        
-                        if not main_content:
-                            continue
+        with self.tracer.span('search.cdc', terms=len(terms), max_terms=max_terms, per_term=per_term) as span:
+            base_url = self.source_urls['cdc']
+            results = []
+            
+            for term_index, term in enumerate(terms[:max_terms]):
+                try:
+                    search_url = f"{base_url}search/index.html?query={term.replace(' ', '+')}"
+                    response = self._fetch(search_url, 10, 'fetch.cdc_search')
+                    response.raise_for_status()
+                    
+                    for title, page_url in self._parse_cdc_search(response.text, base_url, limit=per_term):
+                        try:
+                            # Fetch page content
+                            page_response = self._fetch(page_url, 10, 'fetch.cdc_page')
+                            content = self._parse_cdc_page(page_response.text)
                             
-                        # Remove unwanted elements
-                        for element in main_content.find_all(['nav', 'footer', 'aside', 'script', 'style']):
-                            element.decompose()
+                            if content is None:
+                                continue
                             
-                        # Extract meaningful content
-                        content_parts = []
-                        for p in main_content.find_all(['p', 'h1', 'h2', 'h3']):
-                            if p.text.strip():
-                                content_parts.append(p.text.strip())
-                        
-                        content = ' '.join(content_parts[:500])  # Limit content length
-                        
-                        results.append({
-                            'source': 'CDC',
-                            'title': title,
-                            'content': content,
-                            'url': page_url
-                        })
-                    except Exception as e:
-                        print(f"Error processing CDC page: {str(e)}")
-                        continue
-            except Exception as e:
-                print(f"Error searching CDC for {term}: {str(e)}")
-                continue
-                
-        return results
+                            results.append(SearchResult('CDC', title, content, page_url, term_index))
+                        except Exception as e:
+                            print(f"Error processing CDC page: {str(e)}")
+                            continue
+                except Exception as e:
+                    print(f"Error searching CDC for {term}: {str(e)}")
+                    continue
+                    
+            span.set(results=len(results))
+            return results
 
-    def create_embeddings(self, texts: List[str]) -> List[List[float]]:
+    def _parse_cdc_search(self, html: str, base_url: str, limit: int = 2) -> List[tuple]:
         """
-        Create embeddings using Nebius AI Studio API
+        Extract (title, page URL) pairs from a CDC search results page
         """
-        embeddings = []
+        page = HTMLPage(html, self.html_backend)
+        links = []
+        for item in page.select('.search-results .item', limit=limit):
+            heading = page.select_one('h3', item)
+            link = page.select_one('a', item)
+            if heading is not None and link is not None:
+                links.append((page.text(heading), urljoin(base_url, page.attr(link, 'href') or '')))
+        return links
+
+    def _parse_cdc_page(self, html: str) -> Optional[str]:
+        """
+        Extract the main text of a CDC page, or None if it has no main content
+        """
+        page = HTMLPage(html, self.html_backend)
+        for selector in ('main', 'div#content', 'article'):
+            main_content = page.select_one(selector)
+            if main_content is not None:
+                break
+        else:
+            return None
         
-        for text in texts:
-            try:
-                if not text.strip():
-                    embeddings.append(None)
-                    continue
+        # Collect headings and paragraphs in one selector pass, skipping navigation chrome, then keep
+        # blocks up to the content token budget without boilerplate or repeated blocks
+        content_parts = page.block_texts('p, h1, h2, h3', main_content, exclude=('nav', 'footer', 'aside'))
+        return ' '.join(budget_blocks(content_parts, self.normalizer.max_tokens))
+
+    def create_embeddings(self, texts: List[str], batch_size: int = 64) -> List[List[float]]:
+        """
+        Create embeddings using Nebius AI Studio API, sending up to batch_size texts per request
+        """
+        embeddings = [None] * len(texts)
+        pending = [i for i, text in enumerate(texts) if text.strip()]
+        
+        with self.tracer.span('embed', texts=len(texts)) as span:
+            for start in range(0, len(pending), batch_size):
+                chunk = pending[start:start + batch_size]
+                try:
+                    response = self.session.post(
+                        f"{self.base_url}embeddings",
+                        headers=self.headers,
+                        json={
+                            "model": self.embedding_model,
+                            "input": [texts[i] for i in chunk],
+                            "encoding_format": "float"
+                        },
+                        timeout=30
+                    )
+                    span.add('api_calls')
+                    span.add('bytes', len(response.content))
+                    span.set(http_status=response.status_code)
                     
-                response = requests.post(
-                    f"{self.base_url}embeddings",
-                    headers=self.headers,
-                    json={
-                        "model": self.embedding_model,
-                        "input": text,
-                        "encoding_format": "float"
-                    },
-                    timeout=30
-                )
-                
-                if response.status_code == 200:
-                    embedding_data = response.json()
-                    embeddings.append(embedding_data['data'][0]['embedding'])
-                else:
-                    print(f"Error creating embedding: {response.status_code} - {response.text}")
-                    embeddings.append(None)
-            except Exception as e:
-                print(f"Exception creating embedding: {str(e)}")
-                embeddings.append(None)
-                
+                    if response.status_code == 200:
+                        for item in response.json()['data']:
+                            embeddings[chunk[item['index']]] = item['embedding']
+                    else:
+                        print(f"Error creating embedding: {response.status_code} - {response.text}")
+                        span.add('failures')
+                except Exception as e:
+                    print(f"Exception creating embedding: {str(e)}")
+                    span.add('failures')
+                    
+        return embeddings
+
+    def _cached_embeddings(self, results: List[SearchResult], texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        Embed result texts, only calling the API for documents not already in the cache
+        """
+        with self.tracer.span('embed.cache', documents=len(results)) as span:
+            keys = [self.embedding_cache.make_key(r.get('url', ''), text) for r, text in zip(results, texts)]
+            embeddings = self.embedding_cache.get_many(keys)
+
+            missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+            span.set(cache_hits=len(results) - len(missing), cache_misses=len(missing))
+            if missing:
+                fresh = self.create_embeddings([texts[i] for i in missing])
+                self.embedding_cache.put_many([keys[i] for i in missing], fresh)
+                for i, embedding in zip(missing, fresh):
+                    embeddings[i] = embedding
+
+        print(f"Embedding cache: {len(results) - len(missing)} hits, {len(missing)} misses")
         return embeddings
 
-    def rank_results(self, query: str, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def _ranking_text(self, result: SearchResult) -> str:
         """
-        Rank results by relevance to query using embeddings
+        Text that represents a result for embedding
+        """
+        return truncate_tokens(f"{result['title']}. {result['content']}", self.embed_max_tokens)
+
+    def _embed_query(self, query: str) -> Optional[List[float]]:
+        """
+        Embed a query once per session so the local lookup and ranking share the call
+        """
+        with self._query_lock:
+            embedding = self._query_embeddings.get(query)
+            if embedding is not None:
+                self._query_embeddings.move_to_end(query)
+        span = current_span()
+        if span is not None:
+            span.set(query_embedding_cached=embedding is not None)
+        if embedding is None:
+            embedding = self.create_embeddings([query])[0]
+            if embedding is not None:
+                self._remember_query_embeddings([(query, embedding)])
+        return embedding
+
+    def _remember_query_embeddings(self, embeddings: List[tuple]):
+        with self._query_lock:
+            for query, embedding in embeddings:
+                self._query_embeddings[query] = embedding
+                self._query_embeddings.move_to_end(query)
+            while len(self._query_embeddings) > self.query_cache_size:
+                self._query_embeddings.popitem(last=False)
+
+    def embed_queries(self, queries: List[str]):
+        """
+        Embed queries not embedded yet in one pass, for batch runs. Only the first query_cache_size
+        are embedded; the memo could not hold more, and later queries are embedded as they run.
+        """
+        with self._query_lock:
+            missing = list(dict.fromkeys(q for q in queries if q not in self._query_embeddings))
+        missing = missing[:self.query_cache_size]
+        self._remember_query_embeddings([(query, embedding) for query, embedding
+                                         in zip(missing, self.create_embeddings(missing)) if embedding is not None])
+
+    def _bm25_stage(self, query: str, results: List[SearchResult]) -> tuple:
+        """
+        Cheap lexical first stage: result indices in BM25 order (unmatched results last) and their scores
+        """
+        index = BM25Index()
+        for i, result in enumerate(results):
+            index.add(i, f"{result['title']} {result['content']}")
+        scores = dict(index.search(query))
+        order = sorted(scores, key=scores.get, reverse=True)
+        order += [i for i in range(len(results)) if i not in scores]
+        return order, scores
+
+    def rank_results(self, query: str, results: List[SearchResult]) -> List[SearchResult]:
+        """
+        Rank results by relevance to query: BM25 first stage, dense re-scoring of the
+        top candidates, then reciprocal-rank fusion of the two rankings
         """
         if not results:
             return []
-            
-        # Create embeddings for query and all results
-        query_embedding = self.create_embeddings([query])[0]
-        if not query_embedding:
-            return results
-            
-        result_texts = [f"{r['title']}. {r['content'][:500]}" for r in results]
-        result_embeddings = self.create_embeddings(result_texts)
         
-        # Calculate similarities
-        ranked_results = []
+        with self.tracer.span('rank', results=len(results)) as span:
+            ranked_results = self._rank(query, results)
+            span.set(dense_scored=sum(1 for r in ranked_results if 'similarity_score' in r))
+        
+        # Freshly fetched documents that reached the top feed the fan-out planner
+        self.planner.record_ranking(ranked_results[:self.yield_top_k])
+        return ranked_results
+
+    def _rank(self, query: str, results: List[SearchResult]) -> List[SearchResult]:
+        for result in results:
+            result.bm25_score = result.similarity_score = result.fusion_score = None
+        bm25_order, bm25_scores = self._bm25_stage(query, results)
         for i, result in enumerate(results):
-            if result_embeddings[i] is None:
-                continue
-                
-            similarity = cosine_similarity(
-                np.array(query_embedding).reshape(1, -1),
-                np.array(result_embeddings[i]).reshape(1, -1)
-            )[0][0]
-            
-            ranked_results.append({
-                **result,
-                'similarity_score': similarity
-            })
+            result.bm25_score = bm25_scores.get(i, 0.0)
         
-        # Sort by similarity
-        ranked_results.sort(key=lambda x: x['similarity_score'], reverse=True)
-        return ranked_results
+        # Create embeddings for the query and only the top BM25 candidates
+        query_embedding = self._embed_query(query)
+        if not query_embedding:
+            return [results[i] for i in bm25_order]
+        
+        candidates = bm25_order[:self.rerank_top_k]
+        candidate_results = [results[i] for i in candidates]
+        candidate_texts = [self._ranking_text(r) for r in candidate_results]
+        candidate_embeddings = self._cached_embeddings(candidate_results, candidate_texts)
+        
+        # Cosine similarity of the query with every embedded candidate in one matrix product
+        scored = [i for i, embedding in zip(candidates, candidate_embeddings) if embedding is not None]
+        dense_order = []
+        if scored:
+            matrix = np.array([e for e in candidate_embeddings if e is not None], dtype=np.float64)
+            query_vector = np.asarray(query_embedding, dtype=np.float64)
+            norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vector)
+            norms[norms == 0] = 1.0
+            similarities = matrix @ query_vector / norms
+            for i, similarity in zip(scored, similarities.tolist()):
+                results[i].similarity_score = similarity
+            dense_order = [scored[j] for j in np.argsort(-similarities, kind='stable')]
+        
+        # Reciprocal-rank fusion; results without a BM25 match only score through the dense ranking
+        fusion_scores = np.zeros(len(results))
+        for ranking in ([i for i in bm25_order if i in bm25_scores], dense_order):
+            fusion_scores[np.array(ranking, dtype=np.intp)] += 1.0 / (self.rrf_k + np.arange(1, len(ranking) + 1))
+        for result, score in zip(results, fusion_scores.tolist()):
+            result.fusion_score = score
+        
+        # Rank by permuting indices; the result records themselves are not copied
+        return [results[i] for i in np.argsort(-fusion_scores, kind='stable')]
 
-    def generate_medical_analysis(self, query: str, results: List[Dict[str, Any]]) -> Dict[str, str]:
+    def _analysis_prompt(self, query: str, results: List[Dict[str, Any]]) -> str:
         """
-        Generate comprehensive medical analysis using LLM
+        Build the analysis prompt from the top search results
         """
         # Prepare context from search results
         context = "\n\n".join([f"Source: {r['source']}\nTitle: {r['title']}\nContent: {r['content'][:1000]}" for r in results[:5]])
         
-        prompt = f"""
+        return f"""
         Based on the following medical search results, provide a comprehensive analysis of:
         
         1. Potential causes for the patient's symptoms
@@ -337,9 +1581,57 @@ class MedicalSearchSystem:
         
         Use professional medical language but keep it clear and concise.
         """
+
+    def generate_medical_analysis(self, query: str, results: List[Dict[str, Any]],
+                                  on_section: Optional[Callable[[str, str], None]] = None,
+                                  cancel: Optional[threading.Event] = None) -> Dict[str, str]:
+        """
+        Generate comprehensive medical analysis using LLM.
+        With on_section, the completion is streamed and on_section(title, text_so_far)
+        is called as soon as each ### section is complete.
+        With cancel, the completion is also streamed and setting the event abandons it
+        at the next delta, closing the connection; the result then has status 'cancelled'.
+        """
+        streamed = on_section is not None or cancel is not None
+        with self.tracer.span('analysis', streamed=streamed, results=len(results)) as span:
+            analysis = self._generate_analysis(query, results, on_section, cancel)
+            span.set(status=analysis['status'], chars=len(analysis['analysis']))
+            return analysis
+
+    def _generate_analysis(self, query: str, results: List[Dict[str, Any]],
+                           on_section: Optional[Callable[[str, str], None]],
+                           cancel: Optional[threading.Event] = None) -> Dict[str, str]:
+        prompt = self._analysis_prompt(query, results)
+        
+        if on_section is not None or cancel is not None:
+            on_section = on_section or (lambda title, text: None)
+            parser = AnalysisSectionParser()
+            try:
+                for delta in self.stream_completion(prompt, max_tokens=2000, timeout=60, cancel=cancel):
+                    for title in parser.feed(delta):
+                        on_section(title, parser.completed_text)
+                if cancel is not None and cancel.is_set():
+                    return {
+                        'analysis': parser.text.strip(),
+                        'status': 'cancelled'
+                    }
+                for title in parser.close():
+                    on_section(title, parser.completed_text)
+                if parser.text.strip():
+                    return {
+                        'analysis': parser.text.strip(),
+                        'status': 'success'
+                    }
+            except Exception as e:
+                print(f"Error streaming medical analysis: {str(e)}")
+            
+            return {
+                'analysis': "Could not generate medical analysis due to technical issues.",
+                'status': 'error'
+            }
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}completions",
                 headers=self.headers,
                 json={
@@ -350,6 +1642,7 @@ class MedicalSearchSystem:
                 },
                 timeout=60
             )
+            current_span().set(http_status=response.status_code, bytes=len(response.content))
             
             if response.status_code == 200:
                 return {
@@ -364,18 +1657,80 @@ class MedicalSearchSystem:
             'status': 'error'
         }
 
-    def generate_report(self, query: str, results: List[Dict[str, Any]], filename: str = "medical_report.html") -> str:
+    def stream_completion(self, prompt: str, max_tokens: int, timeout: int = 60,
+                          cancel: Optional[threading.Event] = None) -> Iterator[str]:
+        """
+        Stream a completion from the Nebius API, yielding text deltas as server-sent events arrive.
+        Stops and closes the connection at the next event once cancel is set.
+        """
+        with self.session.post(
+            f"{self.base_url}completions",
+            headers=self.headers,
+            json={
+                "model": self.llm_model,
+                "prompt": prompt,
+                "max_tokens": max_tokens,
+                "temperature": 0.3,
+                "stream": True
+            },
+            timeout=timeout,
+            stream=True
+        ) as response:
+            span = current_span()
+            if span is not None:
+                span.set(http_status=response.status_code)
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if cancel is not None and cancel.is_set():
+                    if span is not None:
+                        span.set(cancelled=True)
+                    return
+                if not line or not line.startswith('data:'):
+                    continue
+                payload = line[5:].strip()
+                if payload == '[DONE]':
+                    break
+                choices = json.loads(payload).get('choices') or [{}]
+                delta = choices[0].get('text') or ''
+                if delta:
+                    yield delta
+
+    def generate_report(self, query: str, results: List[Dict[str, Any]], filename: str = "medical_report.html",
+                        llm_layout: bool = False, analysis: Optional[Dict[str, str]] = None) -> str:
         """
-        Generate professional HTML report with medical analysis
+        Generate professional HTML report with medical analysis.
+        The page is rendered locally from the precompiled template unless llm_layout is set.
         """
-        # Generate medical analysis
-        analysis = self.generate_medical_analysis(query, results)
+        # Generate medical analysis unless the caller already has one
+        if analysis is None:
+            analysis = self.generate_medical_analysis(query, results)
+        
+        if llm_layout:
+            html_content = self._generate_llm_html(query, results, analysis['analysis'])
+            if html_content:
+                # Save HTML file
+                with open(filename, 'w', encoding='utf-8') as f:
+                    f.write(html_content)
+                
+                print(f"HTML report generated: {filename}")
+                return filename
         
-        # Prepare data for LLM
+        return self._generate_elegant_html(query, results, analysis['analysis'], filename)
+
+    def _generate_llm_html(self, query: str, results: List[Dict[str, Any]], analysis: str) -> Optional[str]:
+        """
+        Ask the LLM to lay out the whole HTML page (slow; opt-in via generate_report(llm_layout=True))
+        """
+        # Only send what the page shows, not the full documents
         report_data = {
             "query": query,
-            "results": results,
-            "analysis": analysis['analysis'],
+            "results": [{
+                "source": r['source'],
+                "title": r['title'],
+                "url": r['url'],
+                "similarity_score": round(float(r.get('similarity_score', 0)), 3),
+                "snippet": r['content'][:300]
+            } for r in results],
             "date": datetime.now().strftime("%B %d, %Y %H:%M:%S")
         }
         
@@ -397,10 +1752,10 @@ class MedicalSearchSystem:
         7. Footer
         
         Medical Analysis Content:
-        {report_data['analysis']}
+        {analysis}
         
         Search Results Data:
-        {json.dumps({k: v for k, v in report_data.items() if k != 'analysis'})}
+        {json.dumps(report_data)}
         
         Include CSS styling for a professional, responsive design with:
         - Clean typography
@@ -413,56 +1768,43 @@ class MedicalSearchSystem:
         """
         
         try:
-            response = requests.post(
-                f"{self.base_url}completions",
-                headers=self.headers,
-                json={
-                    "model": self.llm_model,
-                    "prompt": prompt,
-                    "max_tokens": 4000,
-                    "temperature": 0.3
-                },
-                timeout=60
-            )
+            with self.tracer.span('render.llm') as span:
+                response = self.session.post(
+                    f"{self.base_url}completions",
+                    headers=self.headers,
+                    json={
+                        "model": self.llm_model,
+                        "prompt": prompt,
+                        "max_tokens": 4000,
+                        "temperature": 0.3
+                    },
+                    timeout=60
+                )
+                span.set(http_status=response.status_code, bytes=len(response.content))
             
             if response.status_code == 200:
-                html_content = response.json()['choices'][0]['text'].strip()
-                
-                # Save HTML file
-                with open(filename, 'w', encoding='utf-8') as f:
-                    f.write(html_content)
-                
-                print(f"HTML report generated: {filename}")
-                return filename
+                return response.json()['choices'][0]['text'].strip()
+            print(f"Error generating report: {response.status_code} - {response.text}")
         except Exception as e:
             print(f"Error generating report: {str(e)}")
-            return self._generate_elegant_html(query, results, analysis['analysis'], filename)
+        return None
 
-    def _generate_elegant_html(self, query: str, results: List[Dict[str, Any]], analysis: str, filename: str) -> str:
+    def _render_report_html(self, query: str, results: List[Dict[str, Any]], analysis: str,
+                            streaming: bool = False) -> str:
         """
-        Generate an extremely elegant HTML report with stunning design
+        Fill the precompiled report template with the query, analysis sections and result cards.
+        A streaming report reloads itself until the final version is written.
         """
+        with self.tracer.span('render', results=len(results), streaming=streaming) as span:
+            html_content = self._fill_report_template(query, results, analysis, streaming)
+            span.set(bytes=len(html_content.encode('utf-8')))
+            return html_content
+
+    def _fill_report_template(self, query: str, results: List[Dict[str, Any]], analysis: str,
+                              streaming: bool) -> str:
         current_date = datetime.now().strftime("%B %d, %Y %H:%M:%S")
         avg_similarity = sum(r.get('similarity_score', 0) for r in results) / len(results) if results else 0
         
-        # Professional color scheme (dark blue, slate, with teal accent)
-        colors = {
-            'primary': '#2c3e50',
-            'secondary': '#34495e',
-            'accent': '#1abc9c',
-            'light': '#f8f9fa',
-            'dark': '#2c3e50',
-            'text': '#333333',
-            'light_text': '#7f8c8d'
-        }
-        
-        # Generate source icons
-        source_icons = {
-            'PubMed': '🔬',
-            'ClinicalTrials.gov': '📊',
-            'CDC': '🏥'
-        }
-        
         # Parse analysis into sections
         analysis_sections = {}
         current_section = None
@@ -474,71 +1816,531 @@ class MedicalSearchSystem:
                 analysis_sections[current_section].append(line.strip())
         
         # Generate analysis cards
-        analysis_cards = ""
-        section_icons = {
-            'Potential Causes': '🩺',
-            'Diagnostic Approaches': '🔍',
-            'Treatment Options': '💊',
-            'Similar Cases': '👥',
-            'Clinical Recommendations': '⚠️'
-        }
+        analysis_cards = "".join(
+            ANALYSIS_CARD_TEMPLATE.substitute(
+                icon=SECTION_ICONS.get(section, '📌'),
+                section=html_escape(section),
+                bullet_points="".join([f"<li>{html_escape(point[2:] if point.startswith('- ') else point)}</li>" for point in content if point])
+            )
+            for section, content in analysis_sections.items()
+        )
+        
+        result_cards = "".join(
+            RESULT_CARD_TEMPLATE.substitute(
+                source_icon=SOURCE_ICONS.get(r['source'], '📄'),
+                source=html_escape(r['source']),
+                score=f"{r.get('similarity_score', 0):.2f}",
+                title=html_escape(r['title']),
+                content=html_escape(r['content'][:400]),
+                url=safe_href(r['url'])
+            )
+            for r in results
+        )
+        
+        return REPORT_TEMPLATE.substitute(
+            head_extra='\n            <meta http-equiv="refresh" content="2">' if streaming else '',
+            title_query=html_escape(query[:30]),
+            query=html_escape(query),
+            num_results=len(results),
+            avg_similarity=f"{avg_similarity:.2f}",
+            report_day=current_date.split()[0],
+            analysis_cards=analysis_cards,
+            result_cards=result_cards,
+            current_date=current_date
+        )
+
+    def _generate_elegant_html(self, query: str, results: List[Dict[str, Any]], analysis: str, filename: str) -> str:
+        """
+        Generate an extremely elegant HTML report with stunning design
+        """
+        self._write_report_html(query, results, analysis, filename)
+        print(f"Elegant HTML report generated: {filename}")
+        return filename
+
+    def _write_report_html(self, query: str, results: List[Dict[str, Any]], analysis: str, filename: str,
+                           streaming: bool = False):
+        """
+        Render and atomically replace the report file so a reloading browser never sees a partial page
+        """
+        html_content = self._render_report_html(query, results, analysis, streaming)
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            f.write(html_content)
+        os.replace(tmp_filename, filename)
+
+
+class SearchReportPipeline:
+    """
+    Staged search -> rank -> analysis -> report executor. The LLM analysis starts speculatively
+    on the BM25 top-k while dense re-ranking runs, and is restarted if the final top-k differs.
+    """
+    def __init__(self, system: MedicalSearchSystem, top_k: int = 5):
+        self.system = system
+        self.top_k = top_k
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="analysis")
+
+    def run(self, query: str, filename: str = "medical_report.html",
+            on_update: Optional[Callable[[str], None]] = None) -> Optional[str]:
+        """
+        Run the whole pipeline for one query and return the report filename, or None without results.
+        With on_update, the analysis is streamed: the report is rewritten as each section completes
+        and on_update(filename) is called after every write.
+        """
+        with self.system.tracer.span('query', query=query):
+            return self._run(query, filename, on_update)
+
+    def _run(self, query: str, filename: str, on_update: Optional[Callable[[str], None]]) -> Optional[str]:
+        # Step 1: Search for medical information
+        print("\nSearching for relevant medical information...")
+        results = self.system.search_medical_info(query)
+        
+        if not results:
+            print("No relevant medical information found")
+            return None
+        
+        # Step 2: Start the analysis on the lexical top-k, then rank by relevance in parallel
+        bm25_order, _ = self.system._bm25_stage(query, results)
+        speculative_top = [results[i] for i in bm25_order[:self.top_k]]
+        
+        # Sections streamed by a superseded analysis run must not overwrite the report
+        state = {'generation': 0, 'results': speculative_top}
+        lock = threading.Lock()
+        
+        def section_writer(generation: int) -> Optional[Callable[[str, str], None]]:
+            if on_update is None:
+                return None
+            def on_section(title: str, analysis_text: str):
+                with lock:
+                    if generation != state['generation']:
+                        return
+                    self.system._write_report_html(query, state['results'], analysis_text, filename, streaming=True)
+                on_update(filename)
+            return on_section
+        
+        # Run the analysis in a copy of this context so its spans nest under the query span.
+        # It is always streamed so a superseded run can be abandoned mid-response
+        cancel = threading.Event()
+        analysis_future = self.executor.submit(contextvars.copy_context().run, self.system.generate_medical_analysis,
+                                               query, speculative_top, section_writer(0), cancel)
+        
+        reused = False
+        try:
+            print("\nRanking results by relevance...")
+            ranked_results = self.system.rank_results(query, results)
+            final_top = ranked_results[:self.top_k]
+            with lock:
+                state['results'] = final_top
+            
+            # Step 3: Keep the speculative analysis only if it saw the same documents
+            if {r['url'] for r in final_top} == {r['url'] for r in speculative_top}:
+                analysis = analysis_future.result()
+                reused = True
+            else:
+                print("Top results changed after re-ranking; restarting analysis")
+                with lock:
+                    state['generation'] = 1
+                # Drop the speculative stream (or never start it) before the restart so it stops consuming tokens
+                cancel.set()
+                analysis_future.cancel()
+                analysis = self.system.generate_medical_analysis(query, final_top, section_writer(1))
+        finally:
+            # Any exit other than reusing the speculative result (including a failed ranking) abandons it
+            if not reused:
+                cancel.set()
+                analysis_future.cancel()
+        
+        print("\nGenerating report...")
+        return self.system.generate_report(query, final_top, filename, analysis=analysis)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls: callers arriving with a key that is already running wait for that
+    call and share its result instead of starting their own
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key: str, fn: Callable, *args, **kwargs):
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.in_flight[key] = future
+                self.calls += 1
+            else:
+                self.shared += 1
+        
+        if not leader:
+            return future.result()
+        
+        try:
+            result = fn(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+class PageMemo:
+    """
+    Shares source page fetches between the queries of a batch: each URL is fetched once and
+    concurrent requests for a URL in flight wait for it. Failed fetches are not kept.
+    """
+    def __init__(self):
+        self.pages = {}
+        self.lock = threading.Lock()
+        self.fetched = 0
+        self.shared = 0
+
+    def fetch(self, url: str, fn: Callable, *args) -> tuple:
+        """
+        (response, whether it came from an earlier or concurrent fetch of the same URL)
+        """
+        with self.lock:
+            future = self.pages.get(url)
+            shared = future is not None
+            if shared:
+                self.shared += 1
+            else:
+                future = Future()
+                self.pages[url] = future
+                self.fetched += 1
+        
+        if not shared:
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                with self.lock:
+                    self.pages.pop(url, None)
+                future.set_exception(e)
+        return future.result(), shared
+
+_page_memo = contextvars.ContextVar('medical_search_page_memo', default=None)
+
+class MedicalSearchService:
+    """
+    Long-running query service around one warm MedicalSearchSystem, so every request shares its
+    connection pool and document, embedding and term caches. Identical in-flight queries are coalesced.
+    """
+    def __init__(self, system: MedicalSearchSystem, top_k: int = 5):
+        self.system = system
+        self.top_k = top_k
+        self.searches = SingleFlight()
+        self.answers = SingleFlight()
+
+    def search(self, query: str) -> List[Dict[str, Any]]:
+        """
+        Search and rank, sharing one upstream fetch between identical concurrent queries
+        """
+        return self.searches.do(normalize_query(query), self._search_and_rank, query)
+
+    def _search_and_rank(self, query: str) -> List[Dict[str, Any]]:
+        with self.system.tracer.span('service.search', query=query):
+            results = self.system.search_medical_info(query)
+            return self.system.rank_results(query, results) if results else []
+
+    def answer(self, query: str) -> Dict[str, Any]:
+        """
+        Top results plus the LLM analysis for a query
+        """
+        return self.answers.do(normalize_query(query), self._answer, query)
+
+    def _answer(self, query: str) -> Dict[str, Any]:
+        with self.system.tracer.span('service.answer', query=query):
+            results = self.search(query)[:self.top_k]
+            if not results:
+                return {'query': query, 'results': [], 'analysis': "", 'status': 'no_results'}
+            analysis = self.system.generate_medical_analysis(query, results)
+        return {'query': query, 'results': [r.to_dict() for r in results], 'analysis': analysis['analysis'],
+                'status': analysis['status']}
+
+    def stream(self, query: str) -> Iterator[tuple]:
+        """
+        Yield (event, data) pairs: the ranked results first, then each analysis section as it completes
+        """
+        results = self.search(query)[:self.top_k]
+        yield 'results', [r.to_dict() for r in results]
+        if not results:
+            yield 'done', {'status': 'no_results'}
+            return
         
-        for section, content in analysis_sections.items():
-            icon = section_icons.get(section, '📌')
-            bullet_points = "".join([f"<li>{point[2:] if point.startswith('- ') else point}</li>" for point in content if point])
-            analysis_cards += f"""
+        parser = AnalysisSectionParser()
+        try:
+            prompt = self.system._analysis_prompt(query, results)
+            for delta in self.system.stream_completion(prompt, max_tokens=2000):
+                for title in parser.feed(delta):
+                    yield 'section', {'title': title, 'analysis': parser.completed_text}
+            for title in parser.close():
+                yield 'section', {'title': title, 'analysis': parser.completed_text}
+            yield 'done', {'status': 'success'}
+        except Exception as e:
+            yield 'error', {'message': str(e)}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'term_extraction': self.system.term_extraction_stats(),
+            'corpus_documents': len(self.system.corpus.documents),
+            'cached_embeddings': len(self.system.embedding_cache.ids),
+            'searches': {'upstream': self.searches.calls, 'coalesced': self.searches.shared},
+            'answers': {'computed': self.answers.calls, 'coalesced': self.answers.shared},
+            'stages': self.system.tracer.summary(),
+            'fanout': self.system.planner.stats()
+        }
+
+class BatchRunner:
+    """
+    Runs many queries as one job: term extraction is batched into a few LLM calls, each source page
+    is fetched once however many queries share its term or document, every document is embedded in
+    one pass, and analyses and reports are produced in parallel
+    """
+    def __init__(self, system: MedicalSearchSystem, top_k: int = 5, max_workers: int = 8):
+        self.system = system
+        self.top_k = top_k
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="batch")
+        self.stats = {}
+
+    def _map(self, fn: Callable, *iterables) -> list:
+        # Each task gets its own copy of this context, so spans and the page memo carry over
+        futures = [self.executor.submit(contextvars.copy_context().run, fn, *args) for args in zip(*iterables)]
+        return [future.result() for future in futures]
+
+    def run(self, queries: List[str], output_dir: str = "reports") -> List[Dict[str, Any]]:
+        """
+        Search, rank, analyse and write a report for every query; returns one summary per query
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        with self.system.tracer.span('batch', queries=len(queries)) as span:
+            batched_terms = self.system.prefetch_medical_terms(queries)
+            self.system.embed_queries(queries)
+            
+            memo = PageMemo()
+            token = _page_memo.set(memo)
+            try:
+                searches = self._map(self.system.search_medical_info, queries)
+            finally:
+                _page_memo.reset(token)
+            
+            # Embed every unique document in one pass so ranking below only reads the cache
+            documents = list({r['url']: r for results in searches for r in results}.values())
+            self.system._cached_embeddings(documents, [self.system._ranking_text(r) for r in documents])
+            
+            reports = self._map(self._report, range(len(queries)), queries, searches, [output_dir] * len(queries))
+            
+            self.stats = {
+                'queries': len(queries),
+                'terms_from_batched_llm': batched_terms,
+                'pages_fetched': memo.fetched,
+                'pages_shared': memo.shared,
+                'unique_documents': len(documents),
+                'reports': sum(1 for r in reports if r['report'])
+            }
+            span.set(**self.stats)
+        return reports
+
+    def _report(self, index: int, query: str, results: List[Dict[str, Any]], output_dir: str) -> Dict[str, Any]:
+        if not results:
+            return {'query': query, 'report': None, 'results': 0, 'status': 'no_results'}
+        ranked_results = self.system.rank_results(query, results)[:self.top_k]
+        analysis = self.system.generate_medical_analysis(query, ranked_results)
+        slug = '_'.join(normalize_query(query).split()[:6]) or "query"
+        filename = os.path.join(output_dir, f"report_{index + 1:03d}_{slug}.html")
+        self.system._write_report_html(query, ranked_results, analysis['analysis'], filename)
+        return {'query': query, 'report': filename, 'results': len(ranked_results), 'status': analysis['status']}
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+def run_batch(api_key: str, path: str, output_dir: str = "reports", workers: int = 8):
+    """
+    Write a report for every query in a file (one query per line; blank lines and # comments are skipped)
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        queries = [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    
+    runner = BatchRunner(MedicalSearchSystem(api_key), max_workers=workers)
+    start = time.perf_counter()
+    reports = runner.run(queries, output_dir)
+    runner.close()
+    
+    for report in reports:
+        print(f"[{report['status']}] {report['query']} -> {report['report'] or 'no report'}")
+    print(f"\n{runner.stats['queries']} queries in {time.perf_counter() - start:.1f}s: "
+          f"{runner.stats['pages_fetched']} pages fetched ({runner.stats['pages_shared']} shared), "
+          f"{runner.stats['unique_documents']} unique documents, {runner.stats['reports']} reports in {output_dir}")
+
+def create_app(service: MedicalSearchService):
+    """
+    Flask app exposing the service: /search (JSON), /report (HTML), /stream (server-sent events), /stats
+    """
+    if Flask is None:
+        raise ImportError("Server mode requires Flask: pip install flask")
+    
+    app = Flask(__name__)
+    
+    def query_param():
+        query = request.args.get('q', '').strip()
+        if not query:
+            abort(400, description="Missing query parameter 'q'")
+        return query
+    
+    @app.route('/search')
+    def search():
+        return jsonify(service.answer(query_param()))
+    
+    @app.route('/report')
+    def report():
+        answer = service.answer(query_param())
+        return Response(service.system._render_report_html(answer['query'], answer['results'], answer['analysis']),
+                        mimetype='text/html')
+    
+    @app.route('/stream')
+    def stream():
+        query = query_param()
+        def events():
+            for event, data in service.stream(query):
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        return Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+    
+    @app.route('/stats')
+    def stats():
+        return jsonify(service.stats())
+    
+    return app
+
+def serve(api_key: str, host: str = "127.0.0.1", port: int = 5000):
+    """
+    Run the search service with one shared MedicalSearchSystem
+    """
+    service = MedicalSearchService(MedicalSearchSystem(api_key))
+    app = create_app(service)
+    print(f"Medical Search service listening on http://{host}:{port}")
+    app.run(host=host, port=port, threaded=True)
+
+
+# Professional color scheme (dark blue, slate, with teal accent)
+REPORT_COLORS = {
+    'color_primary': '#2c3e50',
+    'color_secondary': '#34495e',
+    'color_accent': '#1abc9c',
+    'color_light': '#f8f9fa',
+    'color_dark': '#2c3e50',
+    'color_text': '#333333',
+    'color_light_text': '#7f8c8d'
+}
+
+def safe_href(url: str) -> str:
+    """
+    Attribute-escaped link target; anything but http(s) becomes '#'
+    """
+    if urlsplit(url or '').scheme.lower() not in ('http', 'https'):
+        return '#'
+    return html_escape(url, quote=True)
+
+SOURCE_ICONS = {
+    'PubMed': '🔬',
+    'ClinicalTrials.gov': '📊',
+    'CDC': '🏥'
+}
+
+SECTION_ICONS = {
+    'Potential Causes': '🩺',
+    'Diagnostic Approaches': '🔍',
+    'Treatment Options': '💊',
+    'Similar Cases': '👥',
+    'Clinical Recommendations': '⚠️'
+}
+
+ANALYSIS_CARD_TEMPLATE = Template("""
             <div class="analysis-card">
                 <div class="analysis-card-header">
-                    <span class="analysis-card-icon">{icon}</span>
-                    <h3>{section}</h3>
+                    <span class="analysis-card-icon">$icon</span>
+                    <h3>$section</h3>
                 </div>
                 <div class="analysis-card-content">
-                    <ul>{bullet_points}</ul>
+                    <ul>$bullet_points</ul>
                 </div>
             </div>
-            """
-        
-        html_content = f"""
+            """)
+
+RESULT_CARD_TEMPLATE = Template("""
+                    <article class="result-card">
+                        <div class="result-header">
+                            <div class="result-source">
+                                $source_icon $source
+                            </div>
+                            <div class="result-score">Relevance: $score</div>
+                        </div>
+                        <div class="result-body">
+                            <h3 class="result-title">$title</h3>
+                            <div class="result-content">
+                                $content...
+                            </div>
+                            <a href="$url" class="result-link" target="_blank">
+                                <svg width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round">
+                                    <path d="M18 13v6a2 2 0 0 1-2 2H5a2 2 0 0 1-2-2V8a2 2 0 0 1 2-2h6"></path>
+                                    <polyline points="15 3 21 3 21 9"></polyline>
+                                    <line x1="10" y1="14" x2="21" y2="3"></line>
+                                </svg>
+                                View Full Content
+                            </a>
+                        </div>
+                    </article>
+                    """)
+
+# Compiled once at import with the color scheme baked in; only per-report fields are substituted later
+REPORT_TEMPLATE = Template(Template("""
         <!DOCTYPE html>
         <html lang="en">
         <head>
             <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Medical Search Report | {query[:30]}...</title>
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">$head_extra
+            <title>Medical Search Report | $title_query...</title>
             <link href="https://fonts.googleapis.com/css2?family=Roboto:wght@300;400;500;700&family=Merriweather:wght@400;700&display=swap" rel="stylesheet">
             <style>
-                :root {{
-                    --primary: {colors['primary']};
-                    --secondary: {colors['secondary']};
-                    --accent: {colors['accent']};
-                    --light: {colors['light']};
-                    --dark: {colors['dark']};
-                    --text: {colors['text']};
-                    --light-text: {colors['light_text']};
-                }}
-                
-                * {{
+                :root {
+                    --primary: $color_primary;
+                    --secondary: $color_secondary;
+                    --accent: $color_accent;
+                    --light: $color_light;
+                    --dark: $color_dark;
+                    --text: $color_text;
+                    --light-text: $color_light_text;
+                }
+                
+                * {
                     margin: 0;
                     padding: 0;
                     box-sizing: border-box;
-                }}
+                }
                 
-                body {{
+                body {
                     font-family: 'Roboto', sans-serif;
                     line-height: 1.6;
                     color: var(--text);
                     background-color: #ffffff;
                     padding: 0;
                     margin: 0;
-                }}
+                }
                 
-                .container {{
+                .container {
                     max-width: 1200px;
                     margin: 0 auto;
                     padding: 2rem;
-                }}
+                }
                 
-                header {{
+                header {
                     background: linear-gradient(135deg, var(--primary), var(--secondary));
                     color: white;
                     padding: 4rem 2rem;
@@ -546,9 +2348,9 @@ class MedicalSearchSystem:
                     margin-bottom: 3rem;
                     position: relative;
                     overflow: hidden;
-                }}
+                }
                 
-                header:after {{
+                header:after {
                     content: '';
                     position: absolute;
                     bottom: 0;
@@ -556,27 +2358,27 @@ class MedicalSearchSystem:
                     right: 0;
                     height: 4px;
                     background: var(--accent);
-                }}
+                }
                 
-                h1, h2, h3 {{
+                h1, h2, h3 {
                     font-family: 'Merriweather', serif;
                     font-weight: 700;
                     color: var(--dark);
-                }}
+                }
                 
-                h1 {{
+                h1 {
                     font-size: 2.5rem;
                     margin-bottom: 1rem;
-                }}
+                }
                 
-                h2 {{
+                h2 {
                     font-size: 1.8rem;
                     margin: 2.5rem 0 1.5rem;
                     position: relative;
                     padding-bottom: 0.5rem;
-                }}
+                }
                 
-                h2:after {{
+                h2:after {
                     content: '';
                     position: absolute;
                     bottom: 0;
@@ -584,22 +2386,22 @@ class MedicalSearchSystem:
                     width: 50px;
                     height: 3px;
                     background: var(--accent);
-                }}
+                }
                 
-                h3 {{
+                h3 {
                     font-size: 1.3rem;
                     margin: 1.2rem 0;
-                }}
+                }
                 
-                .query-section {{
+                .query-section {
                     background: white;
                     padding: 2rem;
                     border-radius: 8px;
                     box-shadow: 0 2px 15px rgba(0,0,0,0.05);
                     margin-bottom: 2.5rem;
-                }}
+                }
                 
-                .query-text {{
+                .query-text {
                     font-size: 1.1rem;
                     font-weight: 500;
                     color: var(--dark);
@@ -607,15 +2409,15 @@ class MedicalSearchSystem:
                     background: var(--light);
                     border-left: 4px solid var(--accent);
                     border-radius: 0 4px 4px 0;
-                }}
+                }
                 
-                .stats {{
+                .stats {
                     display: flex;
                     gap: 1.2rem;
                     margin: 1.5rem 0;
-                }}
+                }
                 
-                .stat-box {{
+                .stat-box {
                     flex: 1;
                     background: white;
                     padding: 1.5rem;
@@ -623,145 +2425,145 @@ class MedicalSearchSystem:
                     box-shadow: 0 2px 8px rgba(0,0,0,0.04);
                     text-align: center;
                     border-top: 3px solid var(--accent);
-                }}
+                }
                 
-                .stat-value {{
+                .stat-value {
                     font-size: 1.8rem;
                     font-weight: 700;
                     color: var(--primary);
                     margin-bottom: 0.3rem;
-                }}
+                }
                 
-                .stat-label {{
+                .stat-label {
                     font-size: 0.85rem;
                     color: var(--light-text);
                     text-transform: uppercase;
                     letter-spacing: 0.5px;
-                }}
+                }
                 
-                .analysis-section {{
+                .analysis-section {
                     margin-bottom: 2.5rem;
-                }}
+                }
                 
-                .analysis-grid {{
+                .analysis-grid {
                     display: grid;
                     grid-template-columns: repeat(auto-fit, minmax(300px, 1fr));
                     gap: 1.5rem;
                     margin-top: 1.5rem;
-                }}
+                }
                 
-                .analysis-card {{
+                .analysis-card {
                     background: white;
                     border-radius: 8px;
                     box-shadow: 0 3px 10px rgba(0,0,0,0.06);
                     overflow: hidden;
                     transition: transform 0.3s ease, box-shadow 0.3s ease;
-                }}
+                }
                 
-                .analysis-card:hover {{
+                .analysis-card:hover {
                     transform: translateY(-3px);
                     box-shadow: 0 5px 15px rgba(0,0,0,0.1);
-                }}
+                }
                 
-                .analysis-card-header {{
+                .analysis-card-header {
                     padding: 1.2rem 1.5rem;
                     background: var(--light);
                     border-bottom: 1px solid rgba(0,0,0,0.05);
                     display: flex;
                     align-items: center;
                     gap: 0.8rem;
-                }}
+                }
                 
-                .analysis-card-icon {{
+                .analysis-card-icon {
                     font-size: 1.3rem;
                     color: var(--accent);
-                }}
+                }
                 
-                .analysis-card-content {{
+                .analysis-card-content {
                     padding: 1.5rem;
-                }}
+                }
                 
-                .analysis-card-content ul {{
+                .analysis-card-content ul {
                     list-style-type: none;
-                }}
+                }
                 
-                .analysis-card-content li {{
+                .analysis-card-content li {
                     margin-bottom: 0.6rem;
                     padding-left: 1.2rem;
                     position: relative;
                     color: var(--text);
-                }}
+                }
                 
-                .analysis-card-content li:before {{
+                .analysis-card-content li:before {
                     content: '•';
                     position: absolute;
                     left: 0;
                     color: var(--accent);
                     font-weight: bold;
-                }}
+                }
                 
-                .results-section {{
+                .results-section {
                     margin-bottom: 3rem;
-                }}
+                }
                 
-                .result-card {{
+                .result-card {
                     background: white;
                     border-radius: 8px;
                     box-shadow: 0 3px 10px rgba(0,0,0,0.06);
                     margin-bottom: 1.5rem;
                     overflow: hidden;
                     transition: transform 0.3s ease, box-shadow 0.3s ease;
-                }}
+                }
                 
-                .result-card:hover {{
+                .result-card:hover {
                     transform: translateY(-3px);
                     box-shadow: 0 5px 15px rgba(0,0,0,0.1);
-                }}
+                }
                 
-                .result-header {{
+                .result-header {
                     display: flex;
                     justify-content: space-between;
                     align-items: center;
                     padding: 1.2rem 1.5rem;
                     background: var(--light);
                     border-bottom: 1px solid rgba(0,0,0,0.05);
-                }}
+                }
                 
-                .result-source {{
+                .result-source {
                     display: flex;
                     align-items: center;
                     gap: 0.6rem;
                     font-weight: 500;
                     color: var(--light-text);
                     font-size: 0.9rem;
-                }}
+                }
                 
-                .result-score {{
+                .result-score {
                     background: var(--accent);
                     color: white;
                     padding: 0.3rem 0.8rem;
                     border-radius: 20px;
                     font-weight: 600;
                     font-size: 0.85rem;
-                }}
+                }
                 
-                .result-body {{
+                .result-body {
                     padding: 1.5rem;
-                }}
+                }
                 
-                .result-title {{
+                .result-title {
                     font-size: 1.2rem;
                     margin-bottom: 1rem;
                     color: var(--dark);
-                }}
+                }
                 
-                .result-content {{
+                .result-content {
                     margin-bottom: 1.5rem;
                     color: var(--text);
                     line-height: 1.6;
-                }}
+                }
                 
-                .result-link {{
+                .result-link {
                     display: inline-flex;
                     align-items: center;
                     gap: 0.5rem;
@@ -773,63 +2575,63 @@ class MedicalSearchSystem:
                     font-weight: 500;
                     font-size: 0.9rem;
                     transition: background 0.3s ease;
-                }}
+                }
                 
-                .result-link:hover {{
+                .result-link:hover {
                     background: var(--primary);
-                }}
+                }
                 
-                footer {{
+                footer {
                     text-align: center;
                     padding: 2rem;
                     color: var(--light-text);
                     font-size: 0.85rem;
                     border-top: 1px solid rgba(0,0,0,0.08);
-                }}
+                }
                 
-                @media (max-width: 768px) {{
-                    .container {{
+                @media (max-width: 768px) {
+                    .container {
                         padding: 1.2rem;
-                    }}
+                    }
                     
-                    h1 {{
+                    h1 {
                         font-size: 2rem;
-                    }}
+                    }
                     
-                    h2 {{
+                    h2 {
                         font-size: 1.5rem;
-                    }}
+                    }
                     
-                    .stats {{
+                    .stats {
                         flex-direction: column;
-                    }}
+                    }
                     
-                    .analysis-grid {{
+                    .analysis-grid {
                         grid-template-columns: 1fr;
-                    }}
-                }}
+                    }
+                }
                 
                 /* Animation effects */
-                @keyframes fadeIn {{
-                    from {{ opacity: 0; transform: translateY(15px); }}
-                    to {{ opacity: 1; transform: translateY(0); }}
-                }}
+                @keyframes fadeIn {
+                    from { opacity: 0; transform: translateY(15px); }
+                    to { opacity: 1; transform: translateY(0); }
+                }
                 
-                .query-section, .analysis-card, .result-card {{
+                .query-section, .analysis-card, .result-card {
                     animation: fadeIn 0.5s ease-out forwards;
-                }}
-                
-                .analysis-card:nth-child(1) {{ animation-delay: 0.1s; }}
-                .analysis-card:nth-child(2) {{ animation-delay: 0.2s; }}
-                .analysis-card:nth-child(3) {{ animation-delay: 0.3s; }}
-                .analysis-card:nth-child(4) {{ animation-delay: 0.4s; }}
-                .analysis-card:nth-child(5) {{ animation-delay: 0.5s; }}
-                
-                .result-card:nth-child(1) {{ animation-delay: 0.1s; }}
-                .result-card:nth-child(2) {{ animation-delay: 0.2s; }}
-                .result-card:nth-child(3) {{ animation-delay: 0.3s; }}
-                .result-card:nth-child(4) {{ animation-delay: 0.4s; }}
-                .result-card:nth-child(5) {{ animation-delay: 0.5s; }}
+                }
+                
+                .analysis-card:nth-child(1) { animation-delay: 0.1s; }
+                .analysis-card:nth-child(2) { animation-delay: 0.2s; }
+                .analysis-card:nth-child(3) { animation-delay: 0.3s; }
+                .analysis-card:nth-child(4) { animation-delay: 0.4s; }
+                .analysis-card:nth-child(5) { animation-delay: 0.5s; }
+                
+                .result-card:nth-child(1) { animation-delay: 0.1s; }
+                .result-card:nth-child(2) { animation-delay: 0.2s; }
+                .result-card:nth-child(3) { animation-delay: 0.3s; }
+                .result-card:nth-child(4) { animation-delay: 0.4s; }
+                .result-card:nth-child(5) { animation-delay: 0.5s; }
             </style>
         </head>
         <body>
@@ -843,19 +2645,19 @@ class MedicalSearchSystem:
             <main class="container">
                 <section class="query-section">
                     <h2>Patient Query</h2>
-                    <div class="query-text">{query}</div>
+                    <div class="query-text">$query</div>
                     
                     <div class="stats">
                         <div class="stat-box">
-                            <div class="stat-value">{len(results)}</div>
+                            <div class="stat-value">$num_results</div>
                             <div class="stat-label">Relevant Findings</div>
                         </div>
                         <div class="stat-box">
-                            <div class="stat-value">{avg_similarity:.2f}</div>
+                            <div class="stat-value">$avg_similarity</div>
                             <div class="stat-label">Average Relevance</div>
                         </div>
                         <div class="stat-box">
-                            <div class="stat-value">{current_date.split()[0]}</div>
+                            <div class="stat-value">$report_day</div>
                             <div class="stat-label">Report Date</div>
                         </div>
                     </div>
@@ -864,83 +2666,71 @@ class MedicalSearchSystem:
                 <section class="analysis-section">
                     <h2>Clinical Analysis</h2>
                     <div class="analysis-grid">
-                        {analysis_cards}
+                        $analysis_cards
                     </div>
                 </section>
                 
                 <section class="results-section">
                     <h2>Research Findings</h2>
-                    {"".join([f"""
-                    <article class="result-card">
-                        <div class="result-header">
-                            <div class="result-source">
-                                {source_icons.get(r['source'], '📄')} {r['source']}
-                            </div>
-                            <div class="result-score">Relevance: {r.get('similarity_score', 0):.2f}</div>
-                        </div>
-                        <div class="result-body">
-                            <h3 class="result-title">{r['title']}</h3>
-                            <div class="result-content">
-                                {r['content'][:400]}...
-                            </div>
-                            <a href="{r['url']}" class="result-link" target="_blank">
-                                <svg width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round">
-                                    <path d="M18 13v6a2 2 0 0 1-2 2H5a2 2 0 0 1-2-2V8a2 2 0 0 1 2-2h6"></path>
-                                    <polyline points="15 3 21 3 21 9"></polyline>
-                                    <line x1="10" y1="14" x2="21" y2="3"></line>
-                                </svg>
-                                View Full Content
-                            </a>
-                        </div>
-                    </article>
-                    """ for r in results])}
+                    $result_cards
                 </section>
             </main>
             
             <footer>
                 <div class="container">
-                    <p>Report generated on {current_date} by Medical Search System</p>
+                    <p>Report generated on $current_date by Medical Search System</p>
                     <p>This clinical analysis is for informational purposes only and should not replace professional medical advice.</p>
                 </div>
             </footer>
             
             <script>
-                document.addEventListener('DOMContentLoaded', function() {{
+                document.addEventListener('DOMContentLoaded', function() {
                     // Animate elements when they come into view
-                    const animateOnScroll = function() {{
+                    const animateOnScroll = function() {
                         const elements = document.querySelectorAll('.analysis-card, .result-card');
-                        elements.forEach(element => {{
+                        elements.forEach(element => {
                             const elementPosition = element.getBoundingClientRect().top;
                             const screenPosition = window.innerHeight / 1.2;
                             
-                            if (elementPosition < screenPosition) {{
+                            if (elementPosition < screenPosition) {
                                 element.style.opacity = '1';
                                 element.style.transform = 'translateY(0)';
-                            }}
-                        }});
-                    }};
+                            }
+                        });
+                    };
                     
                     window.addEventListener('scroll', animateOnScroll);
                     animateOnScroll();
-                }});
+                });
             </script>
         </body>
         </html>
-        """
-        
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(html_content)
-        
-        print(f"Elegant HTML report generated: {filename}")
-        return filename
+        """).safe_substitute(REPORT_COLORS))
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Medical Search Report")
+    parser.add_argument("--serve", action="store_true", help="Run as a long-lived HTTP service")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to bind; use 0.0.0.0 only behind a trusted proxy")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--batch", metavar="FILE", help="Write a report for every query in FILE (one per line)")
+    parser.add_argument("--output-dir", default="reports", help="Where batch reports are written")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel queries in batch mode")
+    args = parser.parse_args()
+    
     # Initialize with your Nebius API key
     api_key = os.getenv("NEBIUS_API_KEY")
     if not api_key:
         raise ValueError("Please set the NEBIUS_API_KEY environment variable")
     
+    if args.serve:
+        serve(api_key, args.host, args.port)
+        return
+    
+    if args.batch:
+        run_batch(api_key, args.batch, args.output_dir, args.workers)
+        return
+    
     # Get user query
     query = input("Enter your medical query (e.g., '35-year-old with chest pain and shortness of breath'): ")
     if not query.strip():
@@ -950,28 +2740,29 @@ def main():
     print("\nInitializing Medical Search System...")
     med_search = MedicalSearchSystem(api_key)
     
-    # Step 1: Search for medical information
-    print("\nSearching for relevant medical information...")
-    results = med_search.search_medical_info(query)
+    # Open the report as soon as the first analysis section has been written
+    opened = []
+    def open_report(filename: str):
+        if not opened:
+            opened.append(filename)
+            open_in_browser(filename)
     
-    if not results:
-        print("No relevant medical information found")
-        return
-    
-    # Step 2: Rank results by relevance
-    print("\nRanking results by relevance...")
-    ranked_results = med_search.rank_results(query, results)
+    pipeline = SearchReportPipeline(med_search)
+    report_filename = pipeline.run(query, on_update=open_report)
+    pipeline.close()
     
-    # Step 3: Generate and display report
-    print("\nGenerating report...")
-    report_filename = med_search.generate_report(query, ranked_results[:5])  # Top 5 results
-    
-    # Open the report in default browser
+    if report_filename:
+        open_report(report_filename)
+
+def open_in_browser(filename: str):
+    """
+    Open the report in default browser
+    """
     try:
-        webbrowser.open(f'file://{os.path.abspath(report_filename)}')
+        webbrowser.open(f'file://{os.path.abspath(filename)}')
     except Exception as e:
         print(f"Could not open report automatically: {str(e)}")
-        print(f"Please open the file manually: {os.path.abspath(report_filename)}")
+        print(f"Please open the file manually: {os.path.abspath(filename)}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
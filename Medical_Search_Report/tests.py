@@ -0,0 +1,861 @@
+﻿import io
+import os
+import json
+import math
+import time
+import tempfile
+import threading
+import contextlib
+import contextvars
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, Mock, patch
+from benchmark import (DEFAULT_QUERIES, EXTRACTORS, StandInServer, eval_relevance, load_fixtures,
+                       load_medical_search, ndcg)
+
+# code.py shadows the standard library module of the same name, so it is loaded by path
+medical_search = load_medical_search()
+
+
+class SystemTestCase(unittest.TestCase):
+    """Base class giving each test a MedicalSearchSystem over a throwaway cache directory"""
+    
+    def make_system(self, **kwargs):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        return medical_search.MedicalSearchSystem("test_api_key", cache_dir=cache_dir.name,
+                                                  tracer=medical_search.Tracer(), **kwargs)
+
+
+class TestHybridRanking(SystemTestCase):
+    """Test cases for BM25 scoring and reciprocal-rank fusion"""
+    
+    def test_bm25_scoring(self):
+        """Test BM25 matches the Okapi formula and favours rarer terms"""
+        index = medical_search.BM25Index()
+        index.add("a", "chest pain after exercise")
+        index.add("b", "chest pain and pulmonary embolism")
+        index.add("c", "gout in the big toe")
+        
+        scores = dict(index.search("pulmonary chest"))
+        self.assertEqual(set(scores), {"a", "b"})
+        self.assertGreater(scores["b"], scores["a"])
+        
+        # "a" matches only "chest" (in 2 of 3 docs); it has 4 tokens against an average of 11/3 after stopwords
+        idf = math.log(1 + (3 - 2 + 0.5) / (2 + 0.5))
+        self.assertAlmostEqual(scores["a"], idf * (1.5 + 1) / (1 + 1.5 * (1 - 0.75 + 0.75 * 4 / (11 / 3))))
+        self.assertEqual(index.search("pulmonary chest", top_k=1), [("b", scores["b"])])
+        self.assertEqual(index.search("fracture"), [])
+    
+    def test_rrf_ordering(self):
+        """Test the fused order combines both rankings and dense-only matches still score"""
+        system = self.make_system()
+        vectors = {"chest pain": [1.0, 0.0], "Angina": [0.0, 1.0], "Discomfort": [0.8, 0.6], "Gout": [1.0, 0.0]}
+        system.create_embeddings = lambda texts: [
+            next(v for key, v in vectors.items() if t.startswith(key)) for t in texts
+        ]
+        results = [
+            medical_search.SearchResult("PubMed", "Angina", "chest pain chest pain on exertion", "https://a"),
+            medical_search.SearchResult("CDC", "Discomfort", "chest discomfort at rest", "https://b"),
+            medical_search.SearchResult("PubMed", "Gout", "joint flare in the big toe", "https://c"),
+        ]
+        
+        with contextlib.redirect_stdout(io.StringIO()):
+            ranked = system.rank_results("chest pain", results)
+        
+        # BM25 order a, b (c has no lexical match); dense order c, b, a
+        self.assertEqual([r.url for r in ranked], ["https://a", "https://b", "https://c"])
+        self.assertAlmostEqual(ranked[0].fusion_score, 1 / 61 + 1 / 63)
+        self.assertAlmostEqual(ranked[1].fusion_score, 1 / 62 + 1 / 62)
+        self.assertAlmostEqual(ranked[2].fusion_score, 1 / 61)
+        self.assertEqual(ranked[2].bm25_score, 0.0)
+        self.assertAlmostEqual(ranked[2].similarity_score, 1.0)
+    
+    def test_rank_without_query_embedding(self):
+        """Test ranking falls back to BM25 order when the query cannot be embedded"""
+        system = self.make_system()
+        system.create_embeddings = lambda texts: [None] * len(texts)
+        results = [
+            medical_search.SearchResult("CDC", "Gout", "joint flare", "https://c"),
+            medical_search.SearchResult("PubMed", "Angina", "chest pain", "https://a"),
+        ]
+        ranked = system.rank_results("chest pain", results)
+        self.assertEqual([r.url for r in ranked], ["https://a", "https://c"])
+        self.assertNotIn("similarity_score", ranked[0])
+
+
+class TestHTMLBackends(SystemTestCase):
+    """Test cases for extraction agreement across the HTML parser backends"""
+    
+    def test_backends_extract_the_same_documents(self):
+        """Test every installed backend returns the same titles, URLs and content for each fixture"""
+        systems = {backend: self.make_system(html_backend=backend) for backend in medical_search.HTML_BACKENDS}
+        for name, pattern, extract in EXTRACTORS:
+            pages = load_fixtures(pattern)
+            self.assertTrue(pages, f"no fixtures matching {pattern}")
+            for page in pages:
+                # Parsers disagree on insignificant whitespace only
+                outputs = {backend: " ".join(json.dumps(extract(system, page)).replace('\\n', ' ').split())
+                           for backend, system in systems.items()}
+                reference = outputs['html.parser']
+                self.assertNotIn(reference, ('[]', '""'))
+                for backend, output in outputs.items():
+                    with self.subTest(extractor=name, backend=backend):
+                        self.assertEqual(output, reference)
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    """Test cases for the memory-mapped embedding cache"""
+    
+    def test_persists_across_instances(self):
+        """Test embeddings written by one instance are read back by a new one"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = medical_search.EmbeddingCache(cache_dir, "model-a")
+            keys = [cache.make_key("https://a", "first"), cache.make_key("https://b", "second")]
+            cache.put_many(keys, [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+            
+            reloaded = medical_search.EmbeddingCache(cache_dir, "model-a")
+            self.assertEqual(reloaded.dim, 3)
+            first, second, missing = reloaded.get_many(keys + [reloaded.make_key("https://c", "third")])
+            self.assertEqual(first.tolist(), [1.0, 2.0, 3.0])
+            self.assertEqual(second.tolist(), [4.0, 5.0, 6.0])
+            self.assertIsNone(missing)
+            # The key covers the content, so an edited page misses
+            self.assertIsNone(reloaded.get_many([reloaded.make_key("https://a", "edited")])[0])
+    
+    def test_append_keeps_row_offsets(self):
+        """Test rows appended after a reload land at their recorded offsets"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = medical_search.EmbeddingCache(cache_dir, "model-a")
+            cache.put_many(["a", "b"], [[1.0, 1.0], [2.0, 2.0]])
+            cache.get_many(["a"])
+            cache.put_many(["b", "c"], [[9.0, 9.0], [3.0, 3.0]])
+            self.assertEqual(cache.ids, {"a": 0, "b": 1, "c": 2})
+            self.assertEqual([v.tolist() for v in cache.get_many(["a", "b", "c"])],
+                             [[1.0, 1.0], [2.0, 2.0], [3.0, 3.0]])
+            
+            reloaded = medical_search.EmbeddingCache(cache_dir, "model-a")
+            reloaded.put_many(["d"], [[4.0, 4.0]])
+            self.assertEqual(os.path.getsize(reloaded.matrix_path), 4 * 2 * 4)
+            self.assertEqual([v.tolist() for v in reloaded.get_many(["c", "d"])], [[3.0, 3.0], [4.0, 4.0]])
+    
+    def test_dimension_mismatch(self):
+        """Test vectors of another width are rejected and a different model rebuilds the cache"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = medical_search.EmbeddingCache(cache_dir, "model-a")
+            cache.put_many(["a"], [[1.0, 2.0, 3.0]])
+            cache.put_many(["b", "c"], [[1.0, 2.0], [4.0, 5.0, 6.0]])
+            self.assertNotIn("b", cache.ids)
+            self.assertEqual([v.tolist() for v in cache.get_many(["a", "c"])], [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+            
+            rebuilt = medical_search.EmbeddingCache(cache_dir, "model-b")
+            self.assertEqual((rebuilt.ids, rebuilt.dim), ({}, None))
+            rebuilt.put_many(["a"], [[7.0, 8.0]])
+            self.assertEqual(os.path.getsize(rebuilt.matrix_path), 2 * 4)
+            self.assertEqual(medical_search.EmbeddingCache(cache_dir, "model-b").get_many(["a"])[0].tolist(), [7.0, 8.0])
+
+
+class TestDocumentNormalizer(unittest.TestCase):
+    """Test cases for SimHash near-duplicate dropping"""
+    
+    def test_simhash_distance(self):
+        """Test near-identical texts land a few bits apart and unrelated texts far apart"""
+        text = " ".join([
+            "Pulmonary embolism presents with sudden pleuritic chest pain, dyspnea and tachycardia.",
+            "Risk factors include recent surgery, immobilization, long flights, cancer and oral contraceptives.",
+            "Diagnosis relies on clinical probability scores, D-dimer testing and CT pulmonary angiography.",
+            "Treatment is anticoagulation with heparin or a direct oral anticoagulant such as apixaban.",
+            "Massive embolism with hypotension may require thrombolysis or catheter-directed therapy.",
+        ])
+        near = text.replace("long flights", "long-haul flights")
+        other = "Gout flares cause sudden severe pain, redness and swelling in the joint at the base of the big toe"
+        
+        self.assertEqual(medical_search.simhash(text), medical_search.simhash(text.upper()))
+        self.assertLessEqual((medical_search.simhash(text) ^ medical_search.simhash(near)).bit_count(), 8)
+        self.assertGreater((medical_search.simhash(text) ^ medical_search.simhash(other)).bit_count(), 8)
+    
+    def test_drops_duplicates_and_truncates(self):
+        """Test repeated URLs and near-duplicate content are dropped, keeping the first copy in order"""
+        body = " ".join(f"word{i}" for i in range(40))
+        results = [
+            medical_search.SearchResult("PubMed", "Aspirin after MI", body, "https://a"),
+            medical_search.SearchResult("PubMed", "Aspirin after MI", body, "https://a"),
+            medical_search.SearchResult("CDC", "Aspirin after MI", body + " word40", "https://b"),
+            medical_search.SearchResult("CDC", "Gout", "joint flare in the big toe", "https://c"),
+        ]
+        kept, dropped = medical_search.DocumentNormalizer(max_tokens=10).normalize(results)
+        
+        self.assertEqual([r.url for r in kept], ["https://a", "https://c"])
+        self.assertEqual(dropped, 2)
+        self.assertEqual(kept[0].content, " ".join(f"word{i}" for i in range(10)))
+
+
+class TestTermExtraction(SystemTestCase):
+    """Test cases for the term extraction tiers: memory, disk, lexicon, then the LLM"""
+    
+    def llm_response(self, text, status=200):
+        return Mock(status_code=status, content=b"", json=Mock(return_value={'choices': [{'text': text}]}))
+    
+    def extract(self, system, query):
+        """(terms, tier) as recorded on the terms span"""
+        with contextlib.redirect_stdout(io.StringIO()):
+            terms = system._extract_medical_terms(query)
+        return terms, system.tracer.spans[-1].attributes['source']
+    
+    def test_tiers(self):
+        """Test each tier answers in turn and LLM answers are kept for later queries"""
+        system = self.make_system()
+        system.session.post = Mock(return_value=self.llm_response("fatigue, anemia"))
+        
+        self.assertEqual(self.extract(system, "Chest pain"), (["chest pain"], 'lexicon'))
+        self.assertEqual(self.extract(system, "chest  PAIN!"), (["chest pain"], 'memory'))
+        system.session.post.assert_not_called()
+        
+        query = "tired all the time and pale"
+        self.assertEqual(self.extract(system, query), (["fatigue", "anemia"], 'llm'))
+        self.assertEqual(self.extract(system, query), (["fatigue", "anemia"], 'memory'))
+        self.assertEqual(system.session.post.call_count, 1)
+        
+        # A fresh process starts with an empty memory tier but the same disk tier
+        reloaded = medical_search.TermExtractionCache(system.cache_dir)
+        self.assertEqual(reloaded.get(medical_search.normalize_query(query)), (["fatigue", "anemia"], 'disk'))
+        self.assertEqual(reloaded.get(medical_search.normalize_query(query)), (["fatigue", "anemia"], 'memory'))
+        
+        stats = system.term_extraction_stats()
+        self.assertEqual((stats['queries'], stats['memory_hits'], stats['lexicon_answers'], stats['llm_calls']),
+                         (4, 2, 1, 1))
+    
+    def test_llm_failure_not_cached(self):
+        """Test the keyword fallback is used on LLM errors and the LLM is retried next time"""
+        system = self.make_system()
+        system.session.post = Mock(return_value=self.llm_response("", status=503))
+        
+        terms, tier = self.extract(system, "tired and pale")
+        self.assertEqual((sorted(terms), tier), (["and", "pale", "tired"], 'fallback'))
+        self.extract(system, "tired and pale")
+        self.assertEqual(system.session.post.call_count, 2)
+    
+    def test_memory_tier_is_bounded(self):
+        """Test the in-memory tier evicts least recently used queries"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = medical_search.TermExtractionCache(cache_dir, max_entries=2)
+            cache.set("a", ["x"])
+            cache.set("b", ["y"])
+            cache.get("a")
+            cache.set("c", ["z"])
+            self.assertEqual(list(cache.memory), ["a", "c"])
+            self.assertEqual(cache.get("b"), (["y"], 'disk'))
+    
+    def test_disk_tier_is_bounded(self):
+        """Test the disk tier keeps only the most recently used queries"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = medical_search.TermExtractionCache(cache_dir, max_entries=1, max_disk_entries=3)
+            for key in "abcd":
+                cache.set(key, [key])
+                time.sleep(0.01)
+            self.assertEqual(cache.get("a"), (None, None))
+            time.sleep(0.01)
+            self.assertEqual(cache.get("b"), (["b"], 'disk'))
+            cache.set("e", ["e"])
+            cache.conn.close()
+            
+            reloaded = medical_search.TermExtractionCache(cache_dir, max_disk_entries=3)
+            self.assertEqual(reloaded.disk_entries, 3)
+            self.assertEqual([reloaded.get(key)[0] for key in "bcde"], [["b"], None, ["d"], ["e"]])
+            reloaded.conn.close()
+    
+    def test_imports_json_store(self):
+        """Test entries saved by the earlier JSON store are carried over"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with open(os.path.join(cache_dir, "terms.json"), 'w', encoding='utf-8') as f:
+                json.dump({"chest pain": ["chest pain"]}, f)
+            cache = medical_search.TermExtractionCache(cache_dir)
+            self.assertEqual(cache.get("chest pain"), (["chest pain"], 'disk'))
+            self.assertFalse(os.path.exists(os.path.join(cache_dir, "terms.json")))
+            cache.conn.close()
+
+
+class TestFanOutPlanner(unittest.TestCase):
+    """Test cases for the adaptive per-source fan-out"""
+    
+    def make_planner(self, **kwargs):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        return medical_search.FanOutPlanner(cache_dir.name, warmup=2, **kwargs)
+    
+    def observe(self, planner, queries, hits):
+        """Record queries where each source fetched per its default plan and hits[source] of them ranked top"""
+        for _ in range(queries):
+            results = [{'source': source, 'term_index': 0}
+                       for source, name in medical_search.SOURCE_KEYS.items()
+                       for _ in range(medical_search.DEFAULT_FANOUT[name][1])]
+            planner.record_query({name: terms for name, (terms, _) in medical_search.DEFAULT_FANOUT.items()}, results)
+            planner.record_ranking([{'source': source, 'term_index': 0}
+                                    for source, name in medical_search.SOURCE_KEYS.items()
+                                    for _ in range(hits[name])])
+    
+    def planned_seconds(self, planner, plan):
+        return sum(terms * (planner.sources[name]['search_seconds'] + per_term * planner.sources[name]['detail_seconds'])
+                   for name, (terms, per_term) in plan.items())
+    
+    def test_default_until_warm(self):
+        """Test the fixed fan-out is used until every source has been observed for warmup queries"""
+        planner = self.make_planner()
+        self.observe(planner, 1, {'pubmed': 3, 'clinical_trials': 0, 'cdc': 0})
+        self.assertEqual(planner.plan(), medical_search.DEFAULT_FANOUT)
+        self.assertFalse(planner.stats()['adaptive'])
+    
+    def test_budget_and_min_one_per_source(self):
+        """Test the plan stays within the latency budget yet every source keeps one document per term"""
+        planner = self.make_planner(latency_budget=0.0)
+        self.observe(planner, 3, {'pubmed': 4, 'clinical_trials': 0, 'cdc': 0})
+        plan = planner.plan()
+        self.assertTrue(all(terms >= 1 and per_term == 1 for terms, per_term in plan.values()))
+        
+        planner = self.make_planner(latency_budget=6.0)
+        self.observe(planner, 3, {'pubmed': 4, 'clinical_trials': 0, 'cdc': 0})
+        plan = planner.plan()
+        self.assertTrue(all(terms >= 1 and per_term >= 1 for terms, per_term in plan.values()))
+        self.assertLessEqual(self.planned_seconds(planner, plan), 6.0)
+        self.assertLessEqual(sum(terms * per_term for terms, per_term in plan.values()), planner.max_documents)
+    
+    def test_shifts_toward_yield(self):
+        """Test spare budget goes to the source whose documents reach the top results"""
+        planner = self.make_planner(latency_budget=30.0)
+        self.observe(planner, 10, {'pubmed': 0, 'clinical_trials': 0, 'cdc': 2})
+        plan = planner.plan()
+        self.assertEqual(plan['cdc'][1], 2 * medical_search.DEFAULT_FANOUT['cdc'][1])
+        self.assertLess(plan['pubmed'][1], medical_search.DEFAULT_FANOUT['pubmed'][1])
+        
+        # Statistics persist for the next process
+        reloaded = medical_search.FanOutPlanner(os.path.dirname(planner.path), warmup=2, latency_budget=30.0)
+        self.assertEqual(reloaded.plan(), plan)
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Test cases for coalescing identical in-flight calls"""
+    
+    def run_concurrently(self, fn, count=4):
+        results, errors = [], []
+        def call():
+            try:
+                results.append(fn())
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+    
+    def test_concurrent_calls_share_one_execution(self):
+        """Test callers arriving while a key is running get its result without running it again"""
+        flight = medical_search.SingleFlight()
+        calls = []
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return ["shared"]
+        
+        results, errors = self.run_concurrently(lambda: flight.do("chest pain", slow))
+        self.assertEqual((len(calls), errors), (1, []))
+        self.assertEqual(results, [["shared"]] * 4)
+        self.assertEqual((flight.calls, flight.shared), (1, 3))
+        
+        # Finished keys are forgotten, so the next call runs again
+        flight.do("chest pain", slow)
+        self.assertEqual(len(calls), 2)
+    
+    def test_errors_are_shared(self):
+        """Test every waiting caller sees the leader's exception"""
+        flight = medical_search.SingleFlight()
+        def failing():
+            time.sleep(0.2)
+            raise RuntimeError("source down")
+        
+        results, errors = self.run_concurrently(lambda: flight.do("key", failing))
+        self.assertEqual(results, [])
+        self.assertEqual([str(e) for e in errors], ["source down"] * 4)
+        self.assertEqual(flight.calls, 1)
+    
+    def test_service_coalesces_identical_queries(self):
+        """Test the service runs one search for concurrent queries that normalize the same"""
+        system = MagicMock()
+        def search(query):
+            time.sleep(0.2)
+            return ["doc"]
+        system.search_medical_info.side_effect = search
+        system.rank_results.side_effect = lambda query, results: results
+        service = medical_search.MedicalSearchService(system)
+        
+        queries = iter(["Chest pain", "chest pain!", "CHEST  PAIN", "chest pain"])
+        results, errors = self.run_concurrently(lambda: service.search(next(queries)))
+        self.assertEqual((results, errors), ([["doc"]] * 4, []))
+        self.assertEqual(system.search_medical_info.call_count, 1)
+
+
+class TestReportRendering(SystemTestCase):
+    """Test cases for the locally rendered HTML report"""
+    
+    def render(self, system, **kwargs):
+        results = [{
+            'source': 'PubMed',
+            'title': '<script>alert("title")</script>',
+            'url': 'javascript:alert(1)',
+            'content': 'Chest pain <img src=x onerror=alert(2)>',
+            'similarity_score': 0.9
+        }]
+        analysis = {'status': 'success', 'analysis': "### Potential Causes\n- <b>Angina</b>"}
+        filename = os.path.join(system.cache_dir, "report.html")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(system.generate_report("<i>chest</i> pain", results, filename, analysis=analysis,
+                                                    **kwargs), filename)
+        with open(filename, 'r', encoding='utf-8') as f:
+            return f.read()
+    
+    def test_untrusted_fields_escaped(self):
+        """Test page titles, content, query and analysis are escaped and unsafe links neutralized"""
+        page = self.render(self.make_system())
+        self.assertNotIn('<script>alert', page)
+        self.assertIn('&lt;script&gt;alert(&quot;title&quot;)&lt;/script&gt;', page)
+        self.assertNotIn('<img src=x', page)
+        self.assertNotIn('<b>Angina</b>', page)
+        self.assertNotIn('<i>chest</i>', page)
+        self.assertNotIn('javascript:', page)
+        self.assertIn('href="#"', page)
+        
+        self.assertEqual(medical_search.safe_href('javascript:alert(1)'), '#')
+        self.assertEqual(medical_search.safe_href(' JavaScript:alert(1)'), '#')
+        self.assertEqual(medical_search.safe_href('https://a.org/?q="x"&y=<z>'),
+                         'https://a.org/?q=&quot;x&quot;&amp;y=&lt;z&gt;')
+    
+    def test_llm_layout_falls_back_to_local(self):
+        """Test a failed LLM layout request still produces the locally rendered report"""
+        system = self.make_system()
+        system.session.post = Mock(return_value=Mock(status_code=503, content=b'busy', text='busy'))
+        page = self.render(system, llm_layout=True)
+        system.session.post.assert_called_once()
+        self.assertIn('&lt;script&gt;', page)
+        self.assertIn('href="#"', page)
+        self.assertEqual([s.name for s in system.tracer.spans if s.name.startswith('render')],
+                         ['render.llm', 'render'])
+
+
+class TestSearchResult(unittest.TestCase):
+    """Test cases for SearchResult reading like the dicts it replaced"""
+    
+    def test_dict_compatibility(self):
+        """Test item access, get, membership and round-tripping through dicts"""
+        result = medical_search.SearchResult("PubMed", "Angina", "chest pain on exertion", "https://a", term_index=1)
+        
+        self.assertEqual((result['source'], result['title'], result['url']), ("PubMed", "Angina", "https://a"))
+        self.assertEqual(result.get('similarity_score', 0), 0)
+        self.assertNotIn('similarity_score', result)
+        with self.assertRaises(KeyError):
+            result['similarity_score']
+        self.assertIsNone(result.get('not_a_field'))
+        
+        result.similarity_score = 0.0
+        self.assertIn('similarity_score', result)
+        self.assertEqual(result['similarity_score'], 0.0)
+        
+        data = result.to_dict()
+        self.assertEqual(data, {'source': "PubMed", 'title': "Angina", 'content': "chest pain on exertion",
+                                'url': "https://a", 'term_index': 1, 'similarity_score': 0.0})
+        self.assertEqual(json.loads(json.dumps(data)), data)
+        restored = medical_search.SearchResult.from_dict(data)
+        self.assertEqual((restored.url, restored.term_index, restored.similarity_score), ("https://a", 1, None))
+    
+    def test_copy_is_independent(self):
+        """Test copies carry scores but can be re-scored without touching the original"""
+        result = medical_search.SearchResult("CDC", "Gout", "joint flare", "https://c")
+        result.bm25_score = 1.5
+        copy = result.copy()
+        copy.bm25_score = 0.0
+        self.assertEqual((result.bm25_score, copy['bm25_score']), (1.5, 0.0))
+        with self.assertRaises(AttributeError):
+            result.extra = 1
+
+
+class StandInTestCase(SystemTestCase):
+    """Base class pointing the system at the benchmark's stand-in sources and API"""
+    
+    def setUp(self):
+        self.server = StandInServer().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+    
+    def make_system(self, **kwargs):
+        source_urls = {name: self.server.url for name in medical_search.SOURCE_URLS}
+        return super().make_system(base_url=f"{self.server.url}v1/", source_urls=source_urls, **kwargs)
+
+
+class TestTracing(StandInTestCase):
+    """Test cases for span nesting and trace export"""
+    
+    def test_parents_follow_context(self):
+        """Test spans nest through contextvars, including in a thread running a copied context"""
+        tracer = medical_search.Tracer()
+        
+        def child():
+            with tracer.span('analysis') as span:
+                return span
+        
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with tracer.span('query') as query:
+                with tracer.span('search') as search:
+                    self.assertIs(medical_search.current_span(), search)
+                self.assertIs(medical_search.current_span(), query)
+                copied = executor.submit(contextvars.copy_context().run, child).result()
+                fresh = executor.submit(child).result()
+        self.assertIsNone(medical_search.current_span())
+        
+        self.assertEqual((search.parent_id, search.trace_id), (query.span_id, query.trace_id))
+        self.assertEqual((copied.parent_id, copied.trace_id), (query.span_id, query.trace_id))
+        # Without the copied context the worker thread starts a new trace
+        self.assertIsNone(fresh.parent_id)
+        self.assertNotEqual(fresh.trace_id, query.trace_id)
+        self.assertIsNone(query.parent_id)
+    
+    def test_speculative_analysis_nests_under_query(self):
+        """Test the analysis run on the pipeline's worker thread is a child of the query span"""
+        system = self.make_system()
+        system.rank_results = lambda query, results: [results[i] for i in system._bm25_stage(query, results)[0]]
+        analysis = system.generate_medical_analysis
+        threads = []
+        
+        def traced_analysis(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return analysis(*args, **kwargs)
+        
+        system.generate_medical_analysis = traced_analysis
+        pipeline = medical_search.SearchReportPipeline(system)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                pipeline.run("chest pain", os.path.join(system.cache_dir, "report.html"))
+        finally:
+            pipeline.close()
+        
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith("analysis"))
+        spans = {s.name: s for s in system.tracer.spans}
+        self.assertEqual(spans['analysis'].parent_id, spans['query'].span_id)
+        self.assertEqual(spans['analysis'].trace_id, spans['query'].trace_id)
+    
+    def test_trace_file_export(self):
+        """Test MEDICAL_SEARCH_TRACE_FILE appends one record per span in the json and otel formats"""
+        for export_format in ('json', 'otel'):
+            with self.subTest(format=export_format), tempfile.TemporaryDirectory() as cache_dir:
+                path = os.path.join(cache_dir, "trace.jsonl")
+                env = {'MEDICAL_SEARCH_TRACE_FILE': path, 'MEDICAL_SEARCH_TRACE_FORMAT': export_format}
+                with patch.dict(os.environ, env):
+                    module = load_medical_search()
+                system = module.MedicalSearchSystem("test_api_key", cache_dir=cache_dir)
+                with system.tracer.span('query', query="chest pain"):
+                    with system.tracer.span('rank', results=3, cached=True) as rank:
+                        rank.set(score=0.5)
+                    with self.assertRaises(ValueError), system.tracer.span('render'):
+                        raise ValueError("bad template")
+                
+                with open(path, 'r', encoding='utf-8') as f:
+                    records = [json.loads(line) for line in f]
+                if export_format == 'json':
+                    self.assertEqual([r['name'] for r in records], ['rank', 'render', 'query'])
+                    self.assertEqual(set(records[0]), {'name', 'trace_id', 'span_id', 'parent_id', 'start',
+                                                       'duration_ms', 'status', 'error', 'attributes'})
+                    self.assertEqual(records[0]['parent_id'], records[2]['span_id'])
+                    self.assertEqual(records[0]['attributes'], {'results': 3, 'cached': True, 'score': 0.5})
+                    self.assertEqual((records[1]['status'], records[1]['error']), ('error', "bad template"))
+                    self.assertIsNone(records[2]['parent_id'])
+                else:
+                    self.assertEqual([r['name'] for r in records], ['rank', 'render', 'query'])
+                    self.assertEqual(set(records[0]), {'traceId', 'spanId', 'parentSpanId', 'name', 'kind',
+                                                       'startTimeUnixNano', 'endTimeUnixNano', 'attributes', 'status'})
+                    self.assertEqual(records[0]['parentSpanId'], records[2]['spanId'])
+                    self.assertEqual(records[2]['parentSpanId'], "")
+                    self.assertEqual(records[0]['attributes'], [
+                        {'key': 'results', 'value': {'intValue': '3'}},
+                        {'key': 'cached', 'value': {'boolValue': True}},
+                        {'key': 'score', 'value': {'doubleValue': 0.5}}
+                    ])
+                    self.assertLessEqual(int(records[0]['startTimeUnixNano']), int(records[0]['endTimeUnixNano']))
+                    self.assertEqual(records[1]['status'], {'code': 'STATUS_CODE_ERROR', 'message': "bad template"})
+                    self.assertEqual(records[2]['status'], {'code': 'STATUS_CODE_OK'})
+
+
+class TestAnalysisSectionParser(unittest.TestCase):
+    """Test cases for splitting streamed analysis text into sections"""
+    
+    def test_sections_across_chunk_boundaries(self):
+        """Test headers and lines split across deltas complete a section only when the next header arrives"""
+        parser = medical_search.AnalysisSectionParser()
+        first = "### Potential Causes\n- Angina\n"
+        self.assertEqual(parser.feed("##"), [])
+        self.assertEqual(parser.feed("# Potential Ca"), [])
+        self.assertEqual(parser.feed("uses\n- Ang"), [])
+        self.assertEqual(parser.feed("ina\n#"), [])
+        self.assertEqual(parser.feed("## Diagnostic"), [])
+        self.assertEqual(parser.completed_text, "")
+        self.assertEqual(parser.feed(" Approaches\n"), ["Potential Causes"])
+        self.assertEqual(parser.completed_text, first)
+        
+        # A '###' inside a line is not a header
+        self.assertEqual(parser.feed("- ECG ### troponin\n"), [])
+        self.assertEqual(parser.feed("- CT angiography"), [])
+        self.assertEqual(parser.sections, ["Potential Causes"])
+        self.assertEqual(parser.close(), ["Diagnostic Approaches"])
+        self.assertEqual(parser.completed_text, parser.text)
+        self.assertEqual(parser.text, first + "### Diagnostic Approaches\n- ECG ### troponin\n- CT angiography")
+        self.assertEqual(parser.sections, ["Potential Causes", "Diagnostic Approaches"])
+    
+    def test_close_without_sections(self):
+        """Test a stream without headers completes no sections"""
+        parser = medical_search.AnalysisSectionParser()
+        self.assertEqual(parser.feed("No structured analysis\n"), [])
+        self.assertEqual(parser.close(), [])
+
+
+class TestAnalysisStream(StandInTestCase):
+    """Test cases for the streamed analysis"""
+    
+    def test_cancel_stops_stream(self):
+        """Test setting the cancel event abandons the completion at the next delta"""
+        system = self.make_system()
+        cancel = threading.Event()
+        deltas = []
+        for delta in system.stream_completion("Analyze", max_tokens=100, cancel=cancel):
+            deltas.append(delta)
+            cancel.set()
+        self.assertEqual(len(deltas), 1)
+        
+        analysis = system.generate_medical_analysis("chest pain", [], cancel=cancel)
+        self.assertEqual(analysis['status'], 'cancelled')
+        analysis = system.generate_medical_analysis("chest pain", [], cancel=threading.Event())
+        self.assertEqual(analysis['status'], 'success')
+        self.assertIn("###", analysis['analysis'])
+    
+    def test_failed_ranking_cancels_speculative_analysis(self):
+        """Test the speculative analysis is cancelled when re-ranking raises"""
+        system = self.make_system()
+        started = threading.Event()
+        events = []
+        
+        def analysis(query, results, on_section=None, cancel=None):
+            events.append(cancel)
+            started.set()
+            cancel.wait(5)
+            return {'status': 'cancelled'}
+        
+        def rank_results(query, results):
+            raise RuntimeError("embedding service down")
+        
+        system.generate_medical_analysis = analysis
+        system.rank_results = rank_results
+        pipeline = medical_search.SearchReportPipeline(system)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                with self.assertRaises(RuntimeError):
+                    pipeline.run("chest pain", os.path.join(system.cache_dir, "report.html"))
+            self.assertTrue(started.wait(5))
+            self.assertTrue(events[0].is_set())
+        finally:
+            pipeline.close()
+
+
+class TestRelevance(unittest.TestCase):
+    """Test cases for ranking quality on the recorded queries"""
+    
+    def test_ndcg(self):
+        """Test nDCG is 1 for the ideal order and lower when relevant pages sink"""
+        self.assertEqual(ndcg([2, 1, 0], k=3), 1.0)
+        self.assertLess(ndcg([0, 1, 2], k=3), ndcg([1, 0, 2], k=3))
+        self.assertEqual(ndcg([0, 0], k=2), 0.0)
+    
+    def test_hybrid_does_not_regress_dense(self):
+        """Test hybrid ranking matches or beats dense-only ranking on mean nDCG@3 and nDCG@5"""
+        for k in (3, 5):
+            scores = eval_relevance(k)
+            mean = {name: sum(s[name] for s in scores.values()) / len(scores) for name in ('hybrid', 'dense')}
+            with self.subTest(k=k):
+                self.assertGreaterEqual(mean['hybrid'], mean['dense'])
+
+
+class TestBatchRunner(StandInTestCase):
+    """Test cases for running many queries as one batch against the stand-in server"""
+    
+    def run_batch(self, system, queries):
+        runner = medical_search.BatchRunner(system)
+        self.addCleanup(runner.close)
+        self.server.reset_stats()
+        with contextlib.redirect_stdout(io.StringIO()):
+            reports = runner.run(queries, os.path.join(system.cache_dir, "reports"))
+        return runner, reports, {route: stats['requests'] for route, stats in self.server.stats.items()}
+    
+    def test_shared_fetches_and_batched_calls(self):
+        """Test 15 queries take 16 page fetches, 2 embedding requests and 16 completions"""
+        queries = [f"{query} (patient {i})" for i in range(5) for query in DEFAULT_QUERIES]
+        system = self.make_system()
+        runner, reports, requests = self.run_batch(system, queries)
+        
+        self.assertEqual([r['status'] for r in reports], ['success'] * 15)
+        self.assertTrue(all(os.path.exists(r['report']) for r in reports))
+        pages = sum(n for route, n in requests.items() if route not in ('embeddings', 'completions'))
+        self.assertEqual(pages, 16)
+        self.assertEqual(runner.stats['pages_fetched'], 16)
+        self.assertEqual(runner.stats['pages_fetched'] + runner.stats['pages_shared'],
+                         sum(1 for s in system.tracer.spans if s.name.startswith('fetch.')))
+        self.assertEqual(requests['embeddings'], 2)
+        # One batched term call for the queries the lexicon cannot answer, plus one analysis per query
+        self.assertEqual(requests['completions'], 16)
+        self.assertEqual(runner.stats['terms_from_batched_llm'], 10)
+        self.assertEqual(runner.stats['reports'], 15)
+    
+    def test_query_missing_from_batched_answer(self):
+        """Test a query the batched term answer leaves out falls back to its own term call"""
+        system = self.make_system()
+        post = system.session.post
+        
+        def drop_second_answer(url, **kwargs):
+            response = post(url, **kwargs)
+            if "each numbered query" in kwargs['json']['prompt']:
+                text = response.json()['choices'][0]['text']
+                kept = [line for line in text.splitlines() if not line.startswith("2:")]
+                response._content = json.dumps({'choices': [{'text': "\n".join(kept)}]}).encode('utf-8')
+            return response
+        
+        system.session.post = drop_second_answer
+        queries = DEFAULT_QUERIES[1:]
+        runner, reports, requests = self.run_batch(system, queries)
+        
+        self.assertEqual(runner.stats['terms_from_batched_llm'], 1)
+        self.assertEqual([r['status'] for r in reports], ['success'] * 2)
+        # The batched call, a single-query term call for the missing query, and two analyses
+        self.assertEqual(requests['completions'], 4)
+        self.assertEqual(system.term_extraction_stats()['llm_calls'], 2)
+        for query in queries:
+            with self.subTest(query=query):
+                self.assertIsNotNone(system.term_cache.get(medical_search.normalize_query(query))[0])
+    
+    def test_page_memo(self):
+        """Test a URL is fetched once, concurrent callers share it and failures are retried"""
+        memo = medical_search.PageMemo()
+        calls = []
+        release = threading.Event()
+        
+        def fetch(url):
+            calls.append(url)
+            release.wait(5)
+            return f"page {url}"
+        
+        threads = [threading.Thread(target=lambda: results.append(memo.fetch("a", fetch, "a"))) for _ in range(4)]
+        results = []
+        for thread in threads:
+            thread.start()
+        while not calls:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, ["a"])
+        self.assertEqual(sorted(results), [("page a", False)] + [("page a", True)] * 3)
+        self.assertEqual((memo.fetched, memo.shared), (1, 3))
+        
+        def fail(url):
+            raise ConnectionError(url)
+        
+        with self.assertRaises(ConnectionError):
+            memo.fetch("b", fail, "b")
+        self.assertEqual(memo.fetch("b", fetch, "b"), ("page b", False))
+        self.assertEqual(memo.fetched, 3)
+
+
+class TestLocalCorpus(StandInTestCase):
+    """Test cases for answering repeat searches from the local corpus"""
+    
+    def search(self, system, query):
+        self.server.reset_stats()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = system.search_medical_info(query)
+            system.rank_results(query, results)
+        return results, {route for route in self.server.stats if route not in ('embeddings', 'completions')}
+    
+    def test_repeat_query_served_without_scraping(self):
+        """Test every recorded query is answered from the corpus the second time it is asked"""
+        system = self.make_system()
+        for query in DEFAULT_QUERIES:
+            self.search(system, query)
+        self.assertTrue(any(s.name == 'fetch.pubmed_search' for s in system.tracer.spans))
+        
+        for query in DEFAULT_QUERIES:
+            with self.subTest(query=query):
+                results, fetched = self.search(system, query)
+                self.assertEqual(fetched, set())
+                self.assertGreaterEqual(len(results), system.local_min_results)
+                local = [s for s in system.tracer.spans if s.name == 'search.local'][-1]
+                self.assertTrue(local.attributes['cache_hit'])
+    
+    def test_unrelated_query_scrapes(self):
+        """Test a query the corpus does not cover still goes to the sources"""
+        system = self.make_system()
+        self.search(system, DEFAULT_QUERIES[0])
+        _, fetched = self.search(system, "gout flare in the big toe")
+        self.assertIn('pubmed_search', fetched)
+    
+    def test_corpus_persists(self):
+        """Test a new process over the same cache directory answers from the saved corpus"""
+        system = self.make_system()
+        self.search(system, DEFAULT_QUERIES[1])
+        source_urls = {name: self.server.url for name in medical_search.SOURCE_URLS}
+        reloaded = medical_search.MedicalSearchSystem("test_api_key", cache_dir=system.cache_dir,
+                                                      base_url=f"{self.server.url}v1/", source_urls=source_urls,
+                                                      tracer=medical_search.Tracer())
+        _, fetched = self.search(reloaded, DEFAULT_QUERIES[1])
+        self.assertEqual(fetched, set())
+
+
+class TestQueryEmbeddings(SystemTestCase):
+    """Test cases for the query embedding memo"""
+    
+    def test_concurrent_lookups_stay_bounded(self):
+        """Test many threads embedding overlapping queries never fail and never outgrow the memo"""
+        system = self.make_system(query_cache_size=8)
+        system.create_embeddings = lambda texts: [[float(len(t)), 1.0] for t in texts]
+        errors = []
+        def worker(offset):
+            try:
+                for i in range(200):
+                    query = f"query {(i + offset) % 20}"
+                    self.assertEqual(system._embed_query(query), [float(len(query)), 1.0])
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(system._query_embeddings), 8)
+    
+    def test_memo_is_lru(self):
+        """Test a repeated query is served from the memo and recently used queries survive eviction"""
+        system = self.make_system(query_cache_size=2)
+        system.create_embeddings = Mock(side_effect=lambda texts: [[1.0, 0.0] for _ in texts])
+        system._embed_query("a")
+        system._embed_query("b")
+        system._embed_query("a")
+        system._embed_query("c")
+        self.assertEqual(list(system._query_embeddings), ["a", "c"])
+        self.assertEqual(system.create_embeddings.call_count, 3)
+    
+    def test_batch_embedding_is_bounded(self):
+        """Test a batch larger than the memo only embeds what the memo can hold"""
+        system = self.make_system(query_cache_size=4)
+        system.create_embeddings = Mock(side_effect=lambda texts: [[1.0, 0.0] for _ in texts])
+        system.embed_queries([f"query {i}" for i in range(10)] + ["query 0"])
+        
+        self.assertEqual(system.create_embeddings.call_args[0][0], [f"query {i}" for i in range(4)])
+        self.assertEqual(list(system._query_embeddings), [f"query {i}" for i in range(4)])
+
+if __name__ == "__main__":
+    unittest.main()
\ No newline at end of file
@@ -1,15 +1,37 @@
 ﻿import os
+import asyncio
 import base64
+import copy
+import functools
 import json
-from typing import List, Dict, Any, Optional, Union
+from typing import List, Dict, Any, AsyncIterator, Iterator, Optional, Tuple, Union
 from datetime import datetime
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from PIL import Image
 import io
 import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
 from semanticscholar import SemanticScholar
 import arxiv
 from crossref.restful import Works
+from config import Config
+from utils import (
+    AsyncSingleFlight,
+    CacheManager,
+    CitationCache,
+    RateLimiter,
+    SingleFlight,
+    create_cache_backend
+)
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -84,10 +106,35 @@ class ReasoningEngine:
 class CitationSearch:
     """Academic reference search and retrieval system"""
     
-    def __init__(self):
-        self.sch = SemanticScholar()
+    def __init__(
+        self,
+        timeout: Optional[float] = None,
+        source_timeouts: Optional[Dict[str, float]] = None,
+        cache: Optional[CitationCache] = None
+    ):
+        timeout = Config.CITATION_TIMEOUT if timeout is None else timeout
+        self.timeouts = {source: timeout for source in ("semantic_scholar", "arxiv", "crossref")}
+        self.timeouts.update(source_timeouts or {})
+        self.sch = SemanticScholar(timeout=max(1, int(self.timeouts["semantic_scholar"])))
         self.crossref = Works()
         self.arxiv_client = arxiv.Client()
+        # Sized so a source that overruns its timeout does not hold up the next lookup
+        self.executor = ThreadPoolExecutor(max_workers=12, thread_name_prefix="citations")
+        self.rate_limiters = {
+            source: RateLimiter(Config.CITATION_RATE_LIMIT, Config.CITATION_RATE_BURST)
+            for source in self.timeouts
+        }
+        self.cache = cache
+        if cache is None and Config.CITATION_CACHE_ENABLED:
+            try:
+                self.cache = CitationCache(
+                    Config.CITATION_CACHE_PATH,
+                    ttl=Config.CITATION_CACHE_TTL,
+                    negative_ttl=Config.CITATION_CACHE_NEGATIVE_TTL,
+                    max_entries=Config.CITATION_CACHE_MAX_ENTRIES
+                )
+            except Exception as e:
+                logger.warning(f"Citation cache unavailable, searching uncached: {e}")
     
     def search_semantic_scholar(self, query: str, limit: int = 3) -> List[Dict]:
         """Search Semantic Scholar database"""
@@ -144,13 +191,44 @@ class CitationSearch:
             return []
     
     def find_references(self, query: str, limit_per_source: int = 2) -> List[Dict]:
-        """Search across all academic sources"""
+        """Search across all academic sources concurrently; a source past its timeout is skipped"""
+        searches = {
+            "semantic_scholar": self.search_semantic_scholar,
+            "arxiv": self.search_arxiv,
+            "crossref": self.search_crossref
+        }
+        start = time.monotonic()
+        cached = {}
+        futures = {}
+        for source, search in searches.items():
+            if self.cache is not None:
+                cached[source] = self.cache.get(query, source, limit_per_source)
+            if cached.get(source) is None:
+                futures[source] = self.executor.submit(self._search_and_cache, source, search, query, limit_per_source)
+        
         references = []
-        references.extend(self.search_semantic_scholar(query, limit_per_source))
-        references.extend(self.search_arxiv(query, limit_per_source))
-        references.extend(self.search_crossref(query, limit_per_source))
+        # Collected in source order so the citation list stays stable
+        for source in searches:
+            if source not in futures:
+                references.extend(cached[source])
+                continue
+            future = futures[source]
+            remaining = self.timeouts[source] - (time.monotonic() - start)
+            try:
+                references.extend(future.result(timeout=max(remaining, 0)))
+            except FutureTimeoutError:
+                future.cancel()
+                logger.warning(f"{source} search timed out after {self.timeouts[source]}s")
         return references
     
+    def _search_and_cache(self, source: str, search, query: str, limit: int) -> List[Dict]:
+        # Stored even when the caller has already given up on this source, so the next lookup is a hit
+        self.rate_limiters[source].acquire()
+        results = search(query, limit)
+        if self.cache is not None:
+            self.cache.set(query, source, limit, results)
+        return results
+    
     def format_citations(self, references: List[Dict]) -> str:
         """Format references for inclusion in reports"""
         if not references:
@@ -175,12 +253,59 @@ class MultiModalAgent:
     using Qwen2.5-VL-72B-Instruct via Nebius API
     """
 
-    def __init__(self, api_key: str, base_url: str = "https://api.studio.nebius.ai/v1"):
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = "https://api.studio.nebius.ai/v1",
+        limits: Optional[httpx.Limits] = None,
+        http2: Optional[bool] = None,
+        cache: Optional[CacheManager] = None,
+        citation_cache: Optional[CitationCache] = None
+    ):
         self.api_key = api_key
         self.base_url = base_url
         self.model = "Qwen/Qwen2.5-VL-72B-Instruct"
         self.reasoning_engine = ReasoningEngine()
-        self.citation_search = CitationSearch()
+        self.citation_search = CitationSearch(cache=citation_cache)
+
+        # Connection pooling: one keep-alive pool per agent instead of a new connection per call
+        self.limits = limits or httpx.Limits(
+            max_connections=Config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=Config.HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=Config.HTTP_KEEPALIVE_EXPIRY
+        )
+        self.http2 = (Config.HTTP2_ENABLED if http2 is None else http2) and HTTP2_AVAILABLE
+        self.session = requests.Session()
+        self.session.headers.update(self._headers())
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.limits.max_connections or Config.HTTP_MAX_CONNECTIONS
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._async_client: Optional[httpx.AsyncClient] = None
+        # Shared by every call path so concurrent batches stay within the provider's limits
+        self.rate_limiter = RateLimiter(Config.NEBIUS_RATE_LIMIT, Config.NEBIUS_RATE_BURST)
+        # Citation lookups run here alongside the model call
+        self._citation_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="citation-lookup")
+        # Identical requests are answered from here without calling the model
+        self.cache = cache
+        if cache is None and Config.ENABLE_CACHE:
+            self.cache = CacheManager(
+                ttl=Config.CACHE_TTL,
+                backend=create_cache_backend(
+                    Config.CACHE_BACKEND,
+                    max_size=Config.CACHE_SIZE,
+                    max_bytes=Config.CACHE_MAX_BYTES,
+                    path=Config.CACHE_PATH,
+                    url=Config.CACHE_URL,
+                    secret=Config.CACHE_SECRET
+                ),
+                lock_ttl=Config.CACHE_LOCK_TTL
+            )
+        # Concurrent identical requests share one upstream call, with or without the cache
+        self.inflight = SingleFlight()
+        self.ainflight = AsyncSingleFlight()
 
         # Report templates
         self.report_templates = {
@@ -193,6 +318,47 @@ class MultiModalAgent:
             "clinical": self._clinical_template
         }
 
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def _payload(self, messages: List[Dict], max_tokens: int, stream: bool = False) -> Dict[str, Any]:
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": 0.7,
+            "top_p": 0.9
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """Shared async HTTP client, created on first use"""
+        if self._async_client is None or self._async_client.is_closed:
+            self._async_client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self._headers(),
+                limits=self.limits,
+                http2=self.http2,
+                timeout=httpx.Timeout(120, connect=10)
+            )
+        return self._async_client
+
+    def close(self):
+        """Release pooled sync connections"""
+        self.session.close()
+
+    async def aclose(self):
+        """Release pooled async connections"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
     def _encode_image(self, image_data: bytes) -> str:
         """Encode image to base64"""
         return base64.b64encode(image_data).decode('utf-8')
@@ -215,24 +381,11 @@ class MultiModalAgent:
 
     def _call_nebius_api(self, messages: List[Dict], max_tokens: int = 4000) -> str:
         """Make API call to Nebius/Qwen model"""
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-
-        payload = {
-            "model": self.model,
-            "messages": messages,
-            "max_tokens": max_tokens,
-            "temperature": 0.7,
-            "top_p": 0.9
-        }
-
+        self.rate_limiter.acquire()
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=payload,
+                json=self._payload(messages, max_tokens),
                 timeout=120
             )
             response.raise_for_status()
@@ -244,6 +397,77 @@ class MultiModalAgent:
             logger.error(f"API call failed: {e}")
             raise Exception(f"Failed to get response from AI model: {e}")
 
+    def _stream_nebius_api(self, messages: List[Dict], max_tokens: int = 4000) -> Iterator[str]:
+        """Stream the model response, yielding content deltas as they arrive"""
+        self.rate_limiter.acquire()
+        try:
+            with self.session.post(
+                f"{self.base_url}/chat/completions",
+                json=self._payload(messages, max_tokens, stream=True),
+                timeout=120,
+                stream=True
+            ) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    delta = self._parse_stream_line(line)
+                    if delta is None:
+                        break
+                    if delta:
+                        yield delta
+
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Streaming API call failed: {e}")
+            raise Exception(f"Failed to get response from AI model: {e}")
+
+    @staticmethod
+    def _parse_stream_line(line: str) -> Optional[str]:
+        """Content delta from one SSE line: empty for lines without content, None at the end of the stream"""
+        if not line or not line.startswith("data:"):
+            return ""
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return None
+        choices = json.loads(data).get("choices") or [{}]
+        return choices[0].get("delta", {}).get("content") or ""
+
+    async def _acall_nebius_api(self, messages: List[Dict], max_tokens: int = 4000) -> str:
+        """Async API call over the shared connection pool"""
+        await self.rate_limiter.acquire_async()
+        try:
+            response = await self.async_client.post(
+                "/chat/completions",
+                json=self._payload(messages, max_tokens)
+            )
+            response.raise_for_status()
+
+            result = response.json()
+            return result["choices"][0]["message"]["content"]
+
+        except httpx.HTTPError as e:
+            logger.error(f"API call failed: {e}")
+            raise Exception(f"Failed to get response from AI model: {e}")
+
+    async def _astream_nebius_api(self, messages: List[Dict], max_tokens: int = 4000) -> AsyncIterator[str]:
+        """Async variant of _stream_nebius_api"""
+        await self.rate_limiter.acquire_async()
+        try:
+            async with self.async_client.stream(
+                "POST",
+                "/chat/completions",
+                json=self._payload(messages, max_tokens, stream=True)
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    delta = self._parse_stream_line(line)
+                    if delta is None:
+                        break
+                    if delta:
+                        yield delta
+
+        except httpx.HTTPError as e:
+            logger.error(f"Streaming API call failed: {e}")
+            raise Exception(f"Failed to get response from AI model: {e}")
+
     # Report templates with enhanced reasoning
     def _comprehensive_template(self, base_prompt: str) -> str:
         return f"""
@@ -332,6 +556,67 @@ class MultiModalAgent:
     def _clinical_template(self, base_prompt: str) -> str:
         return self.reasoning_engine.apply_reasoning(base_prompt, "clinical")
 
+    def _build_prompt(self, prompt: str, report_type: str, reasoning_mode: str) -> str:
+        """Apply the reasoning framework and the report template"""
+        reasoned_prompt = self.reasoning_engine.apply_reasoning(prompt, reasoning_mode)
+        if report_type in self.report_templates:
+            return self.report_templates[report_type](reasoned_prompt)
+        return reasoned_prompt
+
+    def _wants_citations(self, report_type: str, include_citations: bool) -> bool:
+        return include_citations and report_type in ["research", "technical", "scientific"]
+
+    def _cache_key(
+        self,
+        prompt: str,
+        images: Optional[List[bytes]],
+        report_type: str,
+        reasoning_mode: str,
+        include_citations: bool
+    ) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return CacheManager.make_key(prompt, images, report_type, reasoning_mode, include_citations)
+
+    def _cached_result(self, cache_key: Optional[str]) -> Optional[Dict[str, Any]]:
+        if cache_key is None or self.cache is None:
+            return None
+        result = self.cache.lookup(cache_key)
+        if result is not None:
+            logger.info("Serving cached report")
+            result["metadata"]["cached"] = True
+        return result
+
+    def _cache_result(self, cache_key: Optional[str], result: Dict[str, Any]):
+        # Failures are not cached so a transient API error is retried on the next request
+        if cache_key is not None and self.cache is not None and result.get("success"):
+            self.cache.store(cache_key, result)
+
+    def _start_citations(self, prompt: str, report_type: str, include_citations: bool) -> Optional[Future]:
+        """Begin the citation lookup in the background so it overlaps the model call"""
+        if not self._wants_citations(report_type, include_citations):
+            return None
+        return self._citation_pool.submit(self.citation_search.find_references, prompt)
+
+    def _result_metadata(
+        self,
+        prompt: str,
+        images: Optional[List[bytes]],
+        report_type: str,
+        reasoning_mode: str,
+        references: List[Dict]
+    ) -> Dict[str, Any]:
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "report_type": report_type,
+            "reasoning_mode": reasoning_mode,
+            "model": self.model,
+            "has_images": bool(images),
+            "num_images": len(images) if images else 0,
+            "original_prompt": prompt,
+            "citation_count": len(references)
+        }
+
     def process_request(
         self,
         prompt: str,
@@ -345,45 +630,178 @@ class MultiModalAgent:
         Enhanced processing with reasoning and citations
         """
         try:
-            # Apply reasoning framework
-            reasoned_prompt = self.reasoning_engine.apply_reasoning(prompt, reasoning_mode)
+            request_key = CacheManager.make_key(prompt, images, report_type, reasoning_mode, include_citations)
+            generate = functools.partial(
+                self._generate_report, prompt, images, report_type, reasoning_mode, include_citations
+            )
 
-            # Apply report template
-            if report_type in self.report_templates:
-                enhanced_prompt = self.report_templates[report_type](reasoned_prompt)
-            else:
-                enhanced_prompt = reasoned_prompt
+            def compute():
+                if self.cache is None:
+                    return generate()
+                # Identical requests on other replicas wait for that result instead of calling the model
+                result, cached = self.cache.get_or_compute(request_key, generate)
+                if cached:
+                    logger.info("Serving cached report")
+                    result["metadata"]["cached"] = True
+                return result
 
-            # Prepare messages
-            messages = self._prepare_messages(enhanced_prompt, images)
+            result, shared = self.inflight.do(request_key, compute)
+            return self._shared_copy(result) if shared else result
 
-            # Get AI response
-            logger.info(f"Processing {report_type} report with {reasoning_mode} reasoning")
-            response = self._call_nebius_api(messages, max_tokens=6000)
+        except Exception as e:
+            logger.error(f"Error processing request: {e}")
+            return {
+                "success": False,
+                "error": str(e),
+                "metadata": {
+                    "timestamp": datetime.now().isoformat(),
+                    "report_type": report_type,
+                    "original_prompt": prompt
+                }
+            }
 
-            # Add citations if requested
-            if include_citations and report_type in ["research", "technical", "scientific"]:
-                references = self.citation_search.find_references(prompt)
-                response += self.citation_search.format_citations(references)
+    def _shared_copy(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        """Give a caller that joined another request's call its own copy of the result"""
+        logger.info("Joined an identical in-flight request")
+        result = copy.deepcopy(result)
+        result["metadata"]["coalesced"] = True
+        return result
+
+    def _generate_report(
+        self,
+        prompt: str,
+        images: Optional[List[bytes]],
+        report_type: str,
+        reasoning_mode: str,
+        include_citations: bool
+    ) -> Dict[str, Any]:
+        """Run the model and citation lookup for one request; raises on failure"""
+        # Apply reasoning framework and report template
+        enhanced_prompt = self._build_prompt(prompt, report_type, reasoning_mode)
+
+        # Prepare messages
+        messages = self._prepare_messages(enhanced_prompt, images)
+
+        # Search citations while the model works
+        citations = self._start_citations(prompt, report_type, include_citations)
+
+        # Get AI response
+        logger.info(f"Processing {report_type} report with {reasoning_mode} reasoning")
+        response = self._call_nebius_api(messages, max_tokens=6000)
+
+        # Add citations if requested
+        references = []
+        if citations is not None:
+            references = citations.result()
+            response += self.citation_search.format_citations(references)
+
+        # Prepare result
+        result = {
+            "success": True,
+            "report": response,
+            "metadata": self._result_metadata(prompt, images, report_type, reasoning_mode, references)
+        }
+
+        logger.info("Request processed successfully")
+        return result
+
+    def process_request_stream(
+        self,
+        prompt: str,
+        images: Optional[List[bytes]] = None,
+        report_type: str = "comprehensive",
+        reasoning_mode: str = "standard",
+        include_citations: bool = True,
+        **kwargs
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Streaming variant of process_request: yields progress and token events,
+        then a final {"type": "result"} event with the same shape process_request returns
+        """
+        try:
+            cache_key = self._cache_key(prompt, images, report_type, reasoning_mode, include_citations)
+            cached = self._cached_result(cache_key)
+            if cached is not None:
+                yield {"type": "token", "text": cached["report"]}
+                yield {"type": "result", "result": cached}
+                return
+
+            enhanced_prompt = self._build_prompt(prompt, report_type, reasoning_mode)
+            messages = self._prepare_messages(enhanced_prompt, images)
+            citations = self._start_citations(prompt, report_type, include_citations)
+            yield {"type": "progress", "stage": "prompt built"}
+
+            logger.info(f"Streaming {report_type} report with {reasoning_mode} reasoning")
+            parts = []
+            for delta in self._stream_nebius_api(messages, max_tokens=6000):
+                if not parts:
+                    yield {"type": "progress", "stage": "model streaming"}
+                parts.append(delta)
+                yield {"type": "token", "text": delta}
+            response = "".join(parts)
+
+            references = []
+            if citations is not None:
+                references = citations.result()
+                citation_text = self.citation_search.format_citations(references)
+                response += citation_text
+                yield {"type": "progress", "stage": "citations fetched", "count": len(references)}
+                yield {"type": "token", "text": citation_text}
 
-            # Prepare result
             result = {
                 "success": True,
                 "report": response,
-                "metadata": {
-                    "timestamp": datetime.now().isoformat(),
-                    "report_type": report_type,
-                    "reasoning_mode": reasoning_mode,
-                    "model": self.model,
-                    "has_images": bool(images),
-                    "num_images": len(images) if images else 0,
-                    "original_prompt": prompt,
-                    "citation_count": len(references) if include_citations else 0
+                "metadata": self._result_metadata(prompt, images, report_type, reasoning_mode, references)
+            }
+            self._cache_result(cache_key, result)
+            yield {"type": "result", "result": result}
+
+        except Exception as e:
+            logger.error(f"Error streaming request: {e}")
+            yield {
+                "type": "result",
+                "result": {
+                    "success": False,
+                    "error": str(e),
+                    "metadata": {
+                        "timestamp": datetime.now().isoformat(),
+                        "report_type": report_type,
+                        "original_prompt": prompt
+                    }
                 }
             }
 
-            logger.info("Request processed successfully")
-            return result
+    async def aprocess_request(
+        self,
+        prompt: str,
+        images: Optional[List[bytes]] = None,
+        report_type: str = "comprehensive",
+        reasoning_mode: str = "standard",
+        include_citations: bool = True,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Async variant of process_request using the pooled async client
+        """
+        try:
+            request_key = CacheManager.make_key(prompt, images, report_type, reasoning_mode, include_citations)
+
+            generate = functools.partial(
+                self._agenerate_report, prompt, images, report_type, reasoning_mode, include_citations
+            )
+
+            async def compute():
+                if self.cache is None:
+                    return await generate()
+                # Same fleet-wide coalescing as process_request, without blocking the loop on the backend
+                result, cached = await self.cache.aget_or_compute(request_key, generate)
+                if cached:
+                    logger.info("Serving cached report")
+                    result["metadata"]["cached"] = True
+                return result
+
+            result, shared = await self.ainflight.do(request_key, compute)
+            return self._shared_copy(result) if shared else result
 
         except Exception as e:
             logger.error(f"Error processing request: {e}")
@@ -397,6 +815,104 @@ class MultiModalAgent:
                 }
             }
 
+    async def _agenerate_report(
+        self,
+        prompt: str,
+        images: Optional[List[bytes]],
+        report_type: str,
+        reasoning_mode: str,
+        include_citations: bool
+    ) -> Dict[str, Any]:
+        """Async variant of _generate_report"""
+        enhanced_prompt = self._build_prompt(prompt, report_type, reasoning_mode)
+        messages = self._prepare_messages(enhanced_prompt, images)
+
+        # The citation clients are synchronous libraries, so the lookup runs on the pool
+        citations = self._start_citations(prompt, report_type, include_citations)
+
+        logger.info(f"Processing {report_type} report with {reasoning_mode} reasoning")
+        response = await self._acall_nebius_api(messages, max_tokens=6000)
+
+        references = []
+        if citations is not None:
+            references = await asyncio.wrap_future(citations)
+            response += self.citation_search.format_citations(references)
+
+        result = {
+            "success": True,
+            "report": response,
+            "metadata": self._result_metadata(prompt, images, report_type, reasoning_mode, references)
+        }
+
+        logger.info("Request processed successfully")
+        return result
+
+    async def aprocess_request_stream(
+        self,
+        prompt: str,
+        images: Optional[List[bytes]] = None,
+        report_type: str = "comprehensive",
+        reasoning_mode: str = "standard",
+        include_citations: bool = True,
+        **kwargs
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Async variant of process_request_stream
+        """
+        try:
+            cache_key = self._cache_key(prompt, images, report_type, reasoning_mode, include_citations)
+            # Cache backends may do disk or network I/O, so they run off the event loop
+            cached = await asyncio.to_thread(self._cached_result, cache_key)
+            if cached is not None:
+                yield {"type": "token", "text": cached["report"]}
+                yield {"type": "result", "result": cached}
+                return
+
+            enhanced_prompt = self._build_prompt(prompt, report_type, reasoning_mode)
+            messages = self._prepare_messages(enhanced_prompt, images)
+            citations = self._start_citations(prompt, report_type, include_citations)
+            yield {"type": "progress", "stage": "prompt built"}
+
+            logger.info(f"Streaming {report_type} report with {reasoning_mode} reasoning")
+            parts = []
+            async for delta in self._astream_nebius_api(messages, max_tokens=6000):
+                if not parts:
+                    yield {"type": "progress", "stage": "model streaming"}
+                parts.append(delta)
+                yield {"type": "token", "text": delta}
+            response = "".join(parts)
+
+            references = []
+            if citations is not None:
+                references = await asyncio.wrap_future(citations)
+                citation_text = self.citation_search.format_citations(references)
+                response += citation_text
+                yield {"type": "progress", "stage": "citations fetched", "count": len(references)}
+                yield {"type": "token", "text": citation_text}
+
+            result = {
+                "success": True,
+                "report": response,
+                "metadata": self._result_metadata(prompt, images, report_type, reasoning_mode, references)
+            }
+            await asyncio.to_thread(self._cache_result, cache_key, result)
+            yield {"type": "result", "result": result}
+
+        except Exception as e:
+            logger.error(f"Error streaming request: {e}")
+            yield {
+                "type": "result",
+                "result": {
+                    "success": False,
+                    "error": str(e),
+                    "metadata": {
+                        "timestamp": datetime.now().isoformat(),
+                        "report_type": report_type,
+                        "original_prompt": prompt
+                    }
+                }
+            }
+
     def analyze_image(self, image_data: bytes, prompt: str = "Describe this image in detail") -> Dict[str, Any]:
         """Enhanced image analysis with reasoning"""
         return self.process_request(
@@ -406,18 +922,45 @@ class MultiModalAgent:
             reasoning_mode="chain_of_thought"
         )
 
-    def batch_analyze(self, requests: List[Dict]) -> List[Dict[str, Any]]:
-        """Process multiple requests with consistent reasoning"""
-        results = []
-        for req in requests:
-            result = self.process_request(
+    def _batch_item(self, req: Dict) -> Dict[str, Any]:
+        """Run one batch request; a failure becomes that item's result instead of aborting the batch"""
+        try:
+            return self.process_request(
                 req.get("prompt", ""),
                 images=req.get("images"),
                 report_type=req.get("report_type", "comprehensive"),
                 reasoning_mode=req.get("reasoning_mode", "standard"),
                 include_citations=req.get("include_citations", True)
             )
-            results.append(result)
+        except Exception as e:
+            logger.error(f"Batch item failed: {e}")
+            return {
+                "success": False,
+                "error": str(e),
+                "metadata": {"timestamp": datetime.now().isoformat()}
+            }
+
+    def iter_batch_analyze(
+        self,
+        requests: List[Dict],
+        max_workers: Optional[int] = None
+    ) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """Process requests concurrently, yielding (index, result) pairs as each one completes"""
+        max_workers = max_workers or Config.BATCH_MAX_WORKERS
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="batch")
+        try:
+            futures = {executor.submit(self._batch_item, req): i for i, req in enumerate(requests)}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # Closing the iterator early drops the requests that have not started yet
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def batch_analyze(self, requests: List[Dict], max_workers: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Process multiple requests concurrently, returning results in request order"""
+        results = [None] * len(requests)
+        for i, result in self.iter_batch_analyze(requests, max_workers):
+            results[i] = result
         return results
 
     def search_references(self, query: str, limit: int = 5) -> Dict[str, Any]:
@@ -1,4 +1,6 @@
 ﻿import modal
+import asyncio
+import copy
 import os
 import sys
 import base64
@@ -11,6 +13,8 @@ from datetime import datetime
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from config import Config
+from utils import AsyncSingleFlight, CacheManager, create_cache_backend
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -31,6 +35,7 @@ image = (
         "arxiv>=2.1.0",
         "crossrefapi>=1.0.0"
     ])
+    .add_local_python_source("config", "utils")
 )
 
 class MultiModalAgent:
@@ -283,6 +288,23 @@ def serve_api():
 
     valid_report_types = ["comprehensive", "technical", "executive", "research"]
 
+    # Response cache: identical requests skip the remote agent call. With CACHE_BACKEND=http
+    # every replica shares one cache and concurrent identical requests make a single call
+    response_cache = CacheManager(
+        ttl=Config.CACHE_TTL,
+        backend=create_cache_backend(
+            Config.CACHE_BACKEND,
+            max_size=Config.CACHE_SIZE,
+            max_bytes=Config.CACHE_MAX_BYTES,
+            path=Config.CACHE_PATH,
+            url=Config.CACHE_URL,
+            secret=Config.CACHE_SECRET
+        ),
+        lock_ttl=Config.CACHE_LOCK_TTL
+    ) if Config.ENABLE_CACHE else None
+    # Concurrent identical submissions to this replica (UI retries, shared uploads) share one call
+    inflight = AsyncSingleFlight()
+
     @api.post("/analyze")
     async def analyze(
         prompt: str = Form(...),
@@ -321,25 +343,44 @@ def serve_api():
                         )
                     image_data.append(content)
 
-            # Call the agent function
-            result = run_agent.remote(
-                prompt=prompt,
-                images=image_data if image_data else None,
-                report_type=report_type
-            )
-            
-            # Ensure proper response format
-            if not isinstance(result, dict):
-                raise HTTPException(
-                    status_code=500,
-                    detail="Invalid response format from agent"
+            def generate():
+                # Call the agent function
+                result = run_agent.remote(
+                    prompt=prompt,
+                    images=image_data if image_data else None,
+                    report_type=report_type
                 )
                 
-            if not result.get("success"):
-                raise HTTPException(
-                    status_code=500,
-                    detail=result.get("error", "Analysis failed")
-                )
+                # Ensure proper response format
+                if not isinstance(result, dict):
+                    raise HTTPException(
+                        status_code=500,
+                        detail="Invalid response format from agent"
+                    )
+                    
+                # Raising keeps failed analyses out of the cache
+                if not result.get("success"):
+                    raise HTTPException(
+                        status_code=500,
+                        detail=result.get("error", "Analysis failed")
+                    )
+                return result
+
+            request_key = CacheManager.make_key(prompt, image_data, report_type)
+
+            async def compute():
+                # The remote call and waiting on the cache lock both block, so they run off the event loop
+                if response_cache is None:
+                    return await asyncio.to_thread(generate)
+                result, cached = await asyncio.to_thread(response_cache.get_or_compute, request_key, generate)
+                if cached:
+                    result["metadata"]["cached"] = True
+                return result
+
+            result, shared = await inflight.do(request_key, compute)
+            if shared:
+                result = copy.deepcopy(result)
+                result["metadata"]["coalesced"] = True
                 
             return JSONResponse(result)
 
@@ -0,0 +1,207 @@
+﻿import argparse
+import hmac
+import json
+import logging
+import math
+import os
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from utils import CacheBackend, MemoryCacheBackend, SQLiteCacheBackend
+
+logger = logging.getLogger(__name__)
+
+# Largest entry accepted on PUT; anything bigger is refused before it is read
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+class BadRequest(ValueError):
+    """A header the cache protocol cannot accept"""
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    """HTTP protocol for HTTPCacheBackend: /cache/<key> entries and /locks/<key> compute locks"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    @property
+    def backend(self) -> CacheBackend:
+        return self.server.backend
+
+    def _reply(self, status: int, body: bytes = b"", headers: Optional[dict] = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reject(self, status: int):
+        # The request body may be unread, so the connection cannot be reused
+        self.close_connection = True
+        self._reply(status, headers={"Connection": "close"})
+
+    def _authorized(self) -> bool:
+        secret = self.headers.get("X-Cache-Secret", "")
+        if hmac.compare_digest(secret.encode(), self.server.secret.encode()):
+            return True
+        self._reject(401)
+        return False
+
+    def _ttl(self, header: str, default: Optional[float] = None) -> Optional[float]:
+        value = self.headers.get(header)
+        if value is None:
+            return default
+        try:
+            ttl = float(value)
+        except ValueError:
+            raise BadRequest(f"{header} must be a number")
+        if not math.isfinite(ttl) or ttl <= 0:
+            raise BadRequest(f"{header} must be a positive number of seconds")
+        return ttl
+
+    def _content_length(self) -> int:
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            raise BadRequest("Content-Length is required")
+        if length < 0:
+            raise BadRequest("Content-Length must not be negative")
+        return length
+
+    def _route(self):
+        parts = self.path.strip("/").split("/")
+        return parts[0], parts[1] if len(parts) > 1 else None
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        resource, key = self._route()
+        if resource == "cache" and key:
+            value = self.backend.get(key)
+            if value is None:
+                self._reply(404)
+            else:
+                self._reply(200, value, {"Content-Type": "application/json"})
+        elif resource == "stats":
+            self._reply(200, json.dumps(self.backend.stats()).encode(), {"Content-Type": "application/json"})
+        else:
+            self._reply(404)
+
+    def do_PUT(self):
+        if not self._authorized():
+            return
+        resource, key = self._route()
+        if resource != "cache" or not key:
+            self._reject(404)
+            return
+        try:
+            length = self._content_length()
+            ttl = self._ttl("X-Cache-TTL")
+        except BadRequest as e:
+            logger.debug(f"Rejected PUT {key}: {e}")
+            self._reject(400)
+            return
+        if length > self.server.max_body:
+            self._reject(413)
+            return
+        self.backend.set(key, self.rfile.read(length), ttl)
+        self._reply(204)
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        resource, key = self._route()
+        if resource != "locks" or not key:
+            self._reply(404)
+            return
+        try:
+            ttl = self._ttl("X-Lock-TTL", 300.0)
+        except BadRequest as e:
+            logger.debug(f"Rejected lock {key}: {e}")
+            self._reject(400)
+            return
+        token = self.backend.acquire_lock(key, ttl)
+        if token is None:
+            self._reply(409)
+        else:
+            self._reply(201, headers={"X-Lock-Token": token})
+
+    def do_DELETE(self):
+        if not self._authorized():
+            return
+        resource, key = self._route()
+        if resource == "cache":
+            if key:
+                self.backend.delete(key)
+            else:
+                self.backend.clear()
+        elif resource == "locks" and key:
+            self.backend.release_lock(key, self.headers.get("X-Lock-Token", ""))
+        else:
+            self._reply(404)
+            return
+        self._reply(204)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+class CacheServer(ThreadingHTTPServer):
+    """Shared response cache for a fleet of API replicas; every request must carry the shared secret"""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        backend: Optional[CacheBackend] = None,
+        secret: Optional[str] = None,
+        max_body: int = MAX_BODY_BYTES
+    ):
+        self.backend = backend or MemoryCacheBackend(max_size=10000, max_bytes=512 * 1024 * 1024)
+        # Without a configured secret, only clients handed self.secret in-process can connect
+        self.secret = secret or secrets.token_urlsafe(32)
+        self.max_body = max_body
+        super().__init__((host, port), CacheRequestHandler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "CacheServer":
+        """Serve from a background thread"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def run_cache_server(
+    host: str = "127.0.0.1",
+    port: int = 8090,
+    path: Optional[str] = None,
+    secret: Optional[str] = None,
+    max_body: int = MAX_BODY_BYTES
+):
+    """Run the cache server"""
+    secret = secret or os.getenv("CACHE_SECRET")
+    if not secret:
+        raise ValueError("Set CACHE_SECRET to the shared secret the replicas send")
+    backend = SQLiteCacheBackend(path, max_size=10000, max_bytes=512 * 1024 * 1024) if path else None
+    server = CacheServer(host, port, backend, secret, max_body)
+    logger.info(f"Cache server starting on {host}:{port}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Shared response cache for multi-replica deployments")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to bind; the replicas must be able to reach it")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--path", help="SQLite file to persist entries; in memory when omitted")
+    parser.add_argument("--max-body-mb", type=int, default=MAX_BODY_BYTES // (1024 * 1024),
+                        help="Largest cache entry accepted")
+    args = parser.parse_args()
+    run_cache_server(args.host, args.port, args.path, max_body=args.max_body_mb * 1024 * 1024)
\ No newline at end of file
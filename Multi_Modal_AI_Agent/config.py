@@ -21,9 +21,40 @@ class Config:
     MAX_PROMPT_LENGTH = int(os.getenv("MAX_PROMPT_LENGTH", "10000"))
     REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "300"))  # 5 minutes
     
+    # Batch Processing and Rate Limits (requests per second; 0 disables)
+    BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", "4"))
+    NEBIUS_RATE_LIMIT = float(os.getenv("NEBIUS_RATE_LIMIT", "5"))
+    NEBIUS_RATE_BURST = int(os.getenv("NEBIUS_RATE_BURST", "10"))
+    CITATION_RATE_LIMIT = float(os.getenv("CITATION_RATE_LIMIT", "1"))  # per source
+    CITATION_RATE_BURST = int(os.getenv("CITATION_RATE_BURST", "3"))
+    
+    # HTTP Connection Pool
+    HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+    HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+    HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+    HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true"
+    
+    # Citation Search
+    CITATION_TIMEOUT = float(os.getenv("CITATION_TIMEOUT", "10"))  # per source, in seconds
+    CITATION_CACHE_ENABLED = os.getenv("CITATION_CACHE_ENABLED", "true").lower() == "true"
+    CITATION_CACHE_PATH = os.getenv(
+        "CITATION_CACHE_PATH", str(Path.home() / ".cache" / "multimodal_agent" / "citations.db")
+    )
+    CITATION_CACHE_TTL = float(os.getenv("CITATION_CACHE_TTL", "86400"))  # 1 day
+    CITATION_CACHE_NEGATIVE_TTL = float(os.getenv("CITATION_CACHE_NEGATIVE_TTL", "3600"))  # 1 hour
+    CITATION_CACHE_MAX_ENTRIES = int(os.getenv("CITATION_CACHE_MAX_ENTRIES", "5000"))
+    
     # Cache Configuration
     ENABLE_CACHE = os.getenv("ENABLE_CACHE", "true").lower() == "true"
     CACHE_SIZE = int(os.getenv("CACHE_SIZE", "100"))
+    CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_MB", "64")) * 1024 * 1024
+    CACHE_TTL = float(os.getenv("CACHE_TTL", "3600"))  # seconds; 0 keeps entries until evicted
+    # "memory" (per process), "sqlite" (per host) or "http" (shared by every replica via cache_server.py)
+    CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+    CACHE_PATH = os.getenv("CACHE_PATH", str(Path.home() / ".cache" / "multimodal_agent" / "responses.db"))
+    CACHE_URL = os.getenv("CACHE_URL")
+    CACHE_SECRET = os.getenv("CACHE_SECRET")  # shared with cache_server.py
+    CACHE_LOCK_TTL = float(os.getenv("CACHE_LOCK_TTL", os.getenv("REQUEST_TIMEOUT", "300")))
     
     # UI Configuration
     UI_PORT = int(os.getenv("UI_PORT", "8000"))
@@ -47,6 +78,13 @@ class Config:
         if cls.MAX_PROMPT_LENGTH <= 0:
             issues.append("MAX_PROMPT_LENGTH must be positive")
         
+        if cls.CACHE_BACKEND not in ("memory", "sqlite", "http"):
+            issues.append("CACHE_BACKEND must be memory, sqlite or http")
+        elif cls.CACHE_BACKEND == "http" and not cls.CACHE_URL:
+            issues.append("CACHE_URL is required for the http cache backend")
+        if cls.CACHE_BACKEND == "http" and not cls.CACHE_SECRET:
+            issues.append("CACHE_SECRET is required for the http cache backend")
+        
         return {
             "valid": len(issues) == 0,
             "issues": issues
@@ -68,10 +106,30 @@ class Config:
                 "max_image_size": cls.MAX_IMAGE_SIZE,
                 "max_prompt_length": cls.MAX_PROMPT_LENGTH,
                 "request_timeout": cls.REQUEST_TIMEOUT,
+                "citation_timeout": cls.CITATION_TIMEOUT,
+                "batch_max_workers": cls.BATCH_MAX_WORKERS,
+                "nebius_rate_limit": cls.NEBIUS_RATE_LIMIT,
+                "citation_rate_limit": cls.CITATION_RATE_LIMIT,
+            },
+            "http": {
+                "max_connections": cls.HTTP_MAX_CONNECTIONS,
+                "max_keepalive": cls.HTTP_MAX_KEEPALIVE,
+                "keepalive_expiry": cls.HTTP_KEEPALIVE_EXPIRY,
+                "http2": cls.HTTP2_ENABLED,
             },
             "cache": {
                 "enabled": cls.ENABLE_CACHE,
                 "size": cls.CACHE_SIZE,
+                "max_bytes": cls.CACHE_MAX_BYTES,
+                "ttl": cls.CACHE_TTL,
+                "backend": cls.CACHE_BACKEND,
+                "citations": {
+                    "enabled": cls.CITATION_CACHE_ENABLED,
+                    "path": cls.CITATION_CACHE_PATH,
+                    "ttl": cls.CITATION_CACHE_TTL,
+                    "negative_ttl": cls.CITATION_CACHE_NEGATIVE_TTL,
+                    "max_entries": cls.CITATION_CACHE_MAX_ENTRIES,
+                },
             },
             "ports": {
                 "ui": cls.UI_PORT,
@@ -1,4 +1,5 @@
 ﻿import asyncio
+import functools
 import json
 import logging
 from typing import Dict, Any, List, Optional
@@ -8,38 +9,181 @@ from agent import MultiModalAgent
 
 logger = logging.getLogger(__name__)
 
+class ClientSession:
+    """Per-connection state: in-flight requests by id, the analysis limit and the outgoing queue"""
+    
+    def __init__(self, websocket, max_in_flight: int = 4, send_queue_size: int = 64):
+        self.websocket = websocket
+        self.requests = {}
+        self.tasks = set()
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.outbox = asyncio.Queue(maxsize=send_queue_size)
+        self.closed = False
+        self.writer = asyncio.create_task(self._write())
+    
+    async def send(self, message: Dict[str, Any]):
+        """Queue a message; waits while the queue is full so a slow reader throttles its own requests"""
+        if not self.closed:
+            await self.outbox.put(message)
+    
+    async def _write(self):
+        """Drain the outgoing queue onto the socket in completion order"""
+        try:
+            while True:
+                message = await self.outbox.get()
+                await self.websocket.send(json.dumps(message))
+        except websockets.exceptions.ConnectionClosed:
+            self.closed = True
+            logger.info("MCP client closed before all responses were sent")
+    
+    def close(self):
+        """Cancel every pending request and stop writing"""
+        self.closed = True
+        for task in list(self.tasks):
+            task.cancel()
+        self.writer.cancel()
+
 class MCPServer:
     """MCP Server for multi-modal AI agent"""
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, max_in_flight: int = 4, send_queue_size: int = 64):
         self.agent = MultiModalAgent(api_key)
         self.connections = set()
+        self.sessions = {}
+        self.max_in_flight = max_in_flight
+        self.send_queue_size = send_queue_size
     
     async def register_connection(self, websocket):
         """Register a new client connection"""
         self.connections.add(websocket)
+        self._session(websocket)
         logger.info(f"New MCP client connected. Total connections: {len(self.connections)}")
     
     async def unregister_connection(self, websocket):
         """Unregister a client connection"""
         self.connections.discard(websocket)
+        session = self.sessions.pop(websocket, None)
+        if session:
+            session.close()
         logger.info(f"MCP client disconnected. Total connections: {len(self.connections)}")
     
+    def _session(self, websocket) -> ClientSession:
+        if websocket not in self.sessions:
+            self.sessions[websocket] = ClientSession(websocket, self.max_in_flight, self.send_queue_size)
+        return self.sessions[websocket]
+    
+    async def run_analysis(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Run the agent on its pooled async client; no thread is held while the model works"""
+        return await self.agent.aprocess_request(**params)
+    
+    async def run_analysis_stream(self, session: ClientSession, msg_id, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Forward the agent's stream events as notifications for msg_id and return the final result"""
+        events = self.agent.aprocess_request_stream(**params)
+        try:
+            async for event in events:
+                if event["type"] == "result":
+                    return event["result"]
+                # Waits while the send queue is full, so a slow reader slows the stream down
+                await session.send(self._notification(msg_id, event))
+        finally:
+            await events.aclose()
+    
+    def _notification(self, msg_id, event: Dict[str, Any]) -> Dict[str, Any]:
+        """Wrap an agent stream event as a JSON-RPC notification tied to the request id"""
+        if event["type"] == "token":
+            return {"method": "notifications/token", "params": {"requestId": msg_id, "delta": event["text"]}}
+        params = {key: value for key, value in event.items() if key != "type"}
+        return {"method": "notifications/progress", "params": {"requestId": msg_id, **params}}
+    
     async def handle_message(self, websocket, message: str):
         """Handle incoming MCP messages"""
+        task = await self.dispatch(self._session(websocket), message)
+        if task is not None:
+            await task
+    
+    async def dispatch(self, session: ClientSession, message: str) -> Optional[asyncio.Task]:
+        """Start a task for one request, keyed by its id; cancellations are applied immediately"""
         try:
             data = json.loads(message)
+        except json.JSONDecodeError:
+            error_response = {
+                "error": {"code": -32700, "message": "Parse error"}
+            }
+            await session.send(error_response)
+            return None
+        
+        # Batches and bare values are valid JSON but not requests; answering keeps the connection open
+        if not isinstance(data, dict):
+            await session.send({"error": {"code": -32600, "message": "Invalid Request"}})
+            return None
+        
+        method = data.get("method")
+        msg_id = data.get("id")
+        params = data.get("params", {})
+        if not isinstance(params, dict):
+            await session.send({"id": msg_id, "error": {"code": -32602, "message": "Invalid params"}})
+            return None
+        
+        if method in ("cancel", "notifications/cancelled"):
+            cancelled = self.cancel_request(session, params.get("id", params.get("requestId")))
+            if msg_id is not None:
+                await session.send({"id": msg_id, "result": {"cancelled": cancelled}})
+            return None
+        
+        if msg_id is not None and msg_id in session.requests:
+            await session.send({
+                "id": msg_id,
+                "error": {"code": -32600, "message": f"Request id {msg_id} is already in flight"}
+            })
+            return None
+        
+        task = asyncio.create_task(self.handle_request(session, data))
+        session.tasks.add(task)
+        task.add_done_callback(session.tasks.discard)
+        if msg_id is not None:
+            session.requests[msg_id] = task
+            task.add_done_callback(functools.partial(self._request_done, session, msg_id))
+        return task
+    
+    def _request_done(self, session: ClientSession, msg_id, task: asyncio.Task):
+        session.requests.pop(msg_id, None)
+        # Answer here rather than in handle_request: a task cancelled before it first runs never enters its body
+        if task.cancelled() and not session.closed:
+            reply = asyncio.ensure_future(session.send({
+                "id": msg_id,
+                "error": {"code": -32800, "message": "Request cancelled"}
+            }))
+            session.tasks.add(reply)
+            reply.add_done_callback(session.tasks.discard)
+    
+    def cancel_request(self, session: ClientSession, msg_id) -> bool:
+        """Cancel an in-flight request by id; a model call already running finishes but its result is dropped"""
+        task = session.requests.get(msg_id)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+    
+    async def handle_request(self, session: ClientSession, data: Dict[str, Any]):
+        """Run one request and queue its response as soon as it completes"""
+        msg_id = data.get("id")
+        try:
             method = data.get("method")
             params = data.get("params", {})
-            msg_id = data.get("id")
             
             if method == "analyze":
-                # Process analysis request
-                result = self.agent.process_request(**params)
-                response = {
-                    "id": msg_id,
-                    "result": result
-                }
+                # The slot is held until the response is queued, so a client that stops
+                # reading its responses stops getting new analyses started
+                async with session.in_flight:
+                    if params.pop("stream", False):
+                        result = await self.run_analysis_stream(session, msg_id, params)
+                    else:
+                        result = await self.run_analysis(params)
+                    await session.send({
+                        "id": msg_id,
+                        "result": result
+                    })
+                return
             elif method == "ping":
                 response = {
                     "id": msg_id,
@@ -51,26 +195,21 @@ class MCPServer:
                     "error": {"code": -32601, "message": f"Method '{method}' not found"}
                 }
             
-            await websocket.send(json.dumps(response))
-            
-        except json.JSONDecodeError:
-            error_response = {
-                "error": {"code": -32700, "message": "Parse error"}
-            }
-            await websocket.send(json.dumps(error_response))
         except Exception as e:
-            error_response = {
-                "id": data.get("id") if 'data' in locals() else None,
+            response = {
+                "id": msg_id,
                 "error": {"code": -32603, "message": f"Internal error: {str(e)}"}
             }
-            await websocket.send(json.dumps(error_response))
+        await session.send(response)
     
-    async def client_handler(self, websocket, path):
+    async def client_handler(self, websocket, path=None):
         """Handle individual client connections"""
         await self.register_connection(websocket)
+        session = self._session(websocket)
         try:
+            # Requests are multiplexed: each runs in its own task and responses go out as they complete
             async for message in websocket:
-                await self.handle_message(websocket, message)
+                await self.dispatch(session, message)
         except websockets.exceptions.ConnectionClosed:
             pass
         finally:
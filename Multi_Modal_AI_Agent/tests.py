@@ -1,9 +1,24 @@
 ﻿import unittest
-from unittest.mock import Mock, patch
+from unittest.mock import MagicMock, Mock, patch
+import asyncio
 import json
 import io
+import time
 from PIL import Image
 
+# Agents built with the default Config would open the citation cache under the user's home directory
+_citation_cache_patch = None
+
+def setUpModule():
+    global _citation_cache_patch
+    from config import Config
+    
+    _citation_cache_patch = patch.object(Config, "CITATION_CACHE_ENABLED", False)
+    _citation_cache_patch.start()
+
+def tearDownModule():
+    _citation_cache_patch.stop()
+
 class TestMultiModalAgent(unittest.TestCase):
     """Test cases for the MultiModalAgent class"""
     
@@ -60,6 +75,673 @@ class TestMultiModalAgent(unittest.TestCase):
         messages = agent._prepare_messages(prompt, [img_data])
         self.assertEqual(len(messages), 1)
         self.assertEqual(len(messages[0]["content"]), 2)  # text + image
+    
+    def test_stream_api_parsing(self):
+        """Test that streamed SSE chunks are yielded as content deltas"""
+        from agent import MultiModalAgent
+        
+        agent = MultiModalAgent(self.api_key)
+        mock_post = agent.session.post = MagicMock()
+        response = mock_post.return_value.__enter__.return_value
+        response.iter_lines.return_value = [
+            'data: {"choices": [{"delta": {"role": "assistant"}}]}',
+            '',
+            'data: {"choices": [{"delta": {"content": "Hel"}}]}',
+            'data: {"choices": [{"delta": {"content": "lo"}}]}',
+            'data: [DONE]'
+        ]
+        
+        deltas = list(agent._stream_nebius_api(agent._prepare_messages("Test prompt")))
+        self.assertEqual(deltas, ["Hel", "lo"])
+        self.assertTrue(mock_post.call_args.kwargs["json"]["stream"])
+    
+    def test_process_request_stream(self):
+        """Test streamed events arrive in stage order and end with the full result"""
+        from agent import MultiModalAgent
+        
+        agent = MultiModalAgent(self.api_key)
+        agent._stream_nebius_api = Mock(return_value=iter(["Hel", "lo"]))
+        agent.citation_search.find_references = Mock(return_value=[])
+        
+        events = list(agent.process_request_stream("Test prompt", report_type="research"))
+        stages = [e["stage"] for e in events if e["type"] == "progress"]
+        self.assertEqual(stages, ["prompt built", "model streaming", "citations fetched"])
+        self.assertEqual([e["text"] for e in events if e["type"] == "token"][:2], ["Hel", "lo"])
+        
+        result = events[-1]["result"]
+        self.assertTrue(result["success"])
+        self.assertTrue(result["report"].startswith("Hello"))
+        self.assertIn("## References", result["report"])
+
+class TestAgentCitationCache(unittest.TestCase):
+    """Test cases for the agent's citation cache wiring"""
+    
+    def test_injected_cache(self):
+        """Test an injected citation cache is used and no on-disk cache is opened"""
+        from agent import MultiModalAgent
+        from utils import CitationCache
+        
+        cache = CitationCache()
+        agent = MultiModalAgent("test_api_key", citation_cache=cache)
+        self.assertIs(agent.citation_search.cache, cache)
+    
+    def test_tests_never_open_home_cache(self):
+        """Test agents built by the suite run without the default on-disk citation cache"""
+        from agent import MultiModalAgent
+        
+        with patch("agent.CitationCache") as cache_class:
+            agent = MultiModalAgent("test_api_key")
+        cache_class.assert_not_called()
+        self.assertIsNone(agent.citation_search.cache)
+
+class TestCitationSearch(unittest.TestCase):
+    """Test cases for concurrent citation lookup"""
+    
+    def make_search(self, delays, **kwargs):
+        from agent import CitationSearch
+        from utils import CitationCache
+        
+        search = CitationSearch(cache=CitationCache(), **kwargs)
+        search.calls = []
+        def fake_source(name):
+            def run(query, limit=3):
+                search.calls.append(name)
+                time.sleep(delays[name])
+                return [{"title": name, "source": name}]
+            return run
+        search.search_semantic_scholar = fake_source("semantic_scholar")
+        search.search_arxiv = fake_source("arxiv")
+        search.search_crossref = fake_source("crossref")
+        return search
+    
+    def test_sources_queried_concurrently(self):
+        """Test total latency is the slowest source, not the sum"""
+        search = self.make_search({"semantic_scholar": 0.2, "arxiv": 0.2, "crossref": 0.2})
+        start = time.perf_counter()
+        references = search.find_references("query")
+        elapsed = time.perf_counter() - start
+        
+        self.assertEqual([r["source"] for r in references], ["semantic_scholar", "arxiv", "crossref"])
+        self.assertLess(elapsed, 0.4)
+    
+    def test_source_timeout(self):
+        """Test a source past its timeout is dropped without delaying the others"""
+        search = self.make_search(
+            {"semantic_scholar": 0.05, "arxiv": 0.6, "crossref": 0.05},
+            source_timeouts={"arxiv": 0.1}
+        )
+        start = time.perf_counter()
+        references = search.find_references("query")
+        elapsed = time.perf_counter() - start
+        
+        self.assertEqual([r["source"] for r in references], ["semantic_scholar", "crossref"])
+        self.assertLess(elapsed, 0.4)
+    
+    def test_cached_lookup_skips_search(self):
+        """Test a repeated query is served from the cache, including empty results"""
+        search = self.make_search({"semantic_scholar": 0, "arxiv": 0, "crossref": 0})
+        search.search_crossref = lambda query, limit=3: []
+        
+        first = search.find_references("Quantum  Computing?")
+        second = search.find_references("quantum computing")
+        
+        self.assertEqual(first, second)
+        self.assertEqual(search.calls, ["semantic_scholar", "arxiv"])
+        stats = search.cache.stats()
+        self.assertEqual((stats["hits"], stats["negative_hits"], stats["misses"]), (2, 1, 3))
+        self.assertEqual(stats["hit_rate"], 0.5)
+    
+    def test_citations_overlap_model_call(self):
+        """Test the citation lookup runs while the model call is in progress"""
+        from agent import MultiModalAgent
+        
+        agent = MultiModalAgent("test_api_key")
+        def slow_call(messages, max_tokens=4000):
+            time.sleep(0.3)
+            return "report"
+        def slow_references(query, limit_per_source=2):
+            time.sleep(0.3)
+            return [{"title": "Paper", "authors": ["A"], "year": 2024, "source": "arXiv"}]
+        agent._call_nebius_api = slow_call
+        agent.citation_search.find_references = slow_references
+        
+        start = time.perf_counter()
+        result = agent.process_request("query", report_type="research")
+        elapsed = time.perf_counter() - start
+        
+        self.assertTrue(result["success"])
+        self.assertEqual(result["metadata"]["citation_count"], 1)
+        self.assertIn("## References", result["report"])
+        self.assertLess(elapsed, 0.5)
+    
+    def test_citations_skipped_for_other_report_types(self):
+        """Test report types without citations succeed with a zero count"""
+        from agent import MultiModalAgent
+        
+        agent = MultiModalAgent("test_api_key")
+        agent._call_nebius_api = Mock(return_value="report")
+        agent.citation_search.find_references = Mock()
+        
+        result = agent.process_request("query", report_type="comprehensive", include_citations=True)
+        self.assertTrue(result["success"])
+        self.assertEqual(result["metadata"]["citation_count"], 0)
+        agent.citation_search.find_references.assert_not_called()
+
+class TestBatchAnalyze(unittest.TestCase):
+    """Test cases for concurrent batch processing"""
+    
+    def make_agent(self):
+        from agent import MultiModalAgent
+        
+        agent = MultiModalAgent("test_api_key")
+        def fake_process_request(prompt, **kwargs):
+            if prompt == "fail":
+                raise RuntimeError("model unavailable")
+            time.sleep(float(prompt))
+            return {"success": True, "report": prompt}
+        agent.process_request = fake_process_request
+        return agent
+    
+    def test_batch_is_concurrent_and_ordered(self):
+        """Test results keep request order while running in parallel"""
+        agent = self.make_agent()
+        requests = [{"prompt": delay} for delay in ("0.3", "0.1", "0.2", "0.3")]
+        
+        start = time.perf_counter()
+        results = agent.batch_analyze(requests, max_workers=4)
+        elapsed = time.perf_counter() - start
+        
+        self.assertEqual([r["report"] for r in results], ["0.3", "0.1", "0.2", "0.3"])
+        self.assertLess(elapsed, 0.6)
+    
+    def test_failure_is_isolated(self):
+        """Test one failing item does not affect the rest"""
+        agent = self.make_agent()
+        results = agent.batch_analyze([{"prompt": "0"}, {"prompt": "fail"}, {"prompt": "0"}], max_workers=2)
+        
+        self.assertEqual([r["success"] for r in results], [True, False, True])
+        self.assertIn("model unavailable", results[1]["error"])
+    
+    def test_iter_yields_in_completion_order(self):
+        """Test the streaming iterator yields each result as soon as it is ready"""
+        agent = self.make_agent()
+        completed = [i for i, _ in agent.iter_batch_analyze([{"prompt": "0.3"}, {"prompt": "0.05"}], max_workers=2)]
+        self.assertEqual(completed, [1, 0])
+    
+    def test_rate_limiter(self):
+        """Test the token bucket spaces requests once the burst is spent"""
+        from utils import RateLimiter
+        
+        limiter = RateLimiter(rate=20, burst=2)
+        start = time.perf_counter()
+        for _ in range(4):
+            limiter.acquire()
+        elapsed = time.perf_counter() - start
+        
+        # Two requests from the burst, then one every 50ms
+        self.assertGreaterEqual(elapsed, 0.09)
+        self.assertLess(elapsed, 0.3)
+
+class TestResponseCache(unittest.TestCase):
+    """Test cases for the response cache"""
+    
+    def test_key_fields(self):
+        """Test report type, reasoning mode and image content all change the key"""
+        from utils import CacheManager
+        
+        base = CacheManager.make_key("prompt", [b"image"], "technical", "standard")
+        self.assertEqual(base, CacheManager.make_key("prompt", [b"image"], "technical", "standard"))
+        self.assertNotEqual(base, CacheManager.make_key("prompt", [b"image"], "research", "standard"))
+        self.assertNotEqual(base, CacheManager.make_key("prompt", [b"image"], "technical", "clinical"))
+        self.assertNotEqual(base, CacheManager.make_key("prompt", [b"other"], "technical", "standard"))
+    
+    def test_lru_eviction(self):
+        """Test the least recently used entry is evicted and get/set keep working"""
+        from utils import CacheManager
+        
+        cache = CacheManager(max_size=2)
+        cache.set("a", {"report": "a"})
+        cache.set("b", {"report": "b"})
+        self.assertEqual(cache.get("a"), {"report": "a"})
+        cache.set("c", {"report": "c"})
+        
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+    
+    def test_byte_bound_and_ttl(self):
+        """Test eviction by total size, oversized entries and expiry"""
+        from utils import CacheManager
+        
+        cache = CacheManager(max_size=100, max_bytes=100, ttl=0.05)
+        cache.set("a", {"report": "x" * 40})
+        cache.set("b", {"report": "y" * 40})
+        self.assertIsNone(cache.get("a"))
+        self.assertLessEqual(cache.stats()["bytes"], 100)
+        
+        cache.set("big", {"report": "z" * 200})
+        self.assertIsNone(cache.get("big"))
+        
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["entries"], 0)
+    
+    def test_process_request_uses_cache(self):
+        """Test an identical request is answered without calling the model, and failures are retried"""
+        from agent import MultiModalAgent
+        from utils import CacheManager
+        
+        agent = MultiModalAgent("test_api_key", cache=CacheManager())
+        agent._call_nebius_api = Mock(side_effect=[Exception("temporary"), "report", "other report"])
+        
+        self.assertFalse(agent.process_request("prompt", report_type="executive")["success"])
+        first = agent.process_request("prompt", report_type="executive")
+        second = agent.process_request("prompt", report_type="executive")
+        
+        self.assertEqual(second["report"], "report")
+        self.assertTrue(second["metadata"]["cached"])
+        self.assertNotIn("cached", first["metadata"])
+        self.assertEqual(agent._call_nebius_api.call_count, 2)
+        
+        other = agent.process_request("prompt", report_type="executive", reasoning_mode="clinical")
+        self.assertEqual(other["report"], "other report")
+        self.assertEqual(agent._call_nebius_api.call_count, 3)
+
+class TestCacheBackends(unittest.TestCase):
+    """Test cases for the pluggable cache backends and fleet-wide coalescing"""
+    
+    def setUp(self):
+        from cache_server import CacheServer
+        
+        self.server = CacheServer().start()
+        self.addCleanup(self.server.stop)
+    
+    def backends(self):
+        from utils import HTTPCacheBackend, MemoryCacheBackend, SQLiteCacheBackend
+        
+        return [MemoryCacheBackend(), SQLiteCacheBackend(":memory:"), HTTPCacheBackend(self.server.url, self.server.secret)]
+    
+    def test_backend_contract(self):
+        """Test every backend stores, expires, deletes and locks the same way"""
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                backend.set("key", b'{"report": "a"}')
+                backend.set("short", b"{}", ttl=0.05)
+                self.assertEqual(backend.get("key"), b'{"report": "a"}')
+                self.assertIsNone(backend.get("missing"))
+                time.sleep(0.1)
+                self.assertIsNone(backend.get("short"))
+                backend.delete("key")
+                self.assertIsNone(backend.get("key"))
+                
+                token = backend.acquire_lock("key", ttl=30)
+                self.assertIsNotNone(token)
+                self.assertIsNone(backend.acquire_lock("key", ttl=30))
+                backend.release_lock("key", "not-the-holder")
+                self.assertIsNone(backend.acquire_lock("key", ttl=30))
+                backend.release_lock("key", token)
+                self.assertIsNotNone(backend.acquire_lock("key", ttl=30))
+    
+    def test_sqlite_size_bound(self):
+        """Test the on-disk backend evicts least recently used rows"""
+        from utils import SQLiteCacheBackend
+        
+        backend = SQLiteCacheBackend(":memory:", max_size=2)
+        backend.set("a", b"1")
+        time.sleep(0.01)
+        backend.set("b", b"2")
+        time.sleep(0.01)
+        backend.get("a")
+        time.sleep(0.01)
+        backend.set("c", b"3")
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.stats()["entries"], 2)
+    
+    def test_fleet_coalescing(self):
+        """Test concurrent identical requests on two replicas make one upstream call"""
+        import threading
+        from utils import CacheManager, HTTPCacheBackend
+        
+        replicas = [CacheManager(backend=HTTPCacheBackend(self.server.url, self.server.secret), poll_interval=0.02) for _ in range(2)]
+        calls = []
+        def compute():
+            calls.append(1)
+            time.sleep(0.3)
+            return {"success": True, "report": "shared"}
+        
+        results = []
+        threads = [
+            threading.Thread(target=lambda m=m: results.append(m.get_or_compute("key", compute)))
+            for m in replicas for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r["report"] for r, _ in results], ["shared"] * 4)
+        self.assertEqual(sorted(cached for _, cached in results), [False, True, True, True])
+    
+    def test_failed_compute_releases_lock(self):
+        """Test a failing holder lets the next caller compute"""
+        from utils import CacheManager, HTTPCacheBackend
+        
+        manager = CacheManager(backend=HTTPCacheBackend(self.server.url, self.server.secret))
+        with self.assertRaises(RuntimeError):
+            manager.get_or_compute("key", Mock(side_effect=RuntimeError("model down")))
+        result, cached = manager.get_or_compute("key", lambda: {"report": "retry"})
+        self.assertEqual((result["report"], cached), ("retry", False))
+    
+    def test_unreachable_server_is_a_miss(self):
+        """Test an unreachable cache server never fails the request"""
+        from utils import CacheManager, HTTPCacheBackend
+        
+        manager = CacheManager(backend=HTTPCacheBackend("http://127.0.0.1:9", timeout=0.2))
+        result, cached = manager.get_or_compute("key", lambda: {"report": "local"})
+        self.assertEqual((result["report"], cached), ("local", False))
+        self.assertGreater(manager.stats()["errors"], 0)
+    
+    def test_server_requires_secret(self):
+        """Test the cache server refuses clients without the shared secret"""
+        import requests
+        from utils import CacheManager, HTTPCacheBackend
+        
+        self.assertEqual(requests.get(f"{self.server.url}/stats").status_code, 401)
+        self.assertEqual(
+            requests.put(f"{self.server.url}/cache/key", data=b"{}", headers={"X-Cache-Secret": "wrong"}).status_code,
+            401
+        )
+        
+        manager = CacheManager(backend=HTTPCacheBackend(self.server.url, "wrong"))
+        result, cached = manager.get_or_compute("key", lambda: {"report": "local"})
+        self.assertEqual((result["report"], cached), ("local", False))
+        self.assertIsNone(HTTPCacheBackend(self.server.url, self.server.secret).get("key"))
+    
+    def test_server_rejects_bad_requests(self):
+        """Test malformed headers get 400 and oversized bodies 413 without reaching the backend"""
+        import requests
+        
+        self.server.max_body = 1024
+        url = f"{self.server.url}/cache/key"
+        auth = {"X-Cache-Secret": self.server.secret}
+        
+        self.assertEqual(requests.put(url, data=b"{}", headers={**auth, "X-Cache-TTL": "soon"}).status_code, 400)
+        self.assertEqual(requests.put(url, data=b"{}", headers={**auth, "X-Cache-TTL": "nan"}).status_code, 400)
+        self.assertEqual(requests.put(url, data=b"x" * 2048, headers=auth).status_code, 413)
+        self.assertEqual(
+            requests.post(f"{self.server.url}/locks/key", headers={**auth, "X-Lock-TTL": "-1"}).status_code, 400
+        )
+        self.assertIsNone(self.server.backend.get("key"))
+        self.assertEqual(requests.put(url, data=b"{}", headers=auth).status_code, 204)
+
+    def test_backend_interface_is_abstract(self):
+        """Test a backend missing part of the interface cannot be instantiated"""
+        from utils import CacheBackend
+        
+        class Partial(CacheBackend):
+            def get(self, key):
+                return None
+        
+        with self.assertRaises(TypeError):
+            Partial()
+
+class TestSingleFlight(unittest.TestCase):
+    """Test cases for in-flight request coalescing"""
+    
+    def run_concurrently(self, fn, count=4):
+        import threading
+        
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(fn())) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+    
+    def test_one_execution_per_key(self):
+        """Test concurrent callers share one execution and its failure"""
+        from utils import SingleFlight
+        
+        flight = SingleFlight()
+        calls = []
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return "value"
+        
+        results = self.run_concurrently(lambda: flight.do("key", slow))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(shared for _, shared in results), [False, True, True, True])
+        
+        def failing():
+            time.sleep(0.2)
+            raise RuntimeError("upstream failed")
+        def call():
+            try:
+                flight.do("key", failing)
+            except RuntimeError as e:
+                return str(e)
+        self.assertEqual(self.run_concurrently(call, 3), ["upstream failed"] * 3)
+    
+    def test_process_request_coalesces(self):
+        """Test identical concurrent requests make one model call and get independent results"""
+        from agent import MultiModalAgent
+        
+        agent = MultiModalAgent("test_api_key")
+        agent.cache = None
+        calls = []
+        def slow_call(messages, max_tokens=4000):
+            calls.append(1)
+            time.sleep(0.3)
+            return "report"
+        agent._call_nebius_api = slow_call
+        
+        results = self.run_concurrently(lambda: agent.process_request("prompt", report_type="executive"))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r["report"] for r in results], ["report"] * 4)
+        self.assertEqual(sum(1 for r in results if r["metadata"].get("coalesced")), 3)
+        
+        results[0]["metadata"]["report_type"] = "changed"
+        self.assertTrue(all(r["metadata"]["report_type"] == "executive" for r in results[1:]))
+        
+        agent.process_request("prompt", report_type="executive")
+        self.assertEqual(len(calls), 2)
+
+class TestAsyncSingleFlight(unittest.IsolatedAsyncioTestCase):
+    """Test cases for event-loop request coalescing"""
+    
+    async def test_shared_task_survives_cancelled_caller(self):
+        """Test a caller going away does not cancel the call others are waiting on"""
+        from utils import AsyncSingleFlight
+        
+        flight = AsyncSingleFlight()
+        calls = []
+        async def slow():
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return "value"
+        
+        first = asyncio.create_task(flight.do("key", slow))
+        second = asyncio.create_task(flight.do("key", slow))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        
+        self.assertEqual(await second, ("value", True))
+        self.assertEqual(len(calls), 1)
+    
+    async def test_aprocess_request_coalesces(self):
+        """Test identical concurrent async requests make one model call"""
+        from agent import MultiModalAgent
+        
+        agent = MultiModalAgent("test_api_key")
+        agent.cache = None
+        calls = []
+        async def slow_call(messages, max_tokens=4000):
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return "report"
+        agent._acall_nebius_api = slow_call
+        
+        results = await asyncio.gather(*[
+            agent.aprocess_request("prompt", report_type="executive") for _ in range(3)
+        ])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r["report"] for r in results], ["report"] * 3)
+        self.assertEqual(sum(1 for r in results if r["metadata"].get("coalesced")), 2)
+
+class TestCitationCache(unittest.TestCase):
+    """Test cases for the persistent citation cache"""
+    
+    def test_key_includes_source_and_limit(self):
+        """Test entries are separated by source and limit but not by query formatting"""
+        from utils import CitationCache
+        
+        cache = CitationCache()
+        cache.set("Gene Therapy", "arxiv", 2, [{"title": "A"}])
+        self.assertEqual(cache.get("gene   therapy!", "arxiv", 2), [{"title": "A"}])
+        self.assertIsNone(cache.get("gene therapy", "crossref", 2))
+        self.assertIsNone(cache.get("gene therapy", "arxiv", 3))
+    
+    def test_ttl_expiry(self):
+        """Test expired entries miss, and negative entries use their own TTL"""
+        from utils import CitationCache
+        
+        cache = CitationCache(ttl=60, negative_ttl=0.05)
+        cache.set("query", "arxiv", 2, [{"title": "A"}])
+        cache.set("query", "crossref", 2, [])
+        self.assertEqual(cache.get("query", "crossref", 2), [])
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("query", "crossref", 2))
+        self.assertEqual(cache.get("query", "arxiv", 2), [{"title": "A"}])
+        self.assertEqual(cache.stats()["expired"], 1)
+    
+    def test_size_bound(self):
+        """Test the least recently used entries are evicted past max_entries"""
+        from utils import CitationCache
+        
+        cache = CitationCache(max_entries=2)
+        cache.set("first", "arxiv", 2, [{"title": "1"}])
+        time.sleep(0.01)
+        cache.set("second", "arxiv", 2, [{"title": "2"}])
+        time.sleep(0.01)
+        cache.get("first", "arxiv", 2)
+        time.sleep(0.01)
+        cache.set("third", "arxiv", 2, [{"title": "3"}])
+        
+        self.assertIsNone(cache.get("second", "arxiv", 2))
+        self.assertIsNotNone(cache.get("first", "arxiv", 2))
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertEqual(cache.stats()["evictions"], 1)
+    
+    def test_persistence(self):
+        """Test entries survive reopening the database file"""
+        import os
+        import tempfile
+        from utils import CitationCache
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "citations.db")
+            cache = CitationCache(path)
+            cache.set("query", "arxiv", 2, [{"title": "A"}])
+            cache.close()
+            
+            reopened = CitationCache(path)
+            self.assertEqual(reopened.get("query", "arxiv", 2), [{"title": "A"}])
+            reopened.close()
+
+class TestAsyncAgent(unittest.IsolatedAsyncioTestCase):
+    """Test cases for the pooled async client path"""
+    
+    def make_agent(self, handler):
+        import httpx
+        from agent import MultiModalAgent
+        
+        agent = MultiModalAgent("test_api_key")
+        agent._async_client = httpx.AsyncClient(
+            base_url=agent.base_url,
+            headers=agent._headers(),
+            transport=httpx.MockTransport(handler)
+        )
+        return agent
+    
+    async def test_aprocess_request_reuses_client(self):
+        """Test async requests share one client and return the same shape as process_request"""
+        import httpx
+        
+        seen = []
+        def handler(request):
+            seen.append(request)
+            return httpx.Response(200, json={"choices": [{"message": {"content": "async report"}}]})
+        agent = self.make_agent(handler)
+        client = agent.async_client
+        
+        for prompt in ("First prompt", "Second prompt"):
+            result = await agent.aprocess_request(prompt, include_citations=False)
+            self.assertTrue(result["success"])
+            self.assertEqual(result["report"], "async report")
+        
+        self.assertIs(agent.async_client, client)
+        self.assertEqual(len(seen), 2)
+        self.assertEqual(seen[0].url.path, "/v1/chat/completions")
+        self.assertEqual(seen[0].headers["authorization"], "Bearer test_api_key")
+        await agent.aclose()
+        self.assertTrue(client.is_closed)
+    
+    async def test_aprocess_request_error(self):
+        """Test HTTP errors become a failed result"""
+        import httpx
+        
+        agent = self.make_agent(lambda request: httpx.Response(503))
+        result = await agent.aprocess_request("Test prompt", include_citations=False)
+        self.assertFalse(result["success"])
+        self.assertIn("Failed to get response", result["error"])
+        await agent.aclose()
+    
+    async def test_aprocess_request_stream(self):
+        """Test the async stream yields deltas and the joined report"""
+        import httpx
+        
+        body = (
+            'data: {"choices": [{"delta": {"content": "Hel"}}]}\n\n'
+            'data: {"choices": [{"delta": {"content": "lo"}}]}\n\n'
+            'data: [DONE]\n\n'
+        )
+        agent = self.make_agent(lambda request: httpx.Response(200, text=body))
+        events = [e async for e in agent.aprocess_request_stream("Test prompt", include_citations=False)]
+        
+        self.assertEqual([e["text"] for e in events if e["type"] == "token"], ["Hel", "lo"])
+        self.assertEqual(events[-1]["result"]["report"], "Hello")
+        await agent.aclose()
+    
+    async def test_aprocess_request_fleet_coalescing(self):
+        """Test identical async requests on two replicas sharing a backend make one model call"""
+        import asyncio
+        import httpx
+        from agent import MultiModalAgent
+        from utils import CacheManager, MemoryCacheBackend
+        
+        calls = []
+        async def handler(request):
+            calls.append(request)
+            await asyncio.sleep(0.2)
+            return httpx.Response(200, json={"choices": [{"message": {"content": "shared report"}}]})
+        
+        backend = MemoryCacheBackend()
+        replicas = []
+        for _ in range(2):
+            agent = MultiModalAgent("test_api_key", cache=CacheManager(backend=backend, poll_interval=0.02))
+            agent._async_client = httpx.AsyncClient(base_url=agent.base_url, transport=httpx.MockTransport(handler))
+            replicas.append(agent)
+        
+        results = await asyncio.gather(*(a.aprocess_request("Shared prompt", include_citations=False) for a in replicas))
+        
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r["report"] for r in results], ["shared report"] * 2)
+        self.assertEqual(sorted(bool(r["metadata"].get("cached")) for r in results), [False, True])
+        for agent in replicas:
+            await agent.aclose()
 
 class TestUtils(unittest.TestCase):
     """Test cases for utility functions"""
@@ -138,6 +820,141 @@ class TestUtils(unittest.TestCase):
         self.assertIn('<html>', html_content)
         self.assertIn('Test report content', html_content)
 
+class FakeWebSocket:
+    """In-memory stand-in for a websocket connection"""
+    
+    def __init__(self, messages=None):
+        self.messages = [json.dumps(m) for m in (messages or [])]
+        # Replies carrying an id to wait for before closing
+        self.expected = len(self.messages)
+        self.sent = []
+    
+    def __aiter__(self):
+        return self._iterate()
+    
+    async def _iterate(self):
+        for message in self.messages:
+            yield message
+        # Keep the connection open until every request has been answered; notifications carry no id
+        while sum(1 for m in self.sent if "id" in m) < self.expected:
+            await asyncio.sleep(0.01)
+    
+    async def send(self, message):
+        self.sent.append(json.loads(message))
+
+class TestMCPServer(unittest.IsolatedAsyncioTestCase):
+    """Test cases for concurrent MCP request handling"""
+    
+    def make_server(self, analysis_seconds=0.3, **kwargs):
+        from mcp_server import MCPServer
+        
+        server = MCPServer("test_api_key", **kwargs)
+        async def slow_process_request(**params):
+            await asyncio.sleep(params.pop("delay", analysis_seconds))
+            return {"success": True, "report": params.get("prompt")}
+        server.agent.aprocess_request = slow_process_request
+        return server
+    
+    async def test_ping_not_blocked_by_analysis(self):
+        """A ping sent after a slow analysis is answered first"""
+        server = self.make_server()
+        websocket = FakeWebSocket([
+            {"id": 1, "method": "analyze", "params": {"prompt": "slow"}},
+            {"id": 2, "method": "ping"}
+        ])
+        await server.client_handler(websocket)
+        
+        self.assertEqual([m["id"] for m in websocket.sent], [2, 1])
+        self.assertEqual(websocket.sent[1]["result"]["report"], "slow")
+    
+    async def test_concurrent_analyses_per_connection(self):
+        """Analyses on one socket overlap up to the in-flight limit"""
+        server = self.make_server(analysis_seconds=0.3, max_in_flight=2)
+        websocket = FakeWebSocket([
+            {"id": i, "method": "analyze", "params": {"prompt": str(i)}} for i in range(4)
+        ])
+        start = time.perf_counter()
+        await server.client_handler(websocket)
+        elapsed = time.perf_counter() - start
+        
+        self.assertEqual(sorted(m["id"] for m in websocket.sent), [0, 1, 2, 3])
+        # Two at a time: about 0.6s instead of 1.2s sequentially
+        self.assertLess(elapsed, 1.0)
+        self.assertGreaterEqual(elapsed, 0.55)
+    
+    async def test_responses_out_of_order(self):
+        """A fast request sent second is answered before a slow one"""
+        server = self.make_server()
+        websocket = FakeWebSocket([
+            {"id": "a", "method": "analyze", "params": {"prompt": "slow", "delay": 0.4}},
+            {"id": "b", "method": "analyze", "params": {"prompt": "fast", "delay": 0.05}}
+        ])
+        await server.client_handler(websocket)
+        
+        self.assertEqual([m["id"] for m in websocket.sent], ["b", "a"])
+        self.assertEqual(websocket.sent[0]["result"]["report"], "fast")
+    
+    async def test_cancel_by_id(self):
+        """Cancelling an in-flight request answers it with a cancellation error"""
+        server = self.make_server(analysis_seconds=0.5)
+        websocket = FakeWebSocket([
+            {"id": 1, "method": "analyze", "params": {"prompt": "slow"}},
+            {"id": 2, "method": "cancel", "params": {"id": 1}}
+        ])
+        await server.client_handler(websocket)
+        
+        responses = {m["id"]: m for m in websocket.sent}
+        self.assertEqual(responses[2]["result"], {"cancelled": True})
+        self.assertEqual(responses[1]["error"]["code"], -32800)
+    
+    async def test_malformed_frames_keep_connection(self):
+        """Valid JSON that is not a request object is answered with an error and the socket stays usable"""
+        server = self.make_server(analysis_seconds=0.01)
+        websocket = FakeWebSocket()
+        websocket.messages = [
+            json.dumps([{"id": 9, "method": "ping"}]),
+            json.dumps("x"),
+            "42",
+            json.dumps({"id": 3, "method": "analyze", "params": ["not", "an", "object"]}),
+            json.dumps({"id": 4, "method": "cancel", "params": 1}),
+            json.dumps({"id": 5, "method": "ping"})
+        ]
+        websocket.expected = 3
+        await server.client_handler(websocket)
+        
+        self.assertEqual([m["error"]["code"] for m in websocket.sent[:3]], [-32600] * 3)
+        responses = {m["id"]: m for m in websocket.sent if "id" in m}
+        self.assertEqual(responses[3]["error"]["code"], -32602)
+        self.assertEqual(responses[4]["error"]["code"], -32602)
+        self.assertEqual(responses[5]["result"], {"status": "pong"})
+
+    async def test_streaming_analyze(self):
+        """Streamed tokens and progress arrive as notifications before the final response"""
+        server = self.make_server()
+        async def fake_stream(**params):
+            yield {"type": "progress", "stage": "prompt built"}
+            yield {"type": "progress", "stage": "model streaming"}
+            for delta in ("par", "tial"):
+                yield {"type": "token", "text": delta}
+            yield {"type": "result", "result": {"success": True, "report": "partial"}}
+        server.agent.aprocess_request_stream = fake_stream
+        websocket = FakeWebSocket([
+            {"id": 7, "method": "analyze", "params": {"prompt": "stream me", "stream": True}}
+        ])
+        await server.client_handler(websocket)
+        
+        notifications = websocket.sent[:-1]
+        self.assertTrue(all(m["params"]["requestId"] == 7 for m in notifications))
+        self.assertEqual(
+            [m["params"]["stage"] for m in notifications if m["method"] == "notifications/progress"],
+            ["prompt built", "model streaming"]
+        )
+        self.assertEqual(
+            "".join(m["params"]["delta"] for m in notifications if m["method"] == "notifications/token"),
+            "partial"
+        )
+        self.assertEqual(websocket.sent[-1], {"id": 7, "result": {"success": True, "report": "partial"}})
+
 class TestConfig(unittest.TestCase):
     """Test configuration management"""
     
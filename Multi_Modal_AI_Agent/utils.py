@@ -1,9 +1,19 @@
-﻿import base64
+﻿import asyncio
+import base64
 import io
 from PIL import Image
 import hashlib
 import json
-from typing import Dict, Any, List, Optional, Union
+import os
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Any, List, Optional, Tuple, Union
+import requests
 import logging
 from datetime import datetime
 
@@ -184,43 +194,647 @@ class RequestValidator:
         
         return {"valid": True}
 
+class RateLimiter:
+    """Thread-safe token bucket: `rate` requests per second with bursts of up to `burst`; rate 0 disables it"""
+    
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _reserve(self) -> float:
+        """Take a token, returning how long the caller must wait before using it"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            # A negative balance is a queue of reservations, each one interval behind the last
+            return max(0.0, -self.tokens / self.rate)
+    
+    def acquire(self):
+        """Block until a request may be sent"""
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+    
+    async def acquire_async(self):
+        """Wait until a request may be sent without blocking the event loop"""
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+class CacheBackend(ABC):
+    """Storage interface for CacheManager: serialized entries with expiry, plus short-lived locks for coalescing"""
+    
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        ...
+    
+    @abstractmethod
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        ...
+    
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+    
+    @abstractmethod
+    def clear(self):
+        ...
+    
+    @abstractmethod
+    def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        """Take the compute lock for a key, returning a release token, or None if another holder has it"""
+    
+    @abstractmethod
+    def release_lock(self, key: str, token: str):
+        ...
+    
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+class MemoryCacheBackend(CacheBackend):
+    """Per-process LRU storage bounded by entry count and total bytes"""
+    
+    def __init__(self, max_size: int = 100, max_bytes: int = 64 * 1024 * 1024):
+        # key -> (value, expiry time); ordered from least to most recently used
+        self.entries = OrderedDict()
+        self.locks = {}
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.metrics = {"expired": 0, "evictions": 0}
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                self._remove(key)
+                self.metrics["expired"] += 1
+                return None
+            self.entries.move_to_end(key)
+            return value
+    
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        if len(value) > self.max_bytes:
+            return
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, expires)
+            self.total_bytes += len(value)
+            while len(self.entries) > self.max_size or self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.metrics["evictions"] += 1
+    
+    def _remove(self, key: str):
+        value, _ = self.entries.pop(key)
+        self.total_bytes -= len(value)
+    
+    def delete(self, key: str):
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+    
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.total_bytes = 0
+    
+    def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            holder = self.locks.get(key)
+            if holder is not None and holder[1] > now:
+                return None
+            token = os.urandom(8).hex()
+            self.locks[key] = (token, now + ttl)
+            return token
+    
+    def release_lock(self, key: str, token: str):
+        with self._lock:
+            if self.locks.get(key, (None,))[0] == token:
+                del self.locks[key]
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.metrics, "entries": len(self.entries), "bytes": self.total_bytes}
+
+class SQLiteCacheBackend(CacheBackend):
+    """On-disk storage shared by every process on the host, evicting least recently used rows"""
+    
+    def __init__(self, path: str, max_size: int = 1000, max_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.metrics = {"expired": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        if path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires REAL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, token TEXT NOT NULL, expires REAL NOT NULL)")
+        self.conn.commit()
+    
+    def get(self, key: str) -> Optional[bytes]:
+        # Wall-clock time because entries outlive the process
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] <= now:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+                self.metrics["expired"] += 1
+                return None
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            return bytes(row[0])
+    
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        if len(value) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, expires, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now + ttl if ttl else None, now)
+            )
+            self.conn.execute("DELETE FROM responses WHERE expires IS NOT NULL AND expires <= ?", (now,))
+            count, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            if count > self.max_size or total > self.max_bytes:
+                for old_key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+                    if count <= self.max_size and total <= self.max_bytes:
+                        break
+                    self.conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    count, total = count - 1, total - size
+                    self.metrics["evictions"] += 1
+            self.conn.commit()
+    
+    def delete(self, key: str):
+        with self._lock:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.conn.commit()
+    
+    def clear(self):
+        with self._lock:
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+    
+    def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        now = time.time()
+        token = os.urandom(8).hex()
+        with self._lock:
+            self.conn.execute("DELETE FROM locks WHERE key = ? AND expires <= ?", (key, now))
+            acquired = self.conn.execute(
+                "INSERT OR IGNORE INTO locks (key, token, expires) VALUES (?, ?, ?)", (key, token, now + ttl)
+            ).rowcount == 1
+            self.conn.commit()
+        return token if acquired else None
+    
+    def release_lock(self, key: str, token: str):
+        with self._lock:
+            self.conn.execute("DELETE FROM locks WHERE key = ? AND token = ?", (key, token))
+            self.conn.commit()
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            return {**self.metrics, "entries": entries, "bytes": total}
+    
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+class HTTPCacheBackend(CacheBackend):
+    """Networked storage shared across replicas, speaking the protocol served by cache_server.py"""
+    
+    def __init__(self, base_url: str, secret: Optional[str] = None, timeout: float = 2.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        if secret:
+            self.session.headers["X-Cache-Secret"] = secret
+        self.metrics = {"errors": 0}
+    
+    def _request(self, method: str, path: str, **kwargs) -> Optional[requests.Response]:
+        # The cache must never fail a request: network errors count as misses
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            self.metrics["errors"] += 1
+            logger.warning(f"Cache server {method} {path} failed: {e}")
+            return None
+        if response.status_code == 401:
+            # A wrong secret is treated like an unreachable server rather than waiting on locks
+            self.metrics["errors"] += 1
+            logger.error("Cache server rejected CACHE_SECRET")
+            return None
+        return response
+    
+    def get(self, key: str) -> Optional[bytes]:
+        response = self._request("GET", f"/cache/{key}")
+        if response is None or response.status_code != 200:
+            return None
+        return response.content
+    
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        headers = {"X-Cache-TTL": str(ttl)} if ttl else {}
+        self._request("PUT", f"/cache/{key}", data=value, headers=headers)
+    
+    def delete(self, key: str):
+        self._request("DELETE", f"/cache/{key}")
+    
+    def clear(self):
+        self._request("DELETE", "/cache")
+    
+    def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        response = self._request("POST", f"/locks/{key}", headers={"X-Lock-TTL": str(ttl)})
+        if response is None:
+            # Unreachable server: compute locally rather than wait on a lock nobody can grant
+            return "unlocked"
+        if response.status_code != 201:
+            return None
+        return response.headers.get("X-Lock-Token", "")
+    
+    def release_lock(self, key: str, token: str):
+        if token != "unlocked":
+            self._request("DELETE", f"/locks/{key}", headers={"X-Lock-Token": token})
+    
+    def stats(self) -> Dict[str, Any]:
+        response = self._request("GET", "/stats")
+        remote = response.json() if response is not None and response.status_code == 200 else {}
+        return {**remote, **self.metrics}
+
+def create_cache_backend(
+    kind: str = "memory",
+    max_size: int = 100,
+    max_bytes: int = 64 * 1024 * 1024,
+    path: Optional[str] = None,
+    url: Optional[str] = None,
+    secret: Optional[str] = None
+) -> CacheBackend:
+    """Build the cache backend named by configuration"""
+    if kind == "memory":
+        return MemoryCacheBackend(max_size, max_bytes)
+    if kind == "sqlite":
+        return SQLiteCacheBackend(path or ":memory:", max_size, max_bytes)
+    if kind == "http":
+        if not url:
+            raise ValueError("The http cache backend requires a URL")
+        return HTTPCacheBackend(url, secret)
+    raise ValueError(f"Unknown cache backend: {kind}")
+
 class CacheManager:
-    """Simple in-memory cache for responses"""
+    """Response cache over a pluggable backend, with TTL expiry and fleet-wide request coalescing"""
     
-    def __init__(self, max_size: int = 100):
-        self.cache = {}
+    def __init__(
+        self,
+        max_size: int = 100,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: Optional[float] = 3600,
+        backend: Optional[CacheBackend] = None,
+        lock_ttl: float = 300,
+        poll_interval: float = 0.25
+    ):
+        self.backend = backend or MemoryCacheBackend(max_size, max_bytes)
         self.max_size = max_size
-        self.access_order = []
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self.metrics = {"hits": 0, "misses": 0, "coalesced": 0}
+        self._lock = threading.Lock()
     
-    def _generate_key(self, prompt: str, images: Optional[List[bytes]] = None) -> str:
+    @staticmethod
+    def make_key(
+        prompt: str,
+        images: Optional[List[bytes]] = None,
+        report_type: str = "comprehensive",
+        reasoning_mode: str = "standard",
+        include_citations: bool = True
+    ) -> str:
+        """Cache key for a request: everything that changes the generated report"""
+        key_data = json.dumps([
+            prompt,
+            report_type,
+            reasoning_mode,
+            include_citations,
+            [hashlib.sha256(img).hexdigest() for img in images or []]
+        ])
+        return hashlib.sha256(key_data.encode()).hexdigest()
+    
+    def _generate_key(self, prompt: str, images: Optional[List[bytes]] = None, **key_fields) -> str:
         """Generate cache key"""
-        key_data = prompt
-        if images:
-            # Add image hashes to key
-            img_hashes = [hashlib.md5(img).hexdigest()[:8] for img in images]
-            key_data += "_" + "_".join(img_hashes)
+        return self.make_key(prompt, images, **key_fields)
+    
+    def _count(self, metric: str):
+        with self._lock:
+            self.metrics[metric] += 1
+    
+    def _read(self, key: str) -> Optional[Dict[str, Any]]:
+        # Entries are stored serialized, so every reader gets its own copy
+        data = self.backend.get(key)
+        return json.loads(data) if data is not None else None
+    
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """Cached response for a key, or None when missing or expired"""
+        response = self._read(key)
+        self._count("hits" if response is not None else "misses")
+        return response
+    
+    def store(self, key: str, response: Dict[str, Any]):
+        """Cache a response under a key; the backend evicts to stay within its bounds"""
+        try:
+            data = json.dumps(response, default=str).encode()
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Response not cacheable: {e}")
+            return
+        self.backend.set(key, data, self.ttl)
+    
+    def get_or_compute(self, key: str, compute: Callable[[], Dict[str, Any]]) -> Tuple[Dict[str, Any], bool]:
+        """
+        Return (response, cached). On a miss only the holder of the backend lock runs compute();
+        other callers, in this process or on other replicas sharing the backend, wait for its entry.
+        compute() should raise rather than return a result that must not be cached.
+        """
+        response = self.lookup(key)
+        if response is not None:
+            return response, True
         
-        return hashlib.md5(key_data.encode()).hexdigest()
+        deadline = time.monotonic() + self.lock_ttl
+        while True:
+            token = self.backend.acquire_lock(key, self.lock_ttl)
+            if token is not None:
+                try:
+                    # Filled by the previous holder between our miss and taking the lock
+                    response = self._read(key)
+                    if response is not None:
+                        self._count("coalesced")
+                        return response, True
+                    response = compute()
+                    self.store(key, response)
+                    return response, False
+                finally:
+                    self.backend.release_lock(key, token)
+            
+            time.sleep(self.poll_interval)
+            response = self._read(key)
+            if response is not None:
+                self._count("coalesced")
+                return response, True
+            if time.monotonic() >= deadline:
+                logger.warning("Timed out waiting for a coalesced request; computing locally")
+                response = compute()
+                self.store(key, response)
+                return response, False
     
-    def get(self, prompt: str, images: Optional[List[bytes]] = None) -> Optional[Dict[str, Any]]:
+    async def aget_or_compute(
+        self, key: str, compute: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Tuple[Dict[str, Any], bool]:
+        """Async variant of get_or_compute; backend calls run in worker threads so the event loop never blocks on them"""
+        response = await asyncio.to_thread(self.lookup, key)
+        if response is not None:
+            return response, True
+        
+        deadline = time.monotonic() + self.lock_ttl
+        while True:
+            token = await asyncio.to_thread(self.backend.acquire_lock, key, self.lock_ttl)
+            if token is not None:
+                try:
+                    response = await asyncio.to_thread(self._read, key)
+                    if response is not None:
+                        self._count("coalesced")
+                        return response, True
+                    response = await compute()
+                    await asyncio.to_thread(self.store, key, response)
+                    return response, False
+                finally:
+                    await asyncio.to_thread(self.backend.release_lock, key, token)
+            
+            await asyncio.sleep(self.poll_interval)
+            response = await asyncio.to_thread(self._read, key)
+            if response is not None:
+                self._count("coalesced")
+                return response, True
+            if time.monotonic() >= deadline:
+                logger.warning("Timed out waiting for a coalesced request; computing locally")
+                response = await compute()
+                await asyncio.to_thread(self.store, key, response)
+                return response, False
+    
+    def get(self, prompt: str, images: Optional[List[bytes]] = None, **key_fields) -> Optional[Dict[str, Any]]:
         """Get cached response"""
-        key = self._generate_key(prompt, images)
-        if key in self.cache:
-            # Update access order
-            self.access_order.remove(key)
-            self.access_order.append(key)
-            return self.cache[key]
-        return None
-    
-    def set(self, prompt: str, response: Dict[str, Any], images: Optional[List[bytes]] = None):
+        return self.lookup(self._generate_key(prompt, images, **key_fields))
+    
+    def set(self, prompt: str, response: Dict[str, Any], images: Optional[List[bytes]] = None, **key_fields):
         """Cache response"""
-        key = self._generate_key(prompt, images)
+        self.store(self._generate_key(prompt, images, **key_fields), response)
+    
+    def clear(self):
+        self.backend.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Hit-rate metrics merged with the backend's size and eviction counts"""
+        with self._lock:
+            metrics = dict(self.metrics)
+        lookups = metrics["hits"] + metrics["misses"]
+        return {
+            **self.backend.stats(),
+            **metrics,
+            "hit_rate": round(metrics["hits"] / lookups, 4) if lookups else 0.0
+        }
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into one execution whose outcome every caller shares"""
+    
+    def __init__(self):
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.metrics = {"leaders": 0, "shared": 0}
+    
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Return (result, shared); shared is True when another caller's execution was joined"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.metrics["leaders"] += 1
+            else:
+                self.metrics["shared"] += 1
+        if not leader:
+            return future.result(), True
         
-        # Remove oldest if cache is full
-        if len(self.cache) >= self.max_size and key not in self.cache:
-            oldest_key = self.access_order.pop(0)
-            del self.cache[oldest_key]
+        try:
+            result = fn()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+class AsyncSingleFlight:
+    """Event-loop variant of SingleFlight built on shared tasks"""
+    
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.metrics = {"leaders": 0, "shared": 0}
+    
+    async def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Return (result, shared); a caller that goes away does not cancel the work others wait on"""
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            self.metrics["shared"] += 1
+        else:
+            self.metrics["leaders"] += 1
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task), shared
+    
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+class CitationCache:
+    """Persistent SQLite cache for citation lookups, keyed by normalized query, source and limit"""
+    
+    def __init__(
+        self,
+        path: str = ":memory:",
+        ttl: float = 86400,
+        negative_ttl: float = 3600,
+        max_entries: int = 5000
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.metrics = {"hits": 0, "negative_hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+        self._lock = threading.Lock()
         
-        self.cache[key] = response
-        if key not in self.access_order:
-            self.access_order.append(key)
\ No newline at end of file
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Lookups arrive from the citation thread pool, so one connection is shared under the lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS citations (
+                key TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                results TEXT NOT NULL,
+                expires REAL NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS citations_last_access ON citations (last_access)")
+        self.conn.commit()
+    
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """Lowercase and drop punctuation and extra whitespace so trivially different prompts share an entry"""
+        return " ".join(re.findall(r"\w+", query.lower()))
+    
+    def _generate_key(self, query: str, source: str, limit: int) -> str:
+        key_data = f"{source}\x00{limit}\x00{self.normalize_query(query)}"
+        return hashlib.sha256(key_data.encode()).hexdigest()
+    
+    def get(self, query: str, source: str, limit: int) -> Optional[List[Dict]]:
+        """Cached results, an empty list for a cached negative lookup, or None on a miss"""
+        key = self._generate_key(query, source, limit)
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT results, expires FROM citations WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.metrics["misses"] += 1
+                return None
+            if row[1] <= now:
+                self.conn.execute("DELETE FROM citations WHERE key = ?", (key,))
+                self.conn.commit()
+                self.metrics["expired"] += 1
+                self.metrics["misses"] += 1
+                return None
+            self.conn.execute("UPDATE citations SET last_access = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            results = json.loads(row[0])
+            self.metrics["hits" if results else "negative_hits"] += 1
+            return results
+    
+    def set(self, query: str, source: str, limit: int, results: List[Dict]):
+        """Cache results; empty results (no match or a failed search) expire after the shorter negative TTL"""
+        key = self._generate_key(query, source, limit)
+        now = time.time()
+        ttl = self.ttl if results else self.negative_ttl
+        try:
+            payload = json.dumps(results, default=str)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Citation results for {source} not cacheable: {e}")
+            return
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO citations (key, source, results, expires, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, source, payload, now + ttl, now)
+            )
+            self._evict(now)
+            self.conn.commit()
+    
+    def _evict(self, now: float):
+        """Drop expired entries, then the least recently used ones beyond max_entries"""
+        self.conn.execute("DELETE FROM citations WHERE expires <= ?", (now,))
+        count = self.conn.execute("SELECT COUNT(*) FROM citations").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self.conn.execute(
+                "DELETE FROM citations WHERE key IN (SELECT key FROM citations ORDER BY last_access LIMIT ?)",
+                (overflow,)
+            )
+            self.metrics["evictions"] += overflow
+    
+    def stats(self) -> Dict[str, Any]:
+        """Hit-rate metrics and current size"""
+        with self._lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM citations").fetchone()[0]
+            metrics = dict(self.metrics)
+        lookups = metrics["hits"] + metrics["negative_hits"] + metrics["misses"]
+        hit_rate = (metrics["hits"] + metrics["negative_hits"]) / lookups if lookups else 0.0
+        return {**metrics, "entries": entries, "hit_rate": round(hit_rate, 4)}
+    
+    def clear(self):
+        """Remove every cached lookup"""
+        with self._lock:
+            self.conn.execute("DELETE FROM citations")
+            self.conn.commit()
+    
+    def close(self):
+        with self._lock:
+            self.conn.close()
\ No newline at end of file